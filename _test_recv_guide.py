@@ -1,4 +1,4 @@
-import json
+from guideChannel import GuideReader, GUIDE_DEGREE_NONE
 from debug import DEBUG, ERROR, TRACE, INFO
 from motorContl import MotorController
 from miniMotorDriver import MiniMotorDriver
@@ -62,16 +62,12 @@ if __name__ == '__main__':
     right_motor = MiniMotorDriver(0x60)
     m1 = 0
     m2 = 0
+    guideReader = GuideReader()
     while(True):
-        with open('./guide_info.json', mode='r') as f:
-            try:
-                guide_info_json = json.load(f)
-                guide_degree = guide_info_json.get('degree', 360)
-                if guide_degree != 360:
-                    INFO('guide_degree = ' + str(guide_degree))
-                    m1, m2 = calcMotorPowersByBallAngle(-guide_degree)
-            except json.JSONDecodeError:
-                ERROR('faild to load guide_info.json')
+        guide = guideReader.read()
+        if guide.degree != GUIDE_DEGREE_NONE:
+            INFO('guide_degree = ' + str(guide.degree))
+            m1, m2 = calcMotorPowersByBallAngle(-guide.degree)
         
         motorPowers = roundOffMotorSpeeds((m1, m2))
         INFO('left: ' + str(motorPowers[0]) + 'right: ' + str(motorPowers[1]))
@@ -0,0 +1,248 @@
+# coding: UTF-8
+
+import math
+import numpy as np
+
+
+"""
+
+AHRS module
+
+ジャイロ、加速度、磁気センサの値をMadgwickフィルタで合わせ、姿勢(クォータニオン)と方位(yaw)を求める。
+ジャイロだけを積分するとバイアスで方位がずれていくが、磁気センサで北を、加速度で下を合わせ続けるので、ずれが一定以内に収まる。
+zetaを与えると、合わせた分からジャイロに残っている補正値のずれも推定する(走行中の振動で合わせる方向がばらついても方位が遅れにくい)。
+
+| 座標系は北がx、西がy、上がz(NWU)。yawは北から反時計回りが正[deg]。
+| 1サンプル毎の更新は前のサンプルの姿勢に依存するので並列にはできない。
+| update_block()はブロック全体の単位変換、正規化、サンプル間隔の計算をNumPyでまとめて行い、
+| 各サンプルの更新は4要素の計算になるので、NumPyの配列ではなくPythonのfloatで行う(小さい配列の演算はNumPyの方が遅い)。
+
+"""
+
+
+class MadgwickAhrs:
+    """
+
+    Madgwick AHRS filter
+
+    Examples:
+        >>> ahrs = MadgwickAhrs()
+        >>> ahrs.initialize(accel_mean, magnet)
+        >>> timestamps, accel, gyro = fifo.read_block()
+        >>> ahrs.update_block(timestamps, gyro - gyro_bias, accel, magnet.read())
+        >>> print(ahrs.yaw())
+
+    Attributes:
+        beta (float) : gain of the accelerometer/magnetometer correction (大きいほど早く合わせるが、ジャイロより揺れの影響を受ける)
+        zeta (float) : gain of the gyro bias estimation (0の場合は推定しない)
+        quaternion (tuple of float) : (w, x, y, z) rotating the sensor frame into the earth frame
+        gyro_bias (tuple of float) : estimated residual gyro bias [rad/s]
+
+    """
+
+    # 前回のサンプルから間が空いた場合に使うサンプル間隔の上限[s]
+    MAX_SAMPLE_GAP_SEC = 0.1
+    # 加速度の大きさがこの範囲[g]を外れた場合は、衝突や加減速中として加速度と磁気センサで合わせない
+    ACCEL_VALID_RANGE = (0.8, 1.2)
+
+    def __init__(self, beta=0.1, zeta=0.0):
+        self.beta = beta
+        self.zeta = zeta
+        self.quaternion = (1.0, 0.0, 0.0, 0.0)
+        self.gyro_bias = (0.0, 0.0, 0.0)
+        self._pre_timestamp = None
+
+    def initialize(self, accel, magnet=None):
+        """
+
+        set the attitude directly from a still accelerometer (and magnetometer) measurement
+
+        Args:
+            accel (sequence of float) : mean accelerometer [g]
+            magnet (sequence of float) : magnetometer [uT] (Noneの場合はyawを0とする)
+
+        """
+        up = _normalize(accel)
+        if up is None:
+            return
+        if magnet is not None:
+            west = _normalize(_cross(up, magnet))
+        else:
+            west = None
+        if west is None:
+            # 磁気センサが無い場合はセンサのxを北とする
+            west = _normalize(_cross(up, (1.0, 0.0, 0.0)))
+        north = _cross(west, up)
+        # 各行がセンサ座標で表した北、西、上(センサ座標から地球座標への回転行列)
+        self.quaternion = _quaternionFromMatrix((north, west, up))
+        self._pre_timestamp = None
+
+    def update_block(self, timestamps, gyro, accel, magnet=None):
+        """
+
+        update the attitude with a block of samples
+
+        Args:
+            timestamps (numpy.ndarray) : sample times [s] (N)
+            gyro (numpy.ndarray) : angular rates without bias [deg/s] (N x 3)
+            accel (numpy.ndarray) : accelerations [g] (N x 3)
+            magnet (sequence of float) : latest magnetometer [uT] used for the whole block (Noneの場合は加速度のみで合わせる)
+
+        """
+        count = len(timestamps)
+        if count == 0:
+            return
+        # サンプル間隔(最初のサンプルは前回のブロックの最後からの間隔)
+        pre_timestamp = self._pre_timestamp if self._pre_timestamp is not None else timestamps[0]
+        dts = np.diff(timestamps, prepend=pre_timestamp)
+        dts = np.clip(dts, 0, MadgwickAhrs.MAX_SAMPLE_GAP_SEC)
+        self._pre_timestamp = float(timestamps[-1])
+        gyro = np.radians(gyro)
+        norms = np.linalg.norm(accel, axis=1)
+        valid = (norms > MadgwickAhrs.ACCEL_VALID_RANGE[0]) & (norms < MadgwickAhrs.ACCEL_VALID_RANGE[1])
+        accel = accel / np.where(norms > 0, norms, 1)[:, np.newaxis]
+        magnet = _normalize(magnet) if magnet is not None else None
+
+        q0, q1, q2, q3 = self.quaternion
+        bx, by, bz = self.gyro_bias
+        beta = self.beta
+        zeta = self.zeta
+        for (gx, gy, gz), (ax, ay, az), dt, is_valid in zip(gyro.tolist(), accel.tolist(), dts.tolist(), valid.tolist()):
+            if not is_valid:
+                s0 = s1 = s2 = s3 = 0.0
+            elif magnet is None:
+                s0, s1, s2, s3 = _imuGradient(q0, q1, q2, q3, ax, ay, az)
+            else:
+                s0, s1, s2, s3 = _margGradient(q0, q1, q2, q3, ax, ay, az, magnet[0], magnet[1], magnet[2])
+            if zeta > 0:
+                # 誤差の勾配を角速度に直したものを積分して、ジャイロに残っている補正値のずれとする
+                bx += (q0 * s1 - q1 * s0 - q2 * s3 + q3 * s2) * 2 * zeta * dt
+                by += (q0 * s2 + q1 * s3 - q2 * s0 - q3 * s1) * 2 * zeta * dt
+                bz += (q0 * s3 - q1 * s2 + q2 * s1 - q3 * s0) * 2 * zeta * dt
+                gx -= bx
+                gy -= by
+                gz -= bz
+            # ジャイロで回した分から、加速度、磁気センサとの誤差の勾配方向にbetaだけ戻す
+            q0, q1, q2, q3 = (q0 + (0.5 * (-q1 * gx - q2 * gy - q3 * gz) - beta * s0) * dt,
+                              q1 + (0.5 * (q0 * gx + q2 * gz - q3 * gy) - beta * s1) * dt,
+                              q2 + (0.5 * (q0 * gy - q1 * gz + q3 * gx) - beta * s2) * dt,
+                              q3 + (0.5 * (q0 * gz + q1 * gy - q2 * gx) - beta * s3) * dt)
+            norm = 1.0 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+            q0 *= norm
+            q1 *= norm
+            q2 *= norm
+            q3 *= norm
+        self.quaternion = (q0, q1, q2, q3)
+        self.gyro_bias = (bx, by, bz)
+
+    def yaw(self):
+        """
+
+        Returns:
+            float: heading of the sensor x axis from the north, counterclockwise positive [deg] (-180 ~ 180)
+
+        """
+        q0, q1, q2, q3 = self.quaternion
+        return math.degrees(math.atan2(2 * (q1 * q2 + q0 * q3), 1 - 2 * (q2 * q2 + q3 * q3)))
+
+
+def _normalize(vector):
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm == 0:
+        return None
+    return tuple(value / norm for value in vector)
+
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+
+def _quaternionFromMatrix(m):
+    trace = m[0][0] + m[1][1] + m[2][2]
+    if trace > 0:
+        s = 0.5 / math.sqrt(trace + 1)
+        q = (0.25 / s, (m[2][1] - m[1][2]) * s, (m[0][2] - m[2][0]) * s, (m[1][0] - m[0][1]) * s)
+    elif m[0][0] > m[1][1] and m[0][0] > m[2][2]:
+        s = 2 * math.sqrt(1 + m[0][0] - m[1][1] - m[2][2])
+        q = ((m[2][1] - m[1][2]) / s, 0.25 * s, (m[0][1] + m[1][0]) / s, (m[0][2] + m[2][0]) / s)
+    elif m[1][1] > m[2][2]:
+        s = 2 * math.sqrt(1 + m[1][1] - m[0][0] - m[2][2])
+        q = ((m[0][2] - m[2][0]) / s, (m[0][1] + m[1][0]) / s, 0.25 * s, (m[1][2] + m[2][1]) / s)
+    else:
+        s = 2 * math.sqrt(1 + m[2][2] - m[0][0] - m[1][1])
+        q = ((m[1][0] - m[0][1]) / s, (m[0][2] + m[2][0]) / s, (m[1][2] + m[2][1]) / s, 0.25 * s)
+    return _normalize(q)
+
+
+# 加速度のみの誤差の勾配(正規化済み)
+def _imuGradient(q0, q1, q2, q3, ax, ay, az):
+    _2q0 = 2 * q0
+    _2q1 = 2 * q1
+    _2q2 = 2 * q2
+    _2q3 = 2 * q3
+    _4q0 = 4 * q0
+    _4q1 = 4 * q1
+    _4q2 = 4 * q2
+    _8q1 = 8 * q1
+    _8q2 = 8 * q2
+    q0q0 = q0 * q0
+    q1q1 = q1 * q1
+    q2q2 = q2 * q2
+    q3q3 = q3 * q3
+    s0 = _4q0 * q2q2 + _2q2 * ax + _4q0 * q1q1 - _2q1 * ay
+    s1 = _4q1 * q3q3 - _2q3 * ax + 4 * q0q0 * q1 - _2q0 * ay - _4q1 + _8q1 * q1q1 + _8q1 * q2q2 + _4q1 * az
+    s2 = 4 * q0q0 * q2 + _2q0 * ax + _4q2 * q3q3 - _2q3 * ay - _4q2 + _8q2 * q1q1 + _8q2 * q2q2 + _4q2 * az
+    s3 = 4 * q1q1 * q3 - _2q1 * ax + 4 * q2q2 * q3 - _2q2 * ay
+    return _normalizeGradient(s0, s1, s2, s3)
+
+
+# 加速度と磁気センサの誤差の勾配(正規化済み)
+def _margGradient(q0, q1, q2, q3, ax, ay, az, mx, my, mz):
+    _2q0mx = 2 * q0 * mx
+    _2q0my = 2 * q0 * my
+    _2q0mz = 2 * q0 * mz
+    _2q1mx = 2 * q1 * mx
+    _2q0 = 2 * q0
+    _2q1 = 2 * q1
+    _2q2 = 2 * q2
+    _2q3 = 2 * q3
+    _2q0q2 = 2 * q0 * q2
+    _2q2q3 = 2 * q2 * q3
+    q0q0 = q0 * q0
+    q0q1 = q0 * q1
+    q0q2 = q0 * q2
+    q0q3 = q0 * q3
+    q1q1 = q1 * q1
+    q1q2 = q1 * q2
+    q1q3 = q1 * q3
+    q2q2 = q2 * q2
+    q2q3 = q2 * q3
+    q3q3 = q3 * q3
+    # 地球座標での磁場の向き(水平成分を北、残りを上下とする)
+    hx = mx * q0q0 - _2q0my * q3 + _2q0mz * q2 + mx * q1q1 + _2q1 * my * q2 + _2q1 * mz * q3 - mx * q2q2 - mx * q3q3
+    hy = _2q0mx * q3 + my * q0q0 - _2q0mz * q1 + _2q1mx * q2 - my * q1q1 + my * q2q2 + _2q2 * mz * q3 - my * q3q3
+    _2bx = math.sqrt(hx * hx + hy * hy)
+    _2bz = -_2q0mx * q2 + _2q0my * q1 + mz * q0q0 + _2q1mx * q3 - mz * q1q1 + _2q2 * my * q3 - mz * q2q2 + mz * q3q3
+    _4bx = 2 * _2bx
+    _4bz = 2 * _2bz
+    # 加速度の誤差(fa)、磁気センサの誤差(fm)
+    fa0 = 2 * q1q3 - _2q0q2 - ax
+    fa1 = 2 * q0q1 + _2q2q3 - ay
+    fa2 = 1 - 2 * q1q1 - 2 * q2q2 - az
+    fm0 = _2bx * (0.5 - q2q2 - q3q3) + _2bz * (q1q3 - q0q2) - mx
+    fm1 = _2bx * (q1q2 - q0q3) + _2bz * (q0q1 + q2q3) - my
+    fm2 = _2bx * (q0q2 + q1q3) + _2bz * (0.5 - q1q1 - q2q2) - mz
+    s0 = -_2q2 * fa0 + _2q1 * fa1 - _2bz * q2 * fm0 + (-_2bx * q3 + _2bz * q1) * fm1 + _2bx * q2 * fm2
+    s1 = (_2q3 * fa0 + _2q0 * fa1 - 4 * q1 * fa2 + _2bz * q3 * fm0 + (_2bx * q2 + _2bz * q0) * fm1 +
+          (_2bx * q3 - _4bz * q1) * fm2)
+    s2 = (-_2q0 * fa0 + _2q3 * fa1 - 4 * q2 * fa2 + (-_4bx * q2 - _2bz * q0) * fm0 + (_2bx * q1 + _2bz * q3) * fm1 +
+          (_2bx * q0 - _4bz * q2) * fm2)
+    s3 = _2q1 * fa0 + _2q2 * fa1 + (-_4bx * q3 + _2bz * q1) * fm0 + (-_2bx * q0 + _2bz * q2) * fm1 + _2bx * q1 * fm2
+    return _normalizeGradient(s0, s1, s2, s3)
+
+
+def _normalizeGradient(s0, s1, s2, s3):
+    norm = math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+    if norm == 0:
+        return 0.0, 0.0, 0.0, 0.0
+    return s0 / norm, s1 / norm, s2 / norm, s3 / norm
@@ -0,0 +1,164 @@
+# coding: UTF-8
+
+import argparse
+import math
+import random
+import time
+import numpy as np
+import imu
+from ahrs import MadgwickAhrs
+from imu import Imu
+from imuReplayUnitTest import ReplayClock, ReplayFinished
+from sharedState import createSharedMemory, readImu
+
+"""
+
+test program for ahrs.py
+
+加速度、ジャイロ、磁気センサの合成データ(ジャイロの補正値が少しずつずれていく)を仮想時計の上で再生し、
+ImuのHEADING_GYROとHEADING_AHRSで最終的な角度の誤差を比べる。
+また、MadgwickAhrs.update_block()の1サンプルあたりの処理時間を計測する。
+
+.. code-block:: bash
+
+    python3 ahrsUnitTest.py --duration 120
+
+"""
+
+# 地球座標(北、西、上)での磁場[uT](日本付近、水平30uT、下向き35uT)
+EARTH_MAGNET = (30.0, 0.0, -35.0)
+
+
+def rotateToSensor(yaw_deg, vector):
+    # 水平に置いたセンサがyaw_deg(北から反時計回り)を向いている時の、地球座標のベクトルのセンサ座標での値
+    c = math.cos(math.radians(yaw_deg))
+    s = math.sin(math.radians(yaw_deg))
+    x, y, z = vector
+    return (c * x + s * y, -s * x + c * y, z)
+
+
+def makeMotionTrace(duration, rate_hz=200, start_yaw=40.0, noise=0.3, seed=0):
+    """
+
+    synthesize a trace: 5 s still, then turns and stops repeatedly
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray): timestamps, true yaw [deg], accel [g], gyro [deg/s]
+
+    """
+    rng = random.Random(seed)
+    # (角速度[deg/s], 時間[s])の繰り返し
+    pattern = [(90, 2), (0, 1), (-60, 3), (0, 1), (150, 1), (0, 2)]
+    count = int(duration * rate_hz)
+    timestamps = np.arange(count) / rate_hz
+    yaws = np.zeros(count)
+    accel = np.zeros((count, 3))
+    gyro = np.zeros((count, 3))
+    yaw = start_yaw
+    for i, t in enumerate(timestamps.tolist()):
+        rate = 0
+        if t >= 5:
+            phase = (t - 5) % sum(length for r, length in pattern)
+            for pattern_rate, length in pattern:
+                if phase < length:
+                    rate = pattern_rate
+                    break
+                phase -= length
+        yaw += rate / rate_hz
+        yaws[i] = yaw
+        # 走行中の振動と、温度変化を模したz軸の補正値のずれ(0.8deg/sから1分で2.0deg/sまで)
+        vibration = 0.05 if rate != 0 else 0.005
+        accel[i] = (rng.gauss(0, vibration), rng.gauss(0, vibration), 1 + rng.gauss(0, vibration))
+        gyro[i] = (0.3 + rng.gauss(0, noise), -0.2 + rng.gauss(0, noise), rate + 0.8 + 0.02 * t + rng.gauss(0, noise))
+    return timestamps, yaws, accel, gyro
+
+
+class ReplayFifo:
+    # 合成データを時計に合わせて返す(Mpu9250Fifo.read()、read_block()の代わり)
+    def __init__(self, trace, clock):
+        self._timestamps, yaws, self._accel, self._gyro = trace
+        self._clock = clock
+        self._index = 0
+
+    def read_block(self):
+        end = int(np.searchsorted(self._timestamps, self._clock.now, side='right'))
+        start = self._index
+        self._index = end
+        return self._timestamps[start:end], self._accel[start:end], self._gyro[start:end]
+
+    def read(self):
+        timestamps, accel, gyro = self.read_block()
+        return list(zip(timestamps.tolist(), gyro[:, 2].tolist()))
+
+
+class ReplayMagnet:
+    # 合成データの向きでの磁場を100Hzで返す(Ak8963.read()の代わり)
+    def __init__(self, trace, clock, noise=0.5, seed=0):
+        self._timestamps, self._yaws, accel, gyro = trace
+        self._clock = clock
+        self._rng = random.Random(seed)
+        self._noise = noise
+
+    def read(self):
+        index = max(int(np.searchsorted(self._timestamps, math.floor(self._clock.now * 100) / 100, side='right')) - 1, 0)
+        return tuple(value + self._rng.gauss(0, self._noise)
+                     for value in rotateToSensor(float(self._yaws[index]), EARTH_MAGNET))
+
+
+def replay(trace, backend, jitter_sec, seed=0):
+    timestamps, yaws, accel, gyro = trace
+    clock = ReplayClock(float(timestamps[-1]), jitter_sec, random.Random(seed))
+    fifo = ReplayFifo(trace, clock)
+    original_time = imu.time
+    imu.time = clock
+    try:
+        shmem = createSharedMemory()
+        sensor = Imu(fifo=fifo, mode=Imu.ACQUISITION_FIFO, backend=backend,
+                     magnet=ReplayMagnet(trace, clock))
+        sensor.calibrate()
+        try:
+            sensor.update_loop(shmem)
+        except ReplayFinished:
+            pass
+        sensor.publish(shmem)
+        # 最後に読んだサンプルの向きと比べる(0度は起動時の向き、右回りが正、0.1度単位)
+        index = int(np.searchsorted(timestamps, sensor._pre_sample_time, side='right')) - 1
+        expected = -(float(yaws[index]) - float(yaws[0])) * 10
+        return readImu(shmem), (expected + 1800) % 3600 - 1800
+    finally:
+        imu.time = original_time
+
+
+def measure(trace, block_size):
+    timestamps, yaws, accel, gyro = trace
+    ahrs = MadgwickAhrs()
+    ahrs.initialize(accel[0], rotateToSensor(float(yaws[0]), EARTH_MAGNET))
+    start = time.perf_counter()
+    for i in range(0, len(timestamps), block_size):
+        magnet = rotateToSensor(float(yaws[i]), EARTH_MAGNET)
+        ahrs.update_block(timestamps[i:i + block_size], gyro[i:i + block_size], accel[i:i + block_size], magnet)
+    return (time.perf_counter() - start) / len(timestamps)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare the gyro and AHRS heading backends of Imu')
+    parser.add_argument('--duration', type=float, default=120)
+    parser.add_argument('--jitter', type=float, default=0.02, help='max sleep jitter [s]')
+    args = parser.parse_args()
+
+    trace = makeMotionTrace(args.duration, rate_hz=Imu.AHRS_SAMPLE_RATE_HZ)
+    errors = {}
+    for name, backend in [('GYRO', Imu.HEADING_GYRO), ('AHRS', Imu.HEADING_AHRS)]:
+        snapshot, expected = replay(trace, backend, args.jitter)
+        # ±180度をまたぐ場合も差が小さくなるように丸める
+        errors[name] = abs((snapshot.bodyAngle - expected + 1800) % 3600 - 1800) / 10
+        print(name.ljust(6) + ': bodyAngle = ' + '{:7.1f}'.format(snapshot.bodyAngle / 10) +
+              ', expected = ' + '{:7.1f}'.format(expected / 10) +
+              ', error = ' + '{:6.1f}'.format(errors[name]) + ' [deg]')
+    per_sample = measure(trace, int(Imu.AHRS_SAMPLE_RATE_HZ * Imu.FIFO_READ_INTERVAL_SEC))
+    print('update_block: ' + '{:.1f}'.format(per_sample * 1e6) + ' [us/sample], ' +
+          '{:.1f}'.format(per_sample * Imu.AHRS_SAMPLE_RATE_HZ * 100) + ' [%] of a core at ' +
+          str(Imu.AHRS_SAMPLE_RATE_HZ) + ' [Hz]')
+    assert errors['AHRS'] < 5, errors
+    assert errors['AHRS'] < errors['GYRO'], errors
+    print('ahrs: ok')
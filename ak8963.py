@@ -0,0 +1,181 @@
+# coding: UTF-8
+
+import argparse
+import time
+from debug import DEBUG, TRACE, INFO, WARN
+
+try:
+    import smbus
+except ImportError:
+    # Raspberry Pi以外の環境ではsmbusが無いので、busにfakeSmbus.FakeSMBusを渡して使う
+    smbus = None
+
+
+class Ak8963:
+    """
+
+    AK8963 (magnetometer in the MPU9250) driver class
+
+    MPU9250のI2Cバイパスを有効にして、AK8963を連続測定モード(100Hz、16bit)で読む。
+    read()の値はMPU9250の加速度、ジャイロと同じ軸に並べ替え、OFFSET、SCALEで補正した値。
+
+    | 磁気センサの軸はMPU9250の加速度、ジャイロと違う(x、yが入れ替わり、zが逆向き)
+    | OFFSET(ハードアイアン)とSCALE(ソフトアイアン)はロボットに載せた状態で測る(python3 ak8963.py --calibrate 30)
+
+    Examples:
+        >>> magnet = Ak8963()
+        >>> magnet.start()
+        >>> print(magnet.read())
+        (12.3, -25.1, -38.4)
+
+    Attributes:
+        _address (int) : slave address
+        _bus (smbus.SMBus) : i2c bus, or a compatible one (i2cBus.I2cBusProxy, fakeSmbus.FakeSMBus)
+        overflow_count (int) : number of magnetic sensor overflows (モータなどの近くで飽和した回数)
+
+    """
+
+    # MPU9250のレジスタ
+    MPU9250_REG_INT_PIN_CFG = 0x37
+    MPU9250_BYPASS_EN = 0x02
+    # AK8963のレジスタ
+    REG_ST1 = 0x02
+    REG_HXL = 0x03
+    REG_CNTL1 = 0x0A
+    REG_ASAX = 0x10
+    # レジスタのビット
+    ST1_DRDY = 0x01
+    ST2_HOFL = 0x08
+    # CNTL1のモード
+    MODE_POWER_DOWN = 0x00
+    MODE_FUSE_ROM = 0x0F
+    # 16bit、連続測定モード2(100Hz)
+    MODE_CONTINUOUS_100HZ = 0x16
+    # 16bitの場合の1LSBあたりの磁束密度[uT]
+    SENSITIVITY = 0.15
+
+    # ハードアイアン補正[uT]とソフトアイアン補正(MPU9250の軸の順)
+    OFFSET = (0.0, 0.0, 0.0)
+    SCALE = (1.0, 1.0, 1.0)
+
+    def __init__(self, address=0x0C, bus=None, mpu9250_address=0x68):
+        TRACE('Ak8963 generated: address = ' + str(address))
+        if bus is None:
+            if smbus is None:
+                raise RuntimeError('smbus is not available')
+            bus = smbus.SMBus(1)
+        self._bus = bus
+        self._address = address
+        self._mpu9250_address = mpu9250_address
+        self._adjustment = (1.0, 1.0, 1.0)
+        self._last = None
+        self.overflow_count = 0
+
+    def start(self):
+        bus = self._bus
+        address = self._address
+        # AK8963はMPU9250の内部バスにつながっているので、バイパスを有効にして直接読めるようにする
+        bus.write_byte_data(self._mpu9250_address, Ak8963.MPU9250_REG_INT_PIN_CFG, Ak8963.MPU9250_BYPASS_EN)
+        # 出荷時に書き込まれた感度の補正値を読む
+        bus.write_byte_data(address, Ak8963.REG_CNTL1, Ak8963.MODE_POWER_DOWN)
+        time.sleep(0.01)
+        bus.write_byte_data(address, Ak8963.REG_CNTL1, Ak8963.MODE_FUSE_ROM)
+        time.sleep(0.01)
+        asa = bus.read_i2c_block_data(address, Ak8963.REG_ASAX, 3)
+        self._adjustment = tuple((value - 128) / 256 + 1 for value in asa)
+        bus.write_byte_data(address, Ak8963.REG_CNTL1, Ak8963.MODE_POWER_DOWN)
+        time.sleep(0.01)
+        bus.write_byte_data(address, Ak8963.REG_CNTL1, Ak8963.MODE_CONTINUOUS_100HZ)
+        time.sleep(0.01)
+        INFO('Ak8963 started: adjustment = ' + str(self._adjustment))
+
+    def read_raw(self):
+        """
+
+        read the latest measurement without calibration
+
+        Returns:
+            (float, float, float): magnetic flux density [uT] in the MPU9250 axes, or None if no new data
+
+        Raises:
+            OSError: i2c error
+
+        """
+        if not self._bus.read_byte_data(self._address, Ak8963.REG_ST1) & Ak8963.ST1_DRDY:
+            return None
+        # HXL..HZH(リトルエンディアン)とST2をまとめて読む(ST2を読むと次の測定値に更新される)
+        data = self._bus.read_i2c_block_data(self._address, Ak8963.REG_HXL, 7)
+        if data[6] & Ak8963.ST2_HOFL:
+            self.overflow_count += 1
+            WARN('Ak8963 overflow: count = ' + str(self.overflow_count))
+            return None
+        values = []
+        for i in range(3):
+            value = data[2 * i] | (data[2 * i + 1] << 8)
+            if value >= 0x8000:
+                value -= 0x10000
+            values.append(value * Ak8963.SENSITIVITY * self._adjustment[i])
+        x, y, z = values
+        # AK8963の軸をMPU9250の加速度、ジャイロの軸に合わせる
+        return (y, x, -z)
+
+    def read(self):
+        """
+
+        read the latest calibrated measurement
+
+        Returns:
+            (float, float, float): magnetic flux density [uT] in the MPU9250 axes (新しい値が無い場合は前回の値、一度も読めていない場合はNone)
+
+        Raises:
+            OSError: i2c error
+
+        """
+        raw = self.read_raw()
+        if raw is not None:
+            self._last = tuple((value - offset) * scale for value, offset, scale in zip(raw, Ak8963.OFFSET, Ak8963.SCALE))
+            DEBUG('magnet = ' + str(self._last))
+        return self._last
+
+    def calibrate(self, sec):
+        """
+
+        measure OFFSET and SCALE while the robot is turned around
+
+        Returns:
+            (tuple, tuple): OFFSET, SCALE
+
+        """
+        minimum = [float('inf')] * 3
+        maximum = [float('-inf')] * 3
+        end_time = time.monotonic() + sec
+        while time.monotonic() < end_time:
+            raw = self.read_raw()
+            if raw is not None:
+                minimum = [min(a, b) for a, b in zip(minimum, raw)]
+                maximum = [max(a, b) for a, b in zip(maximum, raw)]
+            time.sleep(0.01)
+        offset = tuple((a + b) / 2 for a, b in zip(minimum, maximum))
+        radius = [(b - a) / 2 for a, b in zip(minimum, maximum)]
+        # 水平に回すだけだとzの幅が小さいので、x、yの平均に合わせる
+        average = (radius[0] + radius[1]) / 2
+        scale = tuple(average / r if r > 0 else 1.0 for r in radius[:2]) + (1.0,)
+        return offset, scale
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='read the AK8963 magnetometer')
+    parser.add_argument('--calibrate', type=float, default=None, help='measure OFFSET and SCALE while turning the robot for this time [s]')
+    args = parser.parse_args()
+
+    magnet = Ak8963()
+    magnet.start()
+    if args.calibrate is not None:
+        print('turn the robot around slowly for ' + str(args.calibrate) + ' [s]')
+        offset, scale = magnet.calibrate(args.calibrate)
+        print('OFFSET = (' + ', '.join('{:.2f}'.format(value) for value in offset) + ')')
+        print('SCALE = (' + ', '.join('{:.3f}'.format(value) for value in scale) + ')')
+    else:
+        while True:
+            print('magnet: ' + str(magnet.read()))
+            time.sleep(0.1)
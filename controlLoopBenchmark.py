@@ -0,0 +1,67 @@
+# coding: UTF-8
+
+import argparse
+import random
+import time
+from multiprocessing import Event, Process
+from controlLoopTimer import ControlLoopTimer
+from latencyStats import LatencyStats
+from sharedState import VisionSnapshot, createSharedMemory, readVision, writeVision
+
+
+"""
+
+benchmark for controlLoopTimer.py
+
+画像処理プロセスの代わりに一定周期(揺らぎあり)で画像処理結果を書き込むプロセスを動かし、
+制御ループが新しい結果を使うまでの時間(vision->motor)と、1秒あたりの制御周期数を
+PERIODICとEVENTの両方式で計測する。
+
+.. code-block:: bash
+
+    python3 controlLoopBenchmark.py --duration 10 --fps 20
+
+"""
+
+
+def visionPublisher(shmem, data_event, duration, fps):
+    end_time = time.monotonic() + duration
+    frame_seq = 0
+    while time.monotonic() < end_time:
+        time.sleep(random.uniform(0.5, 1.5) / fps)
+        frame_seq += 1
+        now = time.monotonic()
+        writeVision(shmem, VisionSnapshot(0, -1, 0, -1, 0, -1, frame_seq, now, now))
+        data_event.set()
+
+
+def run(mode, duration, fps):
+    shmem = createSharedMemory()
+    data_event = Event()
+    publisher = Process(target=visionPublisher, args=(shmem, data_event, duration, fps))
+    publisher.start()
+    timer = ControlLoopTimer(mode, period_sec=0.1, min_period_sec=0.02, data_event=data_event)
+    stats = LatencyStats('vision->motor', max_samples=100000)
+    ticks = 0
+    pre_frame_seq = 0
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        timer.wait()
+        ticks += 1
+        vision = readVision(shmem)
+        if vision.frameSeq != pre_frame_seq and vision.frameSeq != 0:
+            stats.add(time.monotonic() - vision.publishTime)
+            pre_frame_seq = vision.frameSeq
+    publisher.join()
+    return stats, ticks / duration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare PERIODIC and EVENT control loop latency')
+    parser.add_argument('--duration', type=float, default=5, help='duration of each mode [s]')
+    parser.add_argument('--fps', type=float, default=20, help='vision publish rate [Hz]')
+    args = parser.parse_args()
+
+    for name, mode in [('periodic', ControlLoopTimer.PERIODIC), ('event', ControlLoopTimer.EVENT)]:
+        stats, tick_rate = run(mode, args.duration, args.fps)
+        print(name.ljust(8) + ' ticks/s=' + '{:.1f}'.format(tick_rate) + ' ' + stats.format())
@@ -0,0 +1,66 @@
+# coding: UTF-8
+
+import time
+
+
+"""
+
+control loop timer module
+
+制御ループの1周期の待ち方を管理する
+
+"""
+
+
+class ControlLoopTimer:
+    """
+
+    Wait for the next control tick
+
+    PERIODIC : 毎回period_sec待つ(従来方式)
+    EVENT    : 画像処理、IMUが新しい結果を書き込んだ通知(multiprocessing.Event)を待つ。
+    通知が来なくてもperiod_secで必ず起きる(ウォッチドッグ)。通知が連続しても周期はmin_period_sec以上空ける。
+
+    Examples:
+        >>> timer = ControlLoopTimer(ControlLoopTimer.EVENT, period_sec=0.1, data_event=event)
+        >>> while True:
+        >>>     timer.wait()
+        >>>     # 制御処理
+
+    """
+
+    PERIODIC = 0
+    EVENT = 1
+
+    def __init__(self, mode, period_sec=0.1, min_period_sec=0.02, data_event=None):
+        if data_event is None:
+            mode = ControlLoopTimer.PERIODIC
+        self._mode = mode
+        self._period_sec = period_sec
+        self._min_period_sec = min_period_sec
+        self._data_event = data_event
+        self._tick_start_time = time.monotonic()
+
+    def mode(self):
+        return self._mode
+
+    def wait(self):
+        """
+
+        Returns:
+            bool: True if woken by the data event, False if woken by the period
+
+        """
+        is_notified = False
+        if self._mode == ControlLoopTimer.EVENT:
+            elapsed = time.monotonic() - self._tick_start_time
+            if elapsed < self._min_period_sec:
+                time.sleep(self._min_period_sec - elapsed)
+                elapsed = self._min_period_sec
+            is_notified = self._data_event.wait(max(self._period_sec - elapsed, 0))
+            # clear()の後に共有メモリを読むので、clear()とset()が前後しても取りこぼさない
+            self._data_event.clear()
+        else:
+            time.sleep(self._period_sec)
+        self._tick_start_time = time.monotonic()
+        return is_notified
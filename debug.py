@@ -25,9 +25,32 @@ How to use
 | INFO  : 他スレッドとの結合動作において表示したい情報
 | DEBUG : 自スレッドのみの単体デバッグにおいて表示したい情報
 | TRACE : 処理の開始終了や分岐の出入りなど、ルートを確認するための情報
+
+5. 出力の方式(DEBUG_BACKEND)
+
+| ``DEBUG_BACKEND_ASYNC`` : 呼び出したスレッドでは(レベル、time.monotonic()の時刻、書式、引数)をキューに積むだけにし、
+  プロセス毎の書き出しスレッドがDEBUG_FLUSH_INTERVAL_SEC毎にまとめて文字列にして書き出す。
+  ERRORは積んだ後にその場で書き出す。
+| ``DEBUG_BACKEND_SYNC`` : 従来通り呼び出したスレッドでprintする。
+
+6. 引数を作るのに時間がかかる場合
+
+| 書式指定版(ERRORF, WARNF, INFOF, DEBUGF, TRACEF)を使うと、str.format()による文字列の組み立ても書き出しスレッドで行う。
+| 無効なレベルでは引数をそのまま捨てるので、 ``str(x).rjust(8)`` のような組み立ての時間もかからない。
+
+.. code-block:: python
+
+    INFOF('RedSize :{:>8}', size)
 """
 
+import atexit
 import datetime
+import os
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import util
 
 DEBUG_LEVEL_OFF = -1
 DEBUG_LEVEL_ERROR = 0
@@ -40,8 +63,31 @@ DEBUG_LEVEL_ALL = 5
 DEBUG_DISABLE = 0
 DEBUG_ENABLE = 1
 
+DEBUG_BACKEND_SYNC = 0
+DEBUG_BACKEND_ASYNC = 1
+
 # ログ出力のレベルを指定
 DEBUG_LEVEL = DEBUG_LEVEL_INFO
+# ログ出力の方式を指定
+DEBUG_BACKEND = DEBUG_BACKEND_ASYNC
+# 書き出しスレッドがまとめて書き出す間隔[s]
+DEBUG_FLUSH_INTERVAL_SEC = 0.1
+# 書き出し待ちの上限(超えた分は捨てて、捨てた数を後で出力する)
+DEBUG_QUEUE_SIZE = 100000
+
+# 呼び出した時点の値のまま後で文字列にしてよい型(それ以外はキューに積む時にstr()する)
+_DEFERRED_TYPES = frozenset([str, int, float, bool, type(None)])
+
+# 書き出し待ちのレコード(レベル、時刻、書式(Noneなら引数を空白区切り)、引数)
+# deque.append()とpopleft()はスレッド間でロックなしに使える
+_queue = deque()
+_dropped = 0
+_writer = None
+_writer_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wakeup = threading.Event()
+# time.monotonic()から時刻への換算
+_wall_offset = time.time() - time.monotonic()
 
 
 def dummyFunc(level, *args):
@@ -54,11 +100,140 @@ def debugPrint(level, *args):
     print(timestamp + level + ' ' + ' '.join(map(str, args)))
 
 
+def debugPrintFormat(level, fmt, *args):
+    debugPrint(level, fmt.format(*args))
+
+
+def _startWriter():
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            return
+        _writer = threading.Thread(target=_writerLoop, name='debugWriter', daemon=True)
+        _writer.start()
+    # 終了時に残りを書き出す(multiprocessingの子プロセスはatexitを呼ばずに終わるので、Finalizeにも登録する)
+    atexit.register(flush)
+    util.Finalize(None, flush, exitpriority=0)
+
+
+def _writerLoop():
+    while True:
+        _wakeup.wait(DEBUG_FLUSH_INTERVAL_SEC)
+        _wakeup.clear()
+        flush()
+
+
+def _afterFork():
+    # fork先では親のスレッドが動いていないので、キューとロックを作り直して最初の出力時に書き出しスレッドを起動する
+    global _queue, _dropped, _writer, _writer_lock, _flush_lock, _wakeup
+    _queue = deque()
+    _dropped = 0
+    _writer = None
+    _writer_lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _wakeup = threading.Event()
+
+
+os.register_at_fork(after_in_child=_afterFork)
+
+
+def _enqueue(level, fmt, args):
+    global _dropped
+    if _writer is None:
+        _startWriter()
+    if len(_queue) >= DEBUG_QUEUE_SIZE:
+        _dropped += 1
+        return
+    if not _DEFERRED_TYPES.issuperset(map(type, args)):
+        args = [arg if type(arg) in _DEFERRED_TYPES else str(arg) for arg in args]
+    _queue.append((level, time.monotonic(), fmt, args))
+
+
+def asyncPrint(level, *args):
+    _enqueue(level, None, args)
+
+
+def asyncPrintFormat(level, fmt, *args):
+    _enqueue(level, fmt, args)
+
+
+def asyncPrintFlush(level, *args):
+    _enqueue(level, None, args)
+    flush()
+
+
+def asyncPrintFormatFlush(level, fmt, *args):
+    _enqueue(level, fmt, args)
+    flush()
+
+
+def _formatRecord(level, timestamp, fmt, args):
+    now = datetime.datetime.fromtimestamp(timestamp + _wall_offset)
+    if fmt is None:
+        message = ' '.join(map(str, args))
+    else:
+        try:
+            message = fmt.format(*args)
+        except (IndexError, KeyError, ValueError) as e:
+            message = fmt + ' ' + repr(args) + ' (format error: ' + str(e) + ')'
+    return ''.join(['[', now.strftime('%H:%M:%S.%f')[:-3], ']', level, ' ', message])
+
+
+def flush():
+    """
+
+    format and write all queued records (DEBUG_BACKEND_ASYNC)
+
+    """
+    global _dropped
+    with _flush_lock:
+        lines = []
+        while _queue:
+            lines.append(_formatRecord(*_queue.popleft()))
+        if _dropped > 0:
+            lines.append(_formatRecord('[WARN ]', time.monotonic(), None,
+                                       ['debug: dropped ' + str(_dropped) + ' records']))
+            _dropped = 0
+        if lines:
+            lines.append('')
+            sys.stdout.write('\n'.join(lines))
+            sys.stdout.flush()
+
+
 debugFuncList = [dummyFunc, dummyFunc, dummyFunc, dummyFunc, dummyFunc]
+# 書式指定版(ERRORFなど)の出力先
+debugFormatFuncList = [dummyFunc, dummyFunc, dummyFunc, dummyFunc, dummyFunc]
+
+
+# 実行中にログ出力のレベルを変更する(simulator.pyなど、大量のログを抑えたい場合に使う)
+def setDebugLevel(level, backend=None):
+    global DEBUG_LEVEL, DEBUG_BACKEND
+    DEBUG_LEVEL = level
+    if backend is not None:
+        # 溜まっている分を先に書き出してから切り替える
+        flush()
+        DEBUG_BACKEND = backend
+    for i in range(DEBUG_LEVEL_ALL):
+        if level < i:
+            debugFuncList[i] = dummyFunc
+            debugFormatFuncList[i] = dummyFunc
+        elif DEBUG_BACKEND == DEBUG_BACKEND_SYNC:
+            debugFuncList[i] = debugPrint
+            debugFormatFuncList[i] = debugPrintFormat
+        elif i == DEBUG_LEVEL_ERROR:
+            debugFuncList[i] = asyncPrintFlush
+            debugFormatFuncList[i] = asyncPrintFormatFlush
+        else:
+            debugFuncList[i] = asyncPrint
+            debugFormatFuncList[i] = asyncPrintFormat
+
 
-for i in range(DEBUG_LEVEL_ALL):
-    if DEBUG_LEVEL >= i:
-        debugFuncList[i] = debugPrint
+# 指定したレベルのログが出力されるかどうか(出力用に重い計算をする場合に使う)
+def isEnabled(level):
+    return level <= DEBUG_LEVEL
+
+
+setDebugLevel(DEBUG_LEVEL)
 
 
 def ERROR(*args):
@@ -81,9 +256,30 @@ def TRACE(*args):
     debugFuncList[DEBUG_LEVEL_TRACE]('[TRACE]', *args)
 
 
+def ERRORF(fmt, *args):
+    debugFormatFuncList[DEBUG_LEVEL_ERROR]('[ERROR]', fmt, *args)
+
+
+def WARNF(fmt, *args):
+    debugFormatFuncList[DEBUG_LEVEL_WARN]('[WARN ]', fmt, *args)
+
+
+def INFOF(fmt, *args):
+    debugFormatFuncList[DEBUG_LEVEL_INFO]('[INFO ]', fmt, *args)
+
+
+def DEBUGF(fmt, *args):
+    debugFormatFuncList[DEBUG_LEVEL_DEBUG]('[DEBUG]', fmt, *args)
+
+
+def TRACEF(fmt, *args):
+    debugFormatFuncList[DEBUG_LEVEL_TRACE]('[TRACE]', fmt, *args)
+
+
 if __name__ == '__main__':
     ERROR('error test')
     WARN('warn test')
     INFO('info test')
     DEBUG('debug test')
     TRACE('trace test')
+    INFOF('format test: {:>8}, {:.3f}', 123, 0.5)
@@ -0,0 +1,70 @@
+# coding: UTF-8
+
+import argparse
+import os
+import sys
+import time
+import debug
+from debug import INFO, DEBUG, INFOF, DEBUGF
+
+
+"""
+
+benchmark for debug.py
+
+motorContl.pyのcalcAndSendMotorPowers()と同じ形のINFOを、DEBUG_BACKEND_SYNCとDEBUG_BACKEND_ASYNCで出力した場合の呼び出し側の時間を計測する。
+無効なレベル(DEBUG)で、呼び出し側で文字列を組み立てる場合と書式指定版(DEBUGF)を使う場合も比べる。
+出力は/dev/nullに捨てる。
+
+.. code-block:: bash
+
+    python3 debugBenchmark.py --count 100000
+
+"""
+
+
+def logConcat(motor_powers, ball, station, body_angle, func):
+    func('motor r=' + str(motor_powers[0]).rjust(4) + ', l=' + str(motor_powers[1]).rjust(4),
+         ',ball angle, distance=' + str(ball[0]).rjust(4) + ',' + str(ball[1]).rjust(4),
+         ',station angle, distance=' + str(station[0]).rjust(4) + ',' + str(station[1]).rjust(4),
+         ',body angle=' + str(body_angle / 10).rjust(4),
+         )
+
+
+def logFormat(motor_powers, ball, station, body_angle, func):
+    func('motor r={!s:>4}, l={!s:>4} ,ball angle, distance={!s:>4},{!s:>4}'
+         ' ,station angle, distance={!s:>4},{!s:>4} ,body angle={!s:>4}',
+         motor_powers[0], motor_powers[1], ball[0], ball[1], station[0], station[1], body_angle / 10)
+
+
+def measure(count, log, func):
+    start = time.perf_counter()
+    for i in range(count):
+        log((i % 100, -(i % 100)), (i % 90, 30), (-45, 120), i, func)
+    per_call = (time.perf_counter() - start) / count
+    # 書き出しスレッドの分は呼び出し側の時間に含めない
+    debug.flush()
+    return per_call
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measure the caller side overhead of debug prints')
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            for name, backend in [('SYNC', debug.DEBUG_BACKEND_SYNC), ('ASYNC', debug.DEBUG_BACKEND_ASYNC)]:
+                debug.setDebugLevel(debug.DEBUG_LEVEL_INFO, backend)
+                results.append((name + ' INFO', measure(args.count, logConcat, INFO)))
+                results.append((name + ' INFOF', measure(args.count, logFormat, INFOF)))
+            # 無効なレベル
+            results.append(('off DEBUG', measure(args.count, logConcat, DEBUG)))
+            results.append(('off DEBUGF', measure(args.count, logFormat, DEBUGF)))
+        finally:
+            sys.stdout = stdout
+    for name, per_call in results:
+        print(name.ljust(12) + ': ' + '{:.2f}'.format(per_call * 1e6) + ' [us/call]')
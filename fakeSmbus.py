@@ -0,0 +1,86 @@
+# coding: UTF-8
+
+import time
+from collections import defaultdict
+
+
+"""
+
+fake smbus module
+
+smbus.SMBusと同じメソッドを持つメモリ上のレジスタで、I2Cデバイスがない環境でドライバを動かす。
+トランザクションを記録するので、ドライバが何回バスにアクセスしたかを確認できる。
+
+"""
+
+
+class FakeSMBus:
+    """
+
+    In-memory replacement of smbus.SMBus
+
+    Examples:
+        >>> bus = FakeSMBus()
+        >>> motor = MiniMotorDriver(0x65, bus=bus)
+        >>> motor.drive(30)
+        >>> bus.transaction_count(0x65)
+        2
+
+    Attributes:
+        registers (dict) : (address, register) -> value
+        transactions (list) : ('read' or 'write', address, register, value) in order
+        error_addresses (set) : addresses which raise OSError like a disconnected device
+        transaction_time_sec (float) : time taken by one transaction (100kHzで数バイトなら0.0003程度)
+
+    """
+
+    def __init__(self, bus=1, transaction_time_sec=0):
+        self.registers = defaultdict(int)
+        self.transactions = []
+        self.error_addresses = set()
+        self.transaction_time_sec = transaction_time_sec
+
+    def _access(self, kind, addr, reg, value):
+        self.transactions.append((kind, addr, reg, value))
+        if self.transaction_time_sec > 0:
+            time.sleep(self.transaction_time_sec)
+        if addr in self.error_addresses:
+            raise OSError(121, 'Remote I/O error')
+
+    def write_byte(self, addr, value):
+        self._access('write', addr, None, value)
+
+    def read_byte(self, addr):
+        self._access('read', addr, None, None)
+        return 0
+
+    def write_byte_data(self, addr, reg, value):
+        self._access('write', addr, reg, value)
+        self.registers[(addr, reg)] = value & 0xFF
+
+    def read_byte_data(self, addr, reg):
+        self._access('read', addr, reg, None)
+        return self.registers[(addr, reg)]
+
+    def write_i2c_block_data(self, addr, reg, values):
+        self._access('write', addr, reg, list(values))
+        for i, value in enumerate(values):
+            self.registers[(addr, reg + i)] = value & 0xFF
+
+    def read_i2c_block_data(self, addr, reg, length):
+        self._access('read', addr, reg, length)
+        return [self.registers[(addr, reg + i)] for i in range(length)]
+
+    # @brief デバイス側でレジスタの値が変わったことを再現する(フォルトの発生など)
+    def set_register(self, addr, reg, value):
+        self.registers[(addr, reg)] = value & 0xFF
+
+    def transaction_count(self, addr=None, kind=None):
+        return sum(1 for transaction in self.transactions
+                   if (addr is None or transaction[1] == addr) and (kind is None or transaction[0] == kind))
+
+    def clear(self):
+        self.transactions = []
+
+    def close(self):
+        pass
@@ -0,0 +1,238 @@
+# coding: UTF-8
+
+import glob
+import os
+import threading
+import time
+try:
+    import cv2
+except ImportError:
+    # OpenCVが無い環境(simulator.pyのgeometryモードなど)では、フレームの取得元は使用できない
+    cv2 = None
+import numpy as np
+from debug import ERROR, WARN, INFO, DEBUG, TRACE
+
+try:
+    import picamera
+except ImportError:
+    # Raspberry Pi以外の環境ではpicameraが無いので、ファイルからの読み込みのみ使用できる
+    picamera = None
+
+
+"""
+
+frame source module
+
+カメラやファイルから画像を取得し、事前に確保したバッファに格納して画像処理に渡す
+
+"""
+
+
+class FrameSource:
+    """
+
+    Base class of frame sources
+
+    事前に確保したバッファのプールに画像を書き込み、最新の画像をコピーせずに読み出し側へ渡す。
+    読み出されないまま次の画像で上書きされた画像は、取りこぼしとして数える。
+
+    Examples:
+        >>> with FileFrameSource('data/temp') as source:
+        >>>     while True:
+        >>>         captured = source.read()
+        >>>         if captured is None:
+        >>>             break
+        >>>         frame, frame_seq, capture_time = captured
+
+    Attributes:
+        _buffers (list of numpy.ndarray) : preallocated frame buffers
+        _latest (tuple) : (buffer index, frame seq, capture time) of the newest unread frame
+        _in_use (int) : buffer index which the reader is using now
+
+    Note:
+        read()で取得した画像は、次にread()を呼ぶまでの間だけ有効
+
+    """
+
+    def __init__(self, resolution=(480, 480), pool_size=3):
+        # 書き込み中、最新、読み出し中の3つが重ならないように最低3つ必要
+        if pool_size < 3:
+            pool_size = 3
+        width, height = resolution
+        self._resolution = resolution
+        self._buffers = [np.empty((height, width, 3), dtype=np.uint8) for i in range(pool_size)]
+        self._condition = threading.Condition()
+        self._latest = None
+        self._in_use = None
+        self._frame_count = 0
+        self._dropped_frames = 0
+        self._closed = False
+
+    @property
+    def frame_count(self):
+        """int: number of frames written to the buffers"""
+        return self._frame_count
+
+    @property
+    def dropped_frames(self):
+        """int: number of frames overwritten before they were read"""
+        return self._dropped_frames
+
+    def start(self):
+        pass
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, timeout=None):
+        """
+
+        wait for the newest frame
+
+        Args:
+            timeout (float) : timeout [s], wait forever if None
+
+        Returns:
+            tuple: (frame, frame_seq, capture_time), None if timed out or closed.
+            capture_time is time.monotonic() when the frame was written.
+
+        """
+        with self._condition:
+            while self._latest is None and not self._closed:
+                if not self._condition.wait(timeout):
+                    return None
+            if self._latest is None:
+                return None
+            index, frame_seq, capture_time = self._latest
+            self._latest = None
+            self._in_use = index
+        return self._buffers[index], frame_seq, capture_time
+
+    def _acquire_buffer(self):
+        # 読み出し中と最新のバッファ以外から書き込み先を選ぶ
+        with self._condition:
+            for index in range(len(self._buffers)):
+                if index != self._in_use and (self._latest is None or index != self._latest[0]):
+                    return index
+
+    def _publish(self, index, capture_time):
+        with self._condition:
+            if self._latest is not None:
+                self._dropped_frames += 1
+            self._frame_count += 1
+            self._latest = (index, self._frame_count, capture_time)
+            self._condition.notify()
+
+
+class PiCameraFrameSource(FrameSource):
+    """
+
+    Frame source which streams continuously from the Raspberry Pi camera
+
+    カメラをビデオポートで録画状態にし、1フレーム毎に呼ばれるwrite()でバッファに書き込む。
+    PiRGBArrayのように撮影毎にキャプチャを準備し直さない。
+
+    """
+
+    def __init__(self, resolution=(480, 480), pool_size=3, framerate=30):
+        super().__init__(resolution, pool_size)
+        if picamera is None:
+            raise RuntimeError('picamera is not available')
+        self._framerate = framerate
+        self._camera = None
+        # ハードウェアからのデータは幅32、高さ16の倍数に切り上げられている
+        width, height = resolution
+        self._padded_shape = ((height + 15) // 16 * 16, (width + 31) // 32 * 32, 3)
+
+    def start(self):
+        TRACE('PiCameraFrameSource start')
+        self._camera = picamera.PiCamera()
+        self._camera.resolution = self._resolution
+        self._camera.framerate = self._framerate
+        self._camera.start_recording(self, format='bgr')
+
+    def close(self):
+        if self._camera is not None:
+            self._camera.stop_recording()
+            self._camera.close()
+            self._camera = None
+        super().close()
+
+    # picameraから1フレーム毎に呼ばれる
+    def write(self, buf):
+        capture_time = time.monotonic()
+        index = self._acquire_buffer()
+        width, height = self._resolution
+        frame = np.frombuffer(buf, dtype=np.uint8).reshape(self._padded_shape)
+        np.copyto(self._buffers[index], frame[:height, :width])
+        self._publish(index, capture_time)
+
+    def flush(self):
+        pass
+
+
+class FileFrameSource(FrameSource):
+    """
+
+    Frame source which reads image files
+
+    Args:
+        path (str) : directory path or glob pattern of image files
+        loop (bool) : restart from the first file after the last one
+        fps (float) : limit the read rate, as fast as possible if None
+
+    """
+
+    def __init__(self, path, resolution=(480, 480), pool_size=3, loop=False, fps=None):
+        super().__init__(resolution, pool_size)
+        if os.path.isdir(path):
+            path = os.path.join(path, '*.jpg')
+        self._file_list = sorted(glob.glob(path))
+        if len(self._file_list) == 0:
+            WARN('no image files: ' + path)
+        self._next_file_index = 0
+        self._loop = loop
+        self._interval_sec = 1 / fps if fps else 0
+        self._next_read_time = time.monotonic()
+
+    def read(self, timeout=None):
+        if not self._load_next():
+            return None
+        return super().read(timeout)
+
+    def _load_next(self):
+        if self._closed:
+            return False
+        if self._next_file_index >= len(self._file_list):
+            if not self._loop or len(self._file_list) == 0:
+                return False
+            self._next_file_index = 0
+        file_path = self._file_list[self._next_file_index]
+        self._next_file_index += 1
+
+        if self._interval_sec > 0:
+            wait_sec = self._next_read_time - time.monotonic()
+            if wait_sec > 0:
+                time.sleep(wait_sec)
+            self._next_read_time = max(self._next_read_time, time.monotonic() - self._interval_sec) + self._interval_sec
+
+        image = cv2.imread(file_path)
+        if image is None:
+            ERROR('failed to read ' + file_path)
+            return self._load_next()
+        width, height = self._resolution
+        if image.shape[:2] != (height, width):
+            image = cv2.resize(image, (width, height))
+        index = self._acquire_buffer()
+        np.copyto(self._buffers[index], image)
+        self._publish(index, time.monotonic())
+        return True
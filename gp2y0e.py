@@ -1,7 +1,16 @@
 # coding: UTF-8
 
-import smbus
-from debug import DEBUG, TRACE, INFO
+import threading
+import time
+from collections import deque, namedtuple
+from debug import DEBUG, TRACE, INFO, WARN
+from sensorLog import openWriter
+
+try:
+    import smbus
+except ImportError:
+    # Raspberry Pi以外の環境ではsmbusが無いので、busにfakeSmbus.FakeSMBusを渡して使う
+    smbus = None
 
 
 class Gp2y0e:
@@ -18,13 +27,17 @@ class Gp2y0e:
     
     Attributes:
         _address (int) : slave address
-        _bus (smbus.SMBus) : i2c bus
+        _bus (smbus.SMBus) : i2c bus, or a compatible one (i2cBus.I2cBusProxy, fakeSmbus.FakeSMBus)
     
     """
 
-    def __init__(self, address):
+    def __init__(self, address, bus=None):
         TRACE('Gp2y0e generated: address = ' + str(address))
-        self._bus = smbus.SMBus(1)
+        if bus is None:
+            if smbus is None:
+                raise RuntimeError('smbus is not available')
+            bus = smbus.SMBus(1)
+        self._bus = bus
         self._address = address
     
     def read(self):
@@ -37,10 +50,129 @@ class Gp2y0e:
         
         """
         try:
-            data = self._bus.read_i2c_block_data(self._address, 0x5E, 2)
+            distance = self.read_raw()
         except:
             return 100
-        distance = (data[0] << 4) | data[1]
-        distance = distance / 64
         DEBUG('distance = ' + str(distance) + ' [cm]')
         return distance
+
+    def read_raw(self):
+        """
+
+        read distance value without hiding bus errors
+
+        Returns:
+            float: distance value [cm]
+
+        Raises:
+            OSError: i2c error
+
+        """
+        data = self._bus.read_i2c_block_data(self._address, 0x5E, 2)
+        distance = (data[0] << 4) | data[1]
+        return distance / 64
+
+
+# 距離センサのサンプル
+# distanceは直近のサンプルの中央値、timestampは最後に読めた時刻(time.monotonic())、errorCountは累計の読み出し失敗回数
+DistanceSample = namedtuple('DistanceSample', ['distance', 'timestamp', 'errorCount'])
+
+
+class Gp2y0eSampler:
+    """
+
+    Poll GP2Y0E in the background and cache the filtered distance
+
+    バックグラウンドのスレッドで一定周期で距離を読み、直近window個の中央値を公開する。
+    read()はバスにアクセスせずに最新の値を返すので、Gp2y0eの代わりに使える。
+
+    Examples:
+        >>> sampler = Gp2y0eSampler(Gp2y0e(0x40))
+        >>> # 使うプロセスの中で開始する
+        >>> sampler.start()
+        >>> sampler.read()
+        10.7
+
+    Attributes:
+        _samples (collections.deque) : latest valid distances (ring buffer)
+        _latest (DistanceSample) : published sample, replaced as a whole
+
+    """
+
+    # 読めなかった場合、古すぎる場合に返す距離(Gp2y0e.read()と同じ)
+    DISTANCE_INVALID = 100
+
+    def __init__(self, sensor, rate_hz=50, window=5, max_age_sec=0.2):
+        self._sensor = sensor
+        self._interval_sec = 1 / rate_hz
+        self._samples = deque(maxlen=window)
+        self._max_age_sec = max_age_sec
+        self._latest = DistanceSample(Gp2y0eSampler.DISTANCE_INVALID, 0, 0)
+        self._error_count = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._sensor_log = None
+
+    def start(self):
+        TRACE('Gp2y0eSampler start')
+        # 読んだ距離の記録(sensorLogのセッションを開始している場合のみ)
+        self._sensor_log = openWriter('distance')
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            raw = None
+            try:
+                raw = self._sensor.read_raw()
+                self._samples.append(raw)
+                timestamp = time.monotonic()
+            except Exception as e:
+                self._error_count += 1
+                if self._error_count % 100 == 1:
+                    WARN('Gp2y0eSampler read error: ' + str(e) + ', count = ' + str(self._error_count))
+                timestamp = self._latest.timestamp
+            if len(self._samples) > 0:
+                distance = sorted(self._samples)[len(self._samples) // 2]
+            else:
+                distance = Gp2y0eSampler.DISTANCE_INVALID
+            # タプルごと差し替えるので、読み出し側は値と時刻の組を一貫して読める
+            self._latest = DistanceSample(distance, timestamp, self._error_count)
+            if self._sensor_log is not None:
+                self._sensor_log.writeDistance(time.monotonic(), raw, distance, self._error_count)
+            self._stop_event.wait(self._interval_sec)
+
+    def latest(self):
+        """
+
+        Returns:
+            DistanceSample: latest filtered distance with its timestamp and error count
+
+        """
+        return self._latest
+
+    def read(self):
+        """
+
+        Returns:
+            float: filtered distance [cm], DISTANCE_INVALID if no fresh sample
+
+        """
+        sample = self._latest
+        if time.monotonic() - sample.timestamp > self._max_age_sec:
+            return Gp2y0eSampler.DISTANCE_INVALID
+        return sample.distance
+
+    # @brief 状態を文字列にする(ログ用)
+    def format(self):
+        sample = self._latest
+        return 'distance sampler: distance = ' + str(sample.distance) + \
+            ', age = ' + str(int((time.monotonic() - sample.timestamp) * 1000)) + ' [ms]' + \
+            ', errors = ' + str(sample.errorCount)
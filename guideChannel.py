@@ -0,0 +1,178 @@
+# coding: UTF-8
+
+import json
+import mmap
+import os
+import tempfile
+import time
+from collections import namedtuple
+from ctypes import Structure, c_bool, c_double, c_uint, sizeof
+from sharedState import seqlockRead, seqlockWrite
+from debug import ERROR, DEBUG
+
+
+"""
+
+guide channel module
+
+センターカメラからwebsocketで届いたステーションへの誘導情報(degree, distance, wait)を
+socketServer.pyのプロセスからモータ制御プロセスへ渡す。
+
+socketServer.pyはmain.pyとは別に起動するので、名前付きの共有メモリ(/dev/shm上のファイルをmmapしたもの)を使う。
+書き込みはseqlockで行い、書き込む毎にversionを1増やす。読み出し側はversionが変わった時だけ読み直す。
+共有メモリに一度も書き込まれていない場合は、互換のためにguide_info.jsonを読む(更新時刻が変わった時だけ)。
+
+"""
+
+
+GUIDE_CHANNEL_NAME = 'collect_ball_guide'
+GUIDE_FILE_PATH = './guide_info.json'
+# 誘導情報がない時のdegree
+GUIDE_DEGREE_NONE = 360
+
+
+# 共有メモリ上の誘導情報
+class GuideRecord(Structure):
+    _fields_ = [('seq', c_uint), ('version', c_uint),
+                ('degree', c_double), ('distance', c_double), ('wait', c_bool),
+                # 書き込み時刻(time.monotonic())
+                ('publishTime', c_double)]
+
+
+# 誘導情報のスナップショット
+# versionが0の場合はまだ一度も書き込まれていない
+GuideInfo = namedtuple('GuideInfo', ['degree', 'distance', 'wait', 'version', 'publishTime'])
+GUIDE_NONE = GuideInfo(degree=GUIDE_DEGREE_NONE, distance=-1, wait=False, version=0, publishTime=0)
+
+_GUIDE_FIELD_NAMES = ['degree', 'distance', 'wait', 'version', 'publishTime']
+
+
+def defaultChannelPath():
+    # /dev/shmがない環境では一時ディレクトリに置く
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, GUIDE_CHANNEL_NAME)
+
+
+class GuideChannel:
+    """
+
+    Named shared memory record of the guide info
+
+    書き込めるのは1プロセスのみ(socketServer.py)。読み出しは何プロセスからでもよい。
+
+    Examples:
+        >>> channel = GuideChannel()
+        >>> # socketServer.py
+        >>> channel.publish(degree, distance, wait)
+        >>> # 読み出し側
+        >>> guide = channel.read()
+
+    """
+
+    def __init__(self, path=None):
+        self._path = path if path is not None else defaultChannelPath()
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            # 先に起動した方がサイズを確保する。中身は0(version = 0)で初期化される
+            if os.fstat(fd).st_size < sizeof(GuideRecord):
+                os.ftruncate(fd, sizeof(GuideRecord))
+            self._mmap = mmap.mmap(fd, sizeof(GuideRecord))
+        finally:
+            os.close(fd)
+        self._record = GuideRecord.from_buffer(self._mmap)
+
+    def publish(self, degree, distance, wait):
+        record = self._record
+        seqlockWrite(record, 'seq', [('degree', degree), ('distance', distance), ('wait', wait),
+                                     ('version', record.version + 1), ('publishTime', time.monotonic())])
+
+    def version(self):
+        return self._record.version
+
+    def read(self):
+        """
+
+        Returns:
+            GuideInfo: consistent guide info
+
+        """
+        return GuideInfo(*seqlockRead(self._record, 'seq', _GUIDE_FIELD_NAMES))
+
+    def close(self):
+        # mmapを閉じる前に参照を外す
+        self._record = None
+        self._mmap.close()
+
+
+class GuideReader:
+    """
+
+    Read the latest guide info without re-reading unchanged data
+
+    共有メモリのversionが変わった時だけ読み直す。
+    共有メモリに一度も書き込まれていない場合はguide_info.jsonを更新時刻が変わった時だけ読み直す。
+
+    Examples:
+        >>> guideReader = GuideReader()
+        >>> guide = guideReader.read()
+        >>> if guide.degree != GUIDE_DEGREE_NONE:
+        >>>     ...
+
+    """
+
+    def __init__(self, channel=None, file_path=GUIDE_FILE_PATH):
+        self._channel = channel if channel is not None else GuideChannel()
+        self._file_path = file_path
+        self._guide = GUIDE_NONE
+        self._file_mtime = None
+        self._file_guide = GUIDE_NONE
+
+    def read(self):
+        """
+
+        Returns:
+            GuideInfo: latest guide info, GUIDE_NONE if nothing has been received
+
+        """
+        version = self._channel.version()
+        if version != 0:
+            if version != self._guide.version:
+                self._guide = self._channel.read()
+                DEBUG('guide updated: version =', self._guide.version)
+            return self._guide
+        return self.readFile()
+
+    def readFile(self):
+        try:
+            mtime = os.stat(self._file_path).st_mtime_ns
+        except FileNotFoundError:
+            return GUIDE_NONE
+        if mtime == self._file_mtime:
+            return self._file_guide
+        try:
+            with open(self._file_path, mode='r') as f:
+                guide_info_json = json.load(f)
+        except json.JSONDecodeError:
+            # 書き込み途中の可能性があるので、更新時刻は記録せず次回読み直す
+            ERROR('faild to load ' + self._file_path)
+            return self._file_guide
+        self._file_mtime = mtime
+        self._file_guide = GuideInfo(degree=guide_info_json.get('degree', GUIDE_DEGREE_NONE),
+                                     distance=guide_info_json.get('distance', -1),
+                                     wait=guide_info_json.get('wait', False),
+                                     version=0, publishTime=0)
+        return self._file_guide
+
+
+def writeGuideFile(message, file_path=GUIDE_FILE_PATH):
+    """
+
+    write the guide message to the file atomically
+
+    一時ファイルに書いてから置き換えるので、読み出し側が書き込み途中のファイルを読むことはない
+
+    """
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, mode='w') as f:
+        f.write(message)
+    os.replace(tmp_path, file_path)
@@ -0,0 +1,343 @@
+# coding: UTF-8
+
+import itertools
+import os
+import queue
+import threading
+import time
+from latencyStats import LatencyStats
+from debug import ERROR, WARN, INFO, DEBUG, TRACE
+
+try:
+    import smbus
+except ImportError:
+    # Raspberry Pi以外の環境ではsmbusが無いので、busにfakeSmbus.FakeSMBusを渡して使う
+    smbus = None
+
+
+"""
+
+i2c bus scheduler module
+
+モータ制御プロセス内のI2Cデバイス(モータドライバ、サーボ、距離センサ)のバスアクセスを1つのスレッドにまとめ、
+優先度順に実行する。
+
+.. code-block:: none
+
+    MiniMotorDriver --(PRIORITY_MOTOR)--+
+    Gp2y0e ---------(PRIORITY_SENSOR)---+--> request queue --> bus thread --> smbus.SMBus(1)
+    Servo ----------(PRIORITY_SERVO)----+
+
+各ドライバにはsmbus.SMBusの代わりにdevice()で取得したプロキシを渡す。
+ServoはAdafruit_PCA9685を使うので、adafruitI2c()で取得したAdafruit_GPIO.I2C互換のモジュールを渡す。
+サーボは初期化(set_pwm_freqのスリープ切り替え)が終わった後にset_wait_writes(False)で書き込みを待たないようにし、
+溜まった上げ下げのステップ書き込みは同じレジスタの最後の1つだけ実行する。
+
+"""
+
+
+# 優先度(小さいほど先に実行する)
+PRIORITY_MOTOR = 0
+PRIORITY_SENSOR = 1
+PRIORITY_SERVO = 2
+
+
+class _Request:
+    def __init__(self, method, addr, args, wait):
+        self.method = method
+        self.addr = addr
+        self.args = args
+        self.wait = wait
+        self.enqueue_time = time.monotonic()
+        self.done = threading.Event() if wait else None
+        self.result = None
+        self.error = None
+
+    # 待たない書き込みは、同じレジスタへの後の書き込みがあれば省略できる
+    def coalesce_key(self):
+        if self.wait or not self.method.startswith('write'):
+            return None
+        return self.addr, self.method, self.args[0]
+
+
+class DeviceStats:
+    """
+
+    Bus access statistics of one device
+
+    """
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.transaction_count = 0
+        self.error_count = 0
+        self.coalesced_count = 0
+        self.wait_stats = LatencyStats(hex(addr) + ' wait')
+        self.exec_stats = LatencyStats(hex(addr) + ' exec')
+
+    def format(self):
+        return 'i2c ' + hex(self.addr) + ': transactions = ' + str(self.transaction_count) + \
+            ', errors = ' + str(self.error_count) + ', coalesced = ' + str(self.coalesced_count) + \
+            ', ' + self.wait_stats.format() + ', ' + self.exec_stats.format()
+
+    def clear(self):
+        self.wait_stats.clear()
+        self.exec_stats.clear()
+
+
+class I2cBusScheduler:
+    """
+
+    Single owner of an I2C bus executing prioritized transactions
+
+    バススレッドはキューに溜まっている要求をまとめて取り出し(最大batch_size個)、優先度順に続けて実行する。
+    まとめて取り出した中に、待たない書き込みが同じレジスタに複数ある場合は最後の1つだけ実行する。
+    バススレッドは最初の要求で起動する。fork後のプロセスで使われた場合は、そのプロセスで起動し直す。
+
+    Examples:
+        >>> i2cBus = I2cBusScheduler()
+        >>> left_motor = MiniMotorDriver(0x65, bus=i2cBus.device(PRIORITY_MOTOR))
+        >>> sensor = Gp2y0e(0x40, bus=i2cBus.device(PRIORITY_SENSOR))
+        >>> servo = Servo(0x41, i2c=i2cBus.adafruitI2c(PRIORITY_SERVO))
+
+    Attributes:
+        _bus : smbus.SMBus or fakeSmbus.FakeSMBus, accessed only by the bus thread
+        _stats (dict) : address -> DeviceStats
+
+    """
+
+    def __init__(self, bus=None, batch_size=8):
+        if bus is None:
+            if smbus is None:
+                raise RuntimeError('smbus is not available')
+            bus = smbus.SMBus(1)
+        self._bus = bus
+        self._batch_size = batch_size
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._counter = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            TRACE('I2cBusScheduler thread start: pid = ' + str(os.getpid()))
+            self._queue = queue.PriorityQueue()
+            self._counter = itertools.count()
+            self._stats_lock = threading.Lock()
+            thread = threading.Thread(target=self._loop)
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, priority, method, addr, args, wait=True):
+        """
+
+        request a transaction
+
+        Args:
+            priority (int) : PRIORITY_MOTOR, PRIORITY_SENSOR or PRIORITY_SERVO
+            method (str) : smbus.SMBus method name
+            addr (int) : slave address
+            args (tuple) : arguments after the address
+            wait (bool) : wait for the result. exceptions are raised to the caller only if True
+
+        Returns:
+            result of the method if wait is True
+
+        """
+        self._ensure_started()
+        request = _Request(method, addr, args, wait)
+        self._queue.put((priority, next(self._counter), request))
+        if not wait:
+            return None
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _take_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        batch.sort(key=lambda item: item[:2])
+        # 後から来た同じレジスタへの書き込みがある要求を省く
+        latest = {}
+        for index, (priority, count, request) in enumerate(batch):
+            key = request.coalesce_key()
+            if key is not None:
+                latest[key] = index
+        requests = []
+        for index, (priority, count, request) in enumerate(batch):
+            key = request.coalesce_key()
+            if key is not None and latest[key] != index:
+                with self._stats_lock:
+                    self._device_stats(request.addr).coalesced_count += 1
+                continue
+            requests.append(request)
+        return requests
+
+    def _device_stats(self, addr):
+        stats = self._stats.get(addr)
+        if stats is None:
+            stats = DeviceStats(addr)
+            self._stats[addr] = stats
+        return stats
+
+    def _loop(self):
+        while True:
+            requests = self._take_batch()
+            for request in requests:
+                start_time = time.monotonic()
+                try:
+                    request.result = getattr(self._bus, request.method)(request.addr, *request.args)
+                except Exception as e:
+                    request.error = e
+                end_time = time.monotonic()
+                with self._stats_lock:
+                    stats = self._device_stats(request.addr)
+                    stats.transaction_count += 1
+                    stats.wait_stats.add(start_time - request.enqueue_time)
+                    stats.exec_stats.add(end_time - start_time)
+                    if request.error is not None:
+                        stats.error_count += 1
+                if request.wait:
+                    request.done.set()
+                elif request.error is not None:
+                    ERROR('i2c ' + hex(request.addr) + ' ' + request.method + ' failed: ' + str(request.error))
+
+    def device(self, priority, wait_writes=True):
+        """
+
+        Args:
+            priority (int) : PRIORITY_MOTOR, PRIORITY_SENSOR or PRIORITY_SERVO
+            wait_writes (bool) : wait for the completion of writes
+
+        Returns:
+            I2cBusProxy: smbus.SMBus compatible proxy submitting with the priority
+
+        """
+        return I2cBusProxy(self, priority, wait_writes)
+
+    def adafruitI2c(self, priority, wait_writes=True):
+        """
+
+        Args:
+            priority (int) : PRIORITY_MOTOR, PRIORITY_SENSOR or PRIORITY_SERVO
+            wait_writes (bool) : wait for the completion of writes
+
+        Returns:
+            AdafruitI2cAdapter: Adafruit_GPIO.I2C compatible module for Adafruit_PCA9685.PCA9685(i2c=...)
+
+        """
+        return AdafruitI2cAdapter(self, priority, wait_writes)
+
+    def format(self):
+        """
+
+        Returns:
+            list of str: statistics of each device, cleared after formatting
+
+        """
+        with self._stats_lock:
+            lines = []
+            for addr in sorted(self._stats):
+                lines.append(self._stats[addr].format())
+                self._stats[addr].clear()
+            return lines
+
+
+class I2cBusProxy:
+    """
+
+    smbus.SMBus compatible proxy of I2cBusScheduler
+
+    wait_writes=Falseの場合は書き込みの完了を待たない(エラーはバススレッドでログに出す)
+
+    """
+
+    def __init__(self, scheduler, priority, wait_writes=True):
+        self._scheduler = scheduler
+        self._priority = priority
+        self._wait_writes = wait_writes
+
+    def set_wait_writes(self, wait_writes):
+        self._wait_writes = wait_writes
+
+    def write_byte_data(self, addr, reg, value):
+        self._scheduler.submit(self._priority, 'write_byte_data', addr, (reg, value), self._wait_writes)
+
+    def read_byte_data(self, addr, reg):
+        return self._scheduler.submit(self._priority, 'read_byte_data', addr, (reg,))
+
+    def write_byte(self, addr, value):
+        self._scheduler.submit(self._priority, 'write_byte', addr, (value,), self._wait_writes)
+
+    def read_byte(self, addr):
+        return self._scheduler.submit(self._priority, 'read_byte', addr, ())
+
+    def write_i2c_block_data(self, addr, reg, values):
+        self._scheduler.submit(self._priority, 'write_i2c_block_data', addr, (reg, list(values)), self._wait_writes)
+
+    def read_i2c_block_data(self, addr, reg, length):
+        return self._scheduler.submit(self._priority, 'read_i2c_block_data', addr, (reg, length))
+
+
+class AdafruitI2cDevice:
+    """
+
+    Adafruit_GPIO.I2C.Device compatible device on I2cBusProxy
+
+    """
+
+    def __init__(self, address, bus):
+        self._address = address
+        self._bus = bus
+
+    def writeRaw8(self, value):
+        self._bus.write_byte(self._address, value & 0xFF)
+
+    def write8(self, register, value):
+        self._bus.write_byte_data(self._address, register, value & 0xFF)
+
+    def writeList(self, register, data):
+        self._bus.write_i2c_block_data(self._address, register, data)
+
+    def readRaw8(self):
+        return self._bus.read_byte(self._address) & 0xFF
+
+    def readU8(self, register):
+        return self._bus.read_byte_data(self._address, register) & 0xFF
+
+    def readS8(self, register):
+        result = self.readU8(register)
+        return result - 256 if result > 127 else result
+
+    def readList(self, register, length):
+        return self._bus.read_i2c_block_data(self._address, register, length)
+
+
+class AdafruitI2cAdapter:
+    """
+
+    Adafruit_GPIO.I2C compatible module passed as the i2c argument of Adafruit drivers
+
+    """
+
+    def __init__(self, scheduler, priority, wait_writes=True):
+        self._bus = I2cBusProxy(scheduler, priority, wait_writes)
+
+    # 初期化が終わった後に書き込みを待たないようにする(待たない書き込みは同じレジスタの後の書き込みで省略される)
+    def set_wait_writes(self, wait_writes):
+        self._bus.set_wait_writes(wait_writes)
+
+    def get_i2c_device(self, address, busnum=None, i2c_interface=None, **kwargs):
+        return AdafruitI2cDevice(address, self._bus)
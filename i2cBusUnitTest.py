@@ -0,0 +1,112 @@
+# coding: UTF-8
+
+import threading
+import time
+from fakeSmbus import FakeSMBus
+from gp2y0e import Gp2y0e
+from i2cBus import I2cBusScheduler, I2cBusProxy, PRIORITY_MOTOR, PRIORITY_SENSOR, PRIORITY_SERVO
+from miniMotorDriver import MiniMotorDriver
+
+"""
+
+test program for i2c bus scheduler
+
+FakeSMBus(1トランザクション1ms)の上で、モータ制御、距離センサ、サーボの3スレッドが同時にバスを使い、
+デバイス毎の待ち時間を表示する。サーボのステップ書き込みが溜まっていても、モータの待ち時間は短いままになる。
+続けて、優先度順の実行と、待たない書き込みの省略(adafruitI2c()でサーボを初期化した後のset_wait_writes(False)を含む)を確認する。
+
+"""
+
+
+def motorLoop(motor, duration):
+    end_time = time.monotonic() + duration
+    speed = 0
+    while time.monotonic() < end_time:
+        speed = (speed + 7) % 60
+        motor.drive(speed)
+        time.sleep(0.02)
+
+
+def sensorLoop(sensor, duration):
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        sensor.read()
+        time.sleep(0.01)
+
+
+def servoLoop(servo_bus, duration):
+    end_time = time.monotonic() + duration
+    pulse = 0
+    while time.monotonic() < end_time:
+        # 書き込みを待たずに溜める(PCA9685のLED0_OFF_L)
+        for i in range(10):
+            pulse = (pulse + 1) & 0xFF
+            servo_bus.write_byte_data(0x41, 0x08, pulse)
+        time.sleep(0.005)
+
+
+if __name__ == '__main__':
+    bus = FakeSMBus(transaction_time_sec=0.001)
+    i2cBus = I2cBusScheduler(bus)
+    motor = MiniMotorDriver(0x65, bus=i2cBus.device(PRIORITY_MOTOR), write_mode=MiniMotorDriver.WRITE_THROUGH)
+    sensor = Gp2y0e(0x40, bus=i2cBus.device(PRIORITY_SENSOR))
+    servo_bus = I2cBusProxy(i2cBus, PRIORITY_SERVO, wait_writes=False)
+
+    duration = 3
+    threads = [threading.Thread(target=motorLoop, args=(motor, duration)),
+               threading.Thread(target=sensorLoop, args=(sensor, duration)),
+               threading.Thread(target=servoLoop, args=(servo_bus, duration))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    time.sleep(0.5)
+    for line in i2cBus.format():
+        print(line)
+
+    # 1つのバッチの中では優先度順に実行し、待たない書き込みは同じレジスタの最後の1つだけ実行する
+    bus = FakeSMBus()
+    i2cBus = I2cBusScheduler(bus)
+    gate = threading.Event()
+    i2cBus.submit(PRIORITY_SERVO, 'write_byte_data', 0x41, (0x08, 0), wait=False)
+    time.sleep(0.1)
+    bus.clear()
+    # バススレッドを止めている間に要求を溜める
+    bus.write_byte = lambda addr, value: gate.wait()
+    i2cBus.submit(PRIORITY_SERVO, 'write_byte', 0x41, (0,), wait=False)
+    time.sleep(0.1)
+    for value in [1, 2, 3]:
+        i2cBus.submit(PRIORITY_SERVO, 'write_byte_data', 0x41, (0x08, value), wait=False)
+    i2cBus.submit(PRIORITY_SENSOR, 'read_i2c_block_data', 0x40, (0x5E, 2), wait=False)
+    i2cBus.submit(PRIORITY_MOTOR, 'write_byte_data', 0x65, (0x00, 0x7A), wait=False)
+    gate.set()
+    time.sleep(0.1)
+    assert bus.transactions == [('write', 0x65, 0x00, 0x7A),
+                                ('read', 0x40, 0x5E, 2),
+                                ('write', 0x41, 0x08, 3)], bus.transactions
+    print('priority and coalescing: ok')
+
+    # サーボと同じく、初期化は1つずつ待って書き込み、set_wait_writes(False)の後のステップ書き込みは最後の1つだけ実行する
+    bus = FakeSMBus()
+    i2cBus = I2cBusScheduler(bus)
+    adapter = i2cBus.adafruitI2c(PRIORITY_SERVO)
+    servo_device = adapter.get_i2c_device(0x41)
+    # PCA9685のMODE1(スリープ)、PRESCALE、MODE1(復帰)は省略されない
+    for register, value in [(0x00, 0x10), (0xFE, 101), (0x00, 0x00)]:
+        servo_device.write8(register, value)
+    assert bus.transactions == [('write', 0x41, 0x00, 0x10), ('write', 0x41, 0xFE, 101), ('write', 0x41, 0x00, 0x00)], \
+        bus.transactions
+    bus.clear()
+    adapter.set_wait_writes(False)
+    gate = threading.Event()
+    bus.write_byte = lambda addr, value: gate.wait()
+    servo_device.writeRaw8(0)
+    time.sleep(0.1)
+    # LED0_OFF_L, LED0_OFF_Hへのステップ書き込み
+    for pulse in [300, 340, 390]:
+        servo_device.write8(0x08, pulse & 0xFF)
+        servo_device.write8(0x09, pulse >> 8)
+    gate.set()
+    time.sleep(0.1)
+    assert bus.transactions == [('write', 0x41, 0x08, 390 & 0xFF), ('write', 0x41, 0x09, 390 >> 8)], bus.transactions
+    print('servo adapter: ok')
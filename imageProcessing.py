@@ -1,23 +1,36 @@
 # coding: UTF-8
 
 from enum import IntEnum
-from debug import ERROR, WARN, INFO, DEBUG, TRACE
+from debug import ERROR, WARN, INFO, DEBUG, TRACE, INFOF, DEBUGF
 
-import cv2
+try:
+    import cv2
+except ImportError:
+    # OpenCVが無い環境(simulator.pyのgeometryモードなど)では、画像を扱わないdecideTargets()などのみ使用できる
+    cv2 = None
 import numpy as np
-import picamera
-import picamera.array
 import os
+import time
+from frameSource import PiCameraFrameSource
+from visionPipeline import VisionPipeline
+from visionTracker import VisionTracker
+from sharedState import VisionSnapshot, writeVision
+from sensorLog import openWriter
+from spanTrace import span, traced, setProcessName
 from sound import SoundPhaseE
 
 from math import atan2, degrees, hypot
 
 
 class ImageProcessing:
-    # 画像出力の有効無効
+    # 有効無効
     ENABLE = 1
     DISABLE = 0
-    DEBUG_IMSHOW = DISABLE
+    # プレビュー配信(previewStreamer.py)の有効無効
+    # 有効な場合、最新の画像と検知結果をPREVIEW_MAX_FPSに間引いて共有メモリに書き込む
+    # 描画とマスク画像の生成はプレビュー配信プロセスで行う
+    DEBUG_PREVIEW = DISABLE
+    PREVIEW_MAX_FPS = 5
 
     # マスクパラメータはあんまり厳しくしすぎると、本番で認識しないという事態になりそうで怖い
     RED_HSV_RANGE_MIN_1 = [0, 130, 80]
@@ -42,17 +55,106 @@ class ImageProcessing:
     IGNORE_AREA_SIZE_GREEN = 1000
     IGNORE_AREA_SIZE_WALL = 90000
 
+    # 色領域の切り出し方式
+    # SEPARATE : 色ごとにcv2.inRangeで二値化する(従来方式)
+    # FUSED    : 全画素の色ラベルを一度の走査で求め、そこから色ごとの領域を取り出す
+    # data/tempの画像ではFUSEDの方が遅かったのでSEPARATEを使う(計測結果はimageProcessingBenchmark.pyを参照)
+    SEGMENTATION_SEPARATE = 0
+    SEGMENTATION_FUSED = 1
+    SEGMENTATION_MODE = SEGMENTATION_SEPARATE
+
+    # ピラミッド検知の縮小率(色ごとに指定する、1の場合は元の解像度のまま検知する)
+    # 縮小画像で候補領域を探し、その周辺だけ元の解像度で再検知する
+    # 計測結果はimageProcessingBenchmark.pyを参照(4でdata/tempの検知結果は縮小なしと一致する)
+    PYRAMID_SCALE = {'RED': 4, 'YELLOW': 4, 'BLUE': 4, 'GREEN': 4, 'BLACK': 4}
+    # ピラミッド検知時に元の解像度で再検知するかどうか
+    # 壁は面積とx座標しか使わないので、縮小画像の結果で十分
+    PYRAMID_REFINE = {'RED': True, 'YELLOW': True, 'BLUE': True, 'GREEN': True, 'BLACK': False}
+    # 再検知する窓を候補領域の外接矩形から広げる量[縮小画像の画素]
+    PYRAMID_REFINE_MARGIN = 2
+    # 縮小画像での面積(縮小率の2乗を掛けた値)がこの割合×閾値を超える領域を候補として再検知する
+    # 縮小すると面積が小さく見積もられる場合があるので、閾値より少し下まで候補にする
+    PYRAMID_CANDIDATE_RATIO = 0.5
+    # 再検知する候補の最大数(面積の大きい順)
+    PYRAMID_MAX_CANDIDATES = 4
+
+    # 最大領域の検出方式
+    # CONTOUR    : 全輪郭の凸包とモーメントを求めて最大のものを選ぶ(従来方式)
+    # COMPONENTS : 連結成分の統計量から最大の領域をNumPyで選び、選ばれた領域だけ輪郭を求める
+    # COMPONENTSは画素数で最大領域を選ぶので、凸包の面積で選ぶCONTOURとは選ぶ領域が変わる場合がある
+    BLOB_BACKEND_CONTOUR = 0
+    BLOB_BACKEND_COMPONENTS = 1
+    BLOB_BACKEND = BLOB_BACKEND_CONTOUR
+    # COMPONENTSで四角形判定をする色について、判定を試す領域の最大数(面積の大きい順に試す)
+    BLOB_COMPONENTS_MAX_CANDIDATES = 5
+
+    # 追跡モードの有効無効
+    # 追跡中の色は前フレームからの予測位置の周辺だけを探索し、見失った場合は画面全体を探索する
+    TRACKING = DISABLE
+    # パイプライン処理ではワーカごとに別々に追跡するので、効果は小さくなる
+    # 追跡する色
+    TRACKING_COLORS = ['RED', 'BLUE', 'YELLOW']
+
+    # パイプライン処理のワーカプロセス数(0の場合は1プロセスで順番に処理する)
+    # パイプライン処理ではプレビュー配信は行わない
+    PIPELINE_WORKERS = 0
+
+    # 毎フレーム検知する色
+    DETECT_COLORS = ['RED', 'YELLOW', 'BLUE', 'BLACK']
+
+    # 色ラベルのビット割り当て(赤は値域が2つに分かれているので2ビット使う)
+    COLOR_LABEL_RED_1 = 0x01
+    COLOR_LABEL_RED_2 = 0x02
+    COLOR_LABEL_YELLOW = 0x04
+    COLOR_LABEL_BLUE = 0x08
+    COLOR_LABEL_GREEN = 0x10
+    COLOR_LABEL_BLACK = 0x20
+    COLOR_LABEL_BITS = {'RED': COLOR_LABEL_RED_1 | COLOR_LABEL_RED_2,
+                        'YELLOW': COLOR_LABEL_YELLOW,
+                        'BLUE': COLOR_LABEL_BLUE,
+                        'GREEN': COLOR_LABEL_GREEN,
+                        'BLACK': COLOR_LABEL_BLACK}
+
+    # 検知結果の十字マーカーの色
+    MARKER_COLORS = {'RED': (255, 30, 30),
+                     'YELLOW': (30, 255, 255),
+                     'BLUE': (30, 30, 255),
+                     'GREEN': (30, 255, 30),
+                     'BLACK': (0, 0, 0)}
+
     # @brief コンスタラクタ
     # @detail 初期化処理を行う
     def __init__(self):
         TRACE('ImageProcessing generated')
+        self._color_label_lut = self.makeColorLabelLut()
+        self.setTracking(self.TRACKING)
+        # 直前のフレームの色ごとの検知結果
+        self.last_detections = {}
+        self._frameShare = None
+        self._dataEvent = None
+        # 画像処理結果の記録(sensorLogのセッションを開始している場合のみ、target()で開く)
+        self._sensorLog = None
+
+    # @brief プレビュー配信用の共有メモリを設定する
+    # @param frameShare previewStreamer.FrameShare
+    def setFrameShare(self, frameShare):
+        self._frameShare = frameShare
+
+    # @brief 結果を書き込んだことをモータ制御プロセスへ知らせる通知を設定する
+    # @param dataEvent multiprocessing.Event
+    def setDataEvent(self, dataEvent):
+        self._dataEvent = dataEvent
+
+    # @brief 追跡モードを切り替える
+    # @param enable ENABLE or DISABLE
+    def setTracking(self, enable):
+        self.TRACKING = enable
+        self._tracker = VisionTracker(self.TRACKING_COLORS) if enable == self.ENABLE else None
     
-    # @brief 指定色の最大領域を検知する
+    # @brief 指定色のマスク画像を生成する
     # @param hsv_img HSV変換後の処理対象画像
-    # @param color_name 検知する色の名前
-    # @detail
-    def colorDetect2(self, hsv_img, color_name):
-
+    # @param color_name マスクを生成する色の名前
+    def makeColorMask(self, hsv_img, color_name):
         if color_name == 'RED':
             # 赤色のHSVの値域1
             hsv_range_min = self.RED_HSV_RANGE_MIN_1
@@ -80,10 +182,47 @@ class ImageProcessing:
             hsv_range_min = self.BLACK_HSV_RANGE_MIN
             hsv_range_max = self.BLACK_HSV_RANGE_MAX
             mask = cv2.inRange(hsv_img, np.array(hsv_range_min), np.array(hsv_range_max))
-            
-        if self.DEBUG_IMSHOW == self.ENABLE:
-            cv2.imshow('Mask' + color_name, cv2.flip(mask, -1))
-
+        return mask
+
+    # @brief 色ラベル用のルックアップテーブルを生成する
+    # @detail H, S, Vそれぞれの値に対して、その値を値域に含む色ラベルのビットを立てたテーブルを作る
+    #         3チャンネル分のビットのANDを取ると、画素ごとの色ラベルになる
+    def makeColorLabelLut(self):
+        ranges = [(self.COLOR_LABEL_RED_1, self.RED_HSV_RANGE_MIN_1, self.RED_HSV_RANGE_MAX_1),
+                  (self.COLOR_LABEL_RED_2, self.RED_HSV_RANGE_MIN_2, self.RED_HSV_RANGE_MAX_2),
+                  (self.COLOR_LABEL_YELLOW, self.YELLOW_HSV_RANGE_MIN, self.YELLOW_HSV_RANGE_MAX),
+                  (self.COLOR_LABEL_BLUE, self.BLUE_HSV_RANGE_MIN, self.BLUE_HSV_RANGE_MAX),
+                  (self.COLOR_LABEL_GREEN, self.GREEN_HSV_RANGE_MIN, self.GREEN_HSV_RANGE_MAX),
+                  (self.COLOR_LABEL_BLACK, self.BLACK_HSV_RANGE_MIN, self.BLACK_HSV_RANGE_MAX)]
+        lut = np.zeros((1, 256, 3), dtype=np.uint8)
+        for label_bit, hsv_range_min, hsv_range_max in ranges:
+            for channel in range(3):
+                lut[0, hsv_range_min[channel]:hsv_range_max[channel] + 1, channel] |= label_bit
+        return lut
+
+    # @brief 全画素の色ラベルを一度の走査で求める
+    # @param hsv_img HSV変換後の処理対象画像
+    # @detail 戻り値の各画素は、その画素が含まれる色の値域のビットの論理和になる
+    #         (値域が重なっている色もあるので、排他的なラベルではない)
+    def makeColorLabel(self, hsv_img):
+        h, s, v = cv2.split(cv2.LUT(hsv_img, self._color_label_lut))
+        label = cv2.bitwise_and(h, s)
+        cv2.bitwise_and(label, v, dst=label)
+        return label
+
+    # @brief マスク画像から最大領域を検知する
+    # @param mask 処理対象のマスク画像(0以外の画素を領域として扱う)
+    # @param color_name 検知する色の名前
+    # @detail BLOB_BACKENDで指定された方式で検知する
+    def findMaxBlob(self, mask, color_name):
+        if self.BLOB_BACKEND == self.BLOB_BACKEND_COMPONENTS:
+            return self.findMaxBlobByComponents(mask, color_name)
+        return self.findMaxBlobByContours(mask, color_name)
+
+    # @brief 全輪郭の凸包とモーメントからマスク画像の最大領域を検知する
+    # @param mask 処理対象のマスク画像(0以外の画素を領域として扱う)
+    # @param color_name 検知する色の名前
+    def findMaxBlobByContours(self, mask, color_name):
         _, contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
         if color_name == 'RED' or color_name == 'BLUE' or color_name == 'BLACK':
@@ -128,15 +267,212 @@ class ImageProcessing:
             else:
                 return -1, -1, 0.0, []
 
-    # @brief 十字マーカーを描画する
-    # @param x 十字マーカーのx座標
-    # @param y 十字マーカーのy座標
-    # @param marker_color 十字マーカーの色
-    def draw_marker(self, img, x, y, marker_color):
-        cv2.line(img, (x - 7, y), (x + 7, y), color=(255, 255, 255), thickness=2)
-        cv2.line(img, (x, y - 7), (x, y + 7), color=(255, 255, 255), thickness=2)
-        cv2.line(img, (x - 7, y), (x + 7, y), color=marker_color, thickness=1)
-        cv2.line(img, (x, y - 7), (x, y + 7), color=marker_color, thickness=1)
+    # @brief 連結成分の統計量からマスク画像の最大領域を検知する
+    # @param mask 処理対象のマスク画像(0以外の画素を領域として扱う)
+    # @param color_name 検知する色の名前
+    # @detail 凸包(黄色、緑色は近似多角形)とモーメントは選ばれた領域についてだけ求める
+    def findMaxBlobByComponents(self, mask, color_name):
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        # ラベル0は背景
+        if count <= 1:
+            return -1, -1, 0.0, []
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        is_polygon_filter = color_name == 'YELLOW' or color_name == 'GREEN'
+        if is_polygon_filter:
+            candidates = np.argsort(areas)[::-1][:self.BLOB_COMPONENTS_MAX_CANDIDATES] + 1
+        else:
+            candidates = [np.argmax(areas) + 1]
+
+        for index in candidates:
+            x = int(stats[index, cv2.CC_STAT_LEFT])
+            y = int(stats[index, cv2.CC_STAT_TOP])
+            w = int(stats[index, cv2.CC_STAT_WIDTH])
+            h = int(stats[index, cv2.CC_STAT_HEIGHT])
+            blob = (labels[y:y + h, x:x + w] == index).astype(np.uint8)
+            _, contours, _ = cv2.findContours(blob, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contour = max(contours, key=len)
+            if is_polygon_filter:
+                approx = cv2.approxPolyDP(contour, 0.01 * cv2.arcLength(contour, True), True)
+                # 四角形に近い形のみ扱う
+                if not 3 < len(approx) < 10:
+                    continue
+            else:
+                approx = cv2.convexHull(contour)
+            M = cv2.moments(approx)
+            if M['m00'] > 0:
+                cx = int(M['m10'] / M['m00']) + x
+                cy = int(M['m01'] / M['m00']) + y
+                return cx, cy, M['m00'], approx + np.array([x, y], dtype=approx.dtype)
+        return -1, -1, 0.0, []
+
+    # @brief 指定色の最大領域を検知する
+    # @param hsv_img HSV変換後の処理対象画像
+    # @param color_name 検知する色の名前
+    # @detail
+    def colorDetect2(self, hsv_img, color_name):
+        mask = self.makeColorMask(hsv_img, color_name)
+        return self.findMaxBlob(mask, color_name)
+
+    # @brief 色の検知結果を無視する面積の閾値を取得する
+    # @param color_name 色の名前
+    def ignoreAreaSize(self, color_name):
+        if color_name == 'RED' or color_name == 'BLUE':
+            return self.IGNORE_AREA_SIZE_BALL
+        elif color_name == 'YELLOW':
+            return self.IGNORE_AREA_SIZE_YELLOW
+        elif color_name == 'GREEN':
+            return self.IGNORE_AREA_SIZE_GREEN
+        return self.IGNORE_AREA_SIZE_WALL
+
+    # @brief 指定色のマスク画像を現在の切り出し方式で生成する
+    # @param hsv_img HSV変換後の処理対象画像
+    # @param color_name マスクを生成する色の名前
+    # @param labels 色ラベルのキャッシュ(同じ画像の色ラベルを何度も求めないようにする)
+    # @param key キャッシュのキー(Noneの場合はキャッシュしない)
+    def segmentColor(self, hsv_img, color_name, labels, key):
+        if self.SEGMENTATION_MODE == self.SEGMENTATION_FUSED:
+            if labels is None or key is None:
+                label = self.makeColorLabel(hsv_img)
+            else:
+                if key not in labels:
+                    labels[key] = self.makeColorLabel(hsv_img)
+                label = labels[key]
+            return cv2.bitwise_and(label, self.COLOR_LABEL_BITS[color_name])
+        return self.makeColorMask(hsv_img, color_name)
+
+    # @brief 画像を縮小する
+    # @param hsv_img HSV変換後の処理対象画像
+    # @param scale 縮小率
+    # @detail 色相は平均を取ると赤色の境界で壊れるので、最近傍で間引く
+    def downscale(self, hsv_img, scale):
+        height, width = hsv_img.shape[:2]
+        return cv2.resize(hsv_img, (width // scale, height // scale), interpolation=cv2.INTER_NEAREST)
+
+    # @brief 画像の一部の窓の中だけで指定色の最大領域を検知する
+    # @param hsv_img HSV変換後の処理対象画像
+    # @param color_name 検知する色の名前
+    # @param window 探索する窓 (x0, y0, x1, y1)
+    # @return colorDetect2()と同じ、画像全体の座標系での (cx, cy, area_size, convex)
+    def detectInWindow(self, hsv_img, color_name, window):
+        x0, y0, x1, y1 = window
+        mask = self.segmentColor(hsv_img[y0:y1, x0:x1], color_name, None, None)
+        cx, cy, area_size, convex = self.findMaxBlob(mask, color_name)
+        if cx == -1:
+            return -1, -1, 0.0, []
+        return cx + x0, cy + y0, area_size, convex + np.array([x0, y0], dtype=convex.dtype)
+
+    # @brief 窓の中で検知した領域が窓の境界で切れているかを判定する
+    # @param hsv_img HSV変換後の処理対象画像
+    # @param convex 検知した領域の凸包(画像全体の座標系)
+    # @param window 探索した窓 (x0, y0, x1, y1)
+    def isClippedByWindow(self, hsv_img, convex, window):
+        height, width = hsv_img.shape[:2]
+        x0, y0, x1, y1 = window
+        x, y, w, h = cv2.boundingRect(convex)
+        return (x <= x0 and x0 > 0) or (y <= y0 and y0 > 0) or \
+            (x + w >= x1 and x1 < width) or (y + h >= y1 and y1 < height)
+
+    # @brief 縮小画像で候補領域を探し、候補領域の周辺だけ元の解像度で最大領域を検知する
+    # @param hsv_img HSV変換後の処理対象画像
+    # @param coarse_hsv_img hsv_imgをscaleで縮小した画像
+    # @param color_name 検知する色の名前
+    # @param scale 縮小率
+    # @param labels 色ラベルのキャッシュ
+    # @return colorDetect2()と同じ、元の解像度の座標系での (cx, cy, area_size, convex)
+    # @detail 黄色、緑色の四角形判定は縮小画像では崩れるので、候補は形状を問わず凸包の面積で選ぶ
+    #         再検知した領域が窓で切れている場合は、元の解像度で画面全体を検知する
+    def pyramidDetect(self, hsv_img, coarse_hsv_img, color_name, scale, labels):
+        coarse_mask = self.segmentColor(coarse_hsv_img, color_name, labels, scale)
+        if not self.PYRAMID_REFINE.get(color_name, True):
+            cx, cy, area_size, convex = self.findMaxBlob(coarse_mask, color_name)
+            if cx == -1:
+                return -1, -1, 0.0, []
+            return cx * scale + scale // 2, cy * scale + scale // 2, area_size * scale * scale, convex * scale
+
+        # 面積の閾値は縮小率の2乗で縮める
+        # 候補がない場合は、元の解像度で検知しても閾値未満になり結果が使われないので、検知なしとする
+        _, contours, _ = cv2.findContours(coarse_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        min_area = self.ignoreAreaSize(color_name) * self.PYRAMID_CANDIDATE_RATIO / (scale * scale)
+        candidates = []
+        for contour in contours:
+            area_size = cv2.contourArea(cv2.convexHull(contour))
+            if area_size > min_area:
+                candidates.append((area_size, cv2.boundingRect(contour)))
+        if len(candidates) == 0:
+            return -1, -1, 0.0, []
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        # 候補領域の外接矩形の周辺だけ元の解像度で再検知し、最大のものを選ぶ
+        height, width = hsv_img.shape[:2]
+        margin = self.PYRAMID_REFINE_MARGIN
+        best = (-1, -1, 0.0, [])
+        for area_size, (x, y, w, h) in candidates[:self.PYRAMID_MAX_CANDIDATES]:
+            window = (max((x - margin) * scale, 0), max((y - margin) * scale, 0),
+                      min((x + w + margin) * scale, width), min((y + h + margin) * scale, height))
+            detection = self.detectInWindow(hsv_img, color_name, window)
+            if detection[0] == -1:
+                continue
+            if self.isClippedByWindow(hsv_img, detection[3], window):
+                TRACE('pyramid fallback: ' + color_name)
+                return self.findMaxBlob(self.segmentColor(hsv_img, color_name, labels, 1), color_name)
+            if detection[2] > best[2]:
+                best = detection
+        return best
+
+    # @brief 全ての検知対象色の最大領域を検知する
+    # @param hsv_img HSV変換後の処理対象画像
+    # @return 色の名前をキー、colorDetect2()と同じ (cx, cy, area_size, convex) を値とする辞書
+    # @detail SEGMENTATION_MODEがFUSEDの場合は、色ラベルを一度の走査で求めてから色ごとの領域を取り出す
+    #         PYRAMID_SCALEが1より大きい色は、縮小画像で候補領域を探してから再検知する
+    #         TRACKINGが有効な場合、追跡中の色は予測位置の周辺だけを探索する
+    def detectColors(self, hsv_img):
+        detections = {}
+        labels = {}
+        pyramid = {}
+        if self._tracker is not None:
+            self._tracker.next_frame()
+        for color_name in self.DETECT_COLORS:
+            detections[color_name] = self.detectColor(hsv_img, color_name, labels, pyramid)
+        return detections
+
+    # @brief 1色分の最大領域を現在の設定で検知する(detectColors()から色ごとに呼ばれる)
+    # @param hsv_img HSV変換後の処理対象画像
+    # @param color_name 検知する色の名前
+    # @param labels 色ラベルのキャッシュ(同じフレームの色の間で共有する)
+    # @param pyramid 縮小率をキー、縮小画像を値とするキャッシュ(同じフレームの色の間で共有する)
+    # @return colorDetect2()と同じ (cx, cy, area_size, convex)
+    def detectColor(self, hsv_img, color_name, labels, pyramid):
+        height, width = hsv_img.shape[:2]
+        # 追跡中の色は予測位置の周辺だけ探索する
+        window = self._tracker.search_window(color_name, width, height) if self._tracker is not None else None
+        if window is not None:
+            detection = self.detectInWindow(hsv_img, color_name, window)
+            # 閾値以下の領域しか見つからない場合も見失ったものとして扱う
+            is_found = detection[0] != -1 and detection[2] > self.ignoreAreaSize(color_name)
+            if is_found and not self.isClippedByWindow(hsv_img, detection[3], window):
+                if self._tracker.update(color_name, detection[0], detection[1], detection[2],
+                                        self.ignoreAreaSize(color_name)):
+                    return detection
+                # 面積が急に縮んだ場合は信頼度が低いので、同じフレームで画面全体を探索し直す
+                # (追跡は update() の中で解除されている)
+                TRACE('tracking fallback (area dropped): ' + color_name)
+            else:
+                # 見失った場合や窓で切れている場合は、同じフレームで画面全体を探索して追跡し直す
+                TRACE('tracking fallback: ' + color_name)
+                self._tracker.reset(color_name)
+
+        scale = self.PYRAMID_SCALE.get(color_name, 1)
+        if scale > 1:
+            if scale not in pyramid:
+                pyramid[scale] = self.downscale(hsv_img, scale)
+            detection = self.pyramidDetect(hsv_img, pyramid[scale], color_name, scale, labels)
+        else:
+            mask = self.segmentColor(hsv_img, color_name, labels, 1)
+            detection = self.findMaxBlob(mask, color_name)
+        if self._tracker is not None:
+            cx, cy, area_size, convex = detection
+            self._tracker.update(color_name, cx, cy, area_size, self.ignoreAreaSize(color_name))
+        return detection
 
     # @brief 画像処理によって検知した領域からボールの方向と距離を計算する
     # @param cx 領域のx座標
@@ -148,44 +484,14 @@ class ImageProcessing:
         
         return int(ball_angle), int(ball_distance)
 
-    def imageProcessingFrame(self, frame, shmem):
-        # HSV色空間に変換
-        hsv_img = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-        cv2.line(frame, (self.CAMERA_CENTER_CX, 0), (self.CAMERA_CENTER_CX, 480),
-                 (0, 0, 255), thickness=1)
-        cv2.line(frame, (0, self.CAMERA_CENTER_CY), (480, self.CAMERA_CENTER_CY),
-                 (0, 0, 255), thickness=1)
-
-        # 赤色領域の検知
-        red_cx, red_cy, red_area_size, red_convex = self.colorDetect2(hsv_img, 'RED')
-        if red_cx > -1:
-            self.draw_marker(frame, red_cx, red_cy, (255, 30, 30))
-        
-        # 黄色領域の検知
-        yellow_cx, yellow_cy, yellow_area_size, yellow_convex = self.colorDetect2(hsv_img, 'YELLOW')
-        if yellow_cx > -1:
-            self.draw_marker(frame, yellow_cx, yellow_cy, (30, 255, 255))
-
-        # 青色領域の検知
-        blue_cx, blue_cy, blue_area_size, blue_convex = self.colorDetect2(hsv_img, 'BLUE')
-        if blue_cx > -1:
-            self.draw_marker(frame, blue_cx, blue_cy, (30, 30, 255))
-        
-        # 緑色領域の検知
-        #green_cx, green_cy, green_area_size, green_convex = self.colorDetect2(hsv_img, 'GREEN')
-        #if green_cx > -1:
-        #    self.draw_marker(frame, green_cx, green_cy, (30, 255, 30))
-        
-        # 黒色領域の検知
-        black_cx, black_cy, black_area_size, black_convex = self.colorDetect2(hsv_img, 'BLACK')
-        if black_cx > -1:
-            self.draw_marker(frame, black_cx, black_cy, (0, 0, 0))
-        
-        INFO('RedSize :' + str(red_area_size).rjust(8))
-        INFO('YellowSize :' + str(yellow_area_size).rjust(8))
-        INFO('BlueSize :' + str(blue_area_size).rjust(8))
-        #INFO('GreenSize :' + str(green_area_size).rjust(8))
-        INFO('BlackSize :' + str(black_area_size).rjust(8))
+    # @brief 各色の検知結果からボール、ステーション、壁の情報を決定する
+    # @param detections detectColors()の戻り値
+    # @param shmem 共有メモリ
+    def decideTargets(self, detections, shmem):
+        red_cx, red_cy, red_area_size, red_convex = detections['RED']
+        yellow_cx, yellow_cy, yellow_area_size, yellow_convex = detections['YELLOW']
+        blue_cx, blue_cy, blue_area_size, blue_convex = detections['BLUE']
+        black_cx, black_cy, black_area_size, black_convex = detections['BLACK']
 
         # 認識できた部分の面積が小さい場合は結果を無視し、distanceに不正な値を入れる
         if red_area_size > blue_area_size and red_area_size > self.IGNORE_AREA_SIZE_BALL:
@@ -219,57 +525,96 @@ class ImageProcessing:
 
         return ball_angle, ball_distance, station_angle, station_distance, wall_x, wall_size
 
+    # @brief 1フレーム分の画像処理を行う
+    # @param frame BGRの画像(書き換えない)
+    # @param shmem 共有メモリ
+    # @detail 検知結果の描画は行わない(プレビュー配信プロセスで行う)
+    @traced('imageProcessingFrame')
+    def imageProcessingFrame(self, frame, shmem):
+        # HSV色空間に変換
+        with span('cvtColor'):
+            hsv_img = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+
+        # 赤色、黄色、青色、黒色領域の検知
+        # 緑色領域の検知はDETECT_COLORSに'GREEN'を追加すると有効になる
+        with span('detectColors'):
+            detections = self.detectColors(hsv_img)
+        self.last_detections = detections
+
+        # 毎フレーム出力するので、文字列の組み立てはdebugの書き出しスレッドに任せる
+        INFOF('RedSize :{!s:>8}', detections['RED'][2])
+        INFOF('YellowSize :{!s:>8}', detections['YELLOW'][2])
+        INFOF('BlueSize :{!s:>8}', detections['BLUE'][2])
+        #INFOF('GreenSize :{!s:>8}', detections['GREEN'][2])
+        INFOF('BlackSize :{!s:>8}', detections['BLACK'][2])
+
+        with span('decideTargets'):
+            return self.decideTargets(detections, shmem)
+
+    # @brief 画像処理の結果を共有メモリに書き込む
+    # @param shmem 共有メモリ
+    # @param result imageProcessingFrame()の戻り値
+    # @param frame_seq 画像のフレーム番号
+    # @param capture_time 画像の撮影時刻(time.monotonic())
+    def writeResult(self, shmem, result, frame_seq, capture_time):
+        ball_angle, ball_distance, station_angle, station_distance, wall_x, wall_size = result
+        # 1フレーム分の結果をまとめて書き込み、読み出し側で2フレームの結果が混ざらないようにする
+        with span('writeResult', frame_seq):
+            snapshot = VisionSnapshot(ballAngle=int(ball_angle * 90 / 240),
+                                      ballDis=int(ball_distance),
+                                      stationAngle=int(station_angle * 90 / 240),
+                                      stationDis=int(station_distance),
+                                      wallX=int(wall_x),
+                                      wallSize=int(wall_size),
+                                      frameSeq=frame_seq,
+                                      captureTime=capture_time,
+                                      publishTime=time.monotonic())
+            writeVision(shmem, snapshot)
+            if self._sensorLog is not None:
+                self._sensorLog.writeVision(snapshot)
+            if self._dataEvent is not None:
+                self._dataEvent.set()
+
     # @brief 画像処理のmain処理
     # @param shmem 共有メモリ
-    def imageProcessingMain(self, shmem):
+    # @param source 画像の取得元(Noneの場合はカメラから取得する)
+    def imageProcessingMain(self, shmem, source=None):
         # 画像処理を行う
-
-        with picamera.PiCamera() as camera:
-            with picamera.array.PiRGBArray(camera) as stream:
-                camera.resolution = (480, 480)
-                cap = cv2.VideoCapture(0)
-
-                while cap.isOpened():
-                    # 画像を取得し、stream.arrayにRGBの順で映像データを格納
-                    camera.capture(stream, 'bgr', use_video_port=True)
-
-                    ball_angle, ball_distance, station_angle, station_distance, wall_x, wall_size = self.imageProcessingFrame(stream.array, shmem)
-
-                    DEBUG('ball: angle =' + str(ball_angle).rjust(5) + ', distance = ' + str(ball_distance).rjust(5))
-                    DEBUG('station: angle =' + str(station_angle).rjust(5) + ', distance = ' + str(station_distance).rjust(5))
-                    DEBUG('wall: x =' + str(wall_x).rjust(5) + ', size = ' + str(wall_size).rjust(5))
-                    
-                    # 結果表示
-                    # 画角の前後左右と画像表示の上下左右を揃えるために画像を転置する。
-                    if self.DEBUG_IMSHOW == self.ENABLE:
-                        cv2.imshow('Frame', cv2.flip(stream.array, -1))
-                        cv2.moveWindow('Frame', 0, 30)
-                        cv2.moveWindow('MaskRED', 482, 30)
-                        cv2.moveWindow('MaskYELLOW', 964, 30)
-                        cv2.moveWindow('MaskBLUE', 1446, 30)
-                        #cv2.moveWindow('MaskGREEN', 1446, 30)
-                        cv2.moveWindow('MaskBLACK', 0, 530)
-              
-                    # 共有メモリに書き込む
-                    shmem.ballAngle = int(ball_angle * 90 / 240)
-                    shmem.ballDis = int(ball_distance)
-                    shmem.stationAngle = int(station_angle * 90 / 240)
-                    shmem.stationDis = int(station_distance)
-                    shmem.wallX = int(wall_x)
-                    shmem.wallSize = int(wall_size)
-                    
-                    # "q"でウィンドウを閉じる
-                    if cv2.waitKey(1) & 0xFF == ord("q"):
-                        break
-
-                    # streamをリセット
-                    stream.seek(0)
-                    stream.truncate()
-                cv2.destroyAllWindows()
-
-    def target(self, shmem):
+        if source is None:
+            source = PiCameraFrameSource(resolution=(480, 480))
+
+        with source:
+            while True:
+                # 最新の画像を取得する(バッファはコピーせずにそのまま使う)
+                captured = source.read()
+                if captured is None:
+                    break
+                frame, frame_seq, capture_time = captured
+
+                ball_angle, ball_distance, station_angle, station_distance, wall_x, wall_size = self.imageProcessingFrame(frame, shmem)
+
+                DEBUGF('ball: angle ={!s:>5}, distance = {!s:>5}', ball_angle, ball_distance)
+                DEBUGF('station: angle ={!s:>5}, distance = {!s:>5}', station_angle, station_distance)
+                DEBUGF('wall: x ={!s:>5}, size = {!s:>5}', wall_x, wall_size)
+                DEBUGF('frame: seq ={!s:>6}, dropped = {!s:>6}', frame_seq, source.dropped_frames)
+
+                # 共有メモリに書き込む
+                self.writeResult(shmem, (ball_angle, ball_distance, station_angle, station_distance, wall_x, wall_size),
+                                 frame_seq, capture_time)
+
+                # プレビュー配信用に最新の画像と検知結果を渡す
+                if self._frameShare is not None:
+                    self._frameShare.publish(frame, frame_seq, capture_time, self.last_detections)
+
+    # @param source 画像の取得元(Noneの場合はカメラから取得する)
+    def target(self, shmem, source=None):
         TRACE('imageProcessingMain target() start')
-        self.imageProcessingMain(shmem)
+        setProcessName('imageProcessing')
+        self._sensorLog = openWriter('vision')
+        if self.PIPELINE_WORKERS > 0:
+            VisionPipeline(self, workers=self.PIPELINE_WORKERS).run(shmem, source)
+        else:
+            self.imageProcessingMain(shmem, source)
 
     def close():
         pass
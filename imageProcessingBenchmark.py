@@ -0,0 +1,222 @@
+# coding: UTF-8
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import cv2
+from imageProcessing import ImageProcessing
+from latencyStats import LatencyStats
+from debug import ERROR, WARN, INFO, DEBUG, TRACE
+
+
+"""
+
+benchmark for imageProcessing.py
+
+data/tempの撮影画像を使って、画面表示なしで画像処理の各段階の処理時間を計測する。
+検知結果は正解ファイル(golden)と比較し、高速化で結果が変わっていないことを確認する。
+正解ファイル(data/golden/imageProcessing.json)は高速化前の処理(SEGMENTATION_SEPARATE、輪郭抽出、縮小なし)の結果で、
+一致しない場合と正解ファイルがない場合は終了コード1で終わる。
+結果はJSONで出力する。
+
+.. code-block:: bash
+
+    # 正解ファイルを作成(更新)する
+    python3 imageProcessingBenchmark.py --segmentation separate --pyramid-scale 1 --update-golden
+    # 設定を変えて計測し、正解ファイルと比較する(縮小なしとの速度比も出す)
+    python3 imageProcessingBenchmark.py --pyramid-scale 4 --baseline --output result.json
+
+計測例(data/tempの58枚、--repeat 20、x86_64のPC、OpenCV 3.4.18)
+
+ピラミッド検知の縮小率(SEGMENTATION_FUSED、縮小なしとの比較)
+
+=============  ==========  =======  ==================  =================
+PYRAMID_SCALE  ms/frame    speedup  mismatch(scale 1)   mismatch(golden)
+=============  ==========  =======  ==================  =================
+1              2.98        0.93     0                   0
+2              1.40        2.27     0                   0
+3              1.67        2.18     0                   0
+4              1.18        2.44     0                   0
+=============  ==========  =======  ==================  =================
+
+色領域の切り出し方式(同じ画像、同じ縮小率、ms/frameはframe、detectColorsは色の検知のみ)
+
+=============  =============  ==========  ============  =================
+SEGMENTATION   PYRAMID_SCALE  ms/frame    detectColors  mismatch(golden)
+=============  =============  ==========  ============  =================
+SEPARATE       1              2.74        2.33          0
+FUSED          1              3.44        2.83          0
+SEPARATE       4 (default)    1.09        0.67          0
+FUSED          4              1.17        0.75          0
+=============  =============  ==========  ============  =================
+
+| FUSEDは色ラベルを1回で求めるが、色ごとの二値化(cv2.bitwise_and)と輪郭抽出は残るので、
+  inRangeを色ごとに行うSEPARATEより速くならなかった。デフォルトはSEPARATE。
+| data/tempには壁(黒色の面積がIGNORE_AREA_SIZE_WALLを超える画像)が写っていないので、
+  縮小画像の結果をそのまま使う壁の面積とx座標はgoldenでは確認できていない。
+
+"""
+
+
+DEFAULT_GOLDEN_PATH = 'data/golden/imageProcessing.json'
+
+
+class DummyShmem:
+    soundPhase = 0
+
+
+# @brief コマンドライン引数の設定を画像処理インスタンスに反映する
+# @param imageProcessing 設定対象の画像処理インスタンス
+# @param args コマンドライン引数
+# @return JSONに出力する設定値
+def applySettings(imageProcessing, args):
+    if args.segmentation == 'separate':
+        imageProcessing.SEGMENTATION_MODE = ImageProcessing.SEGMENTATION_SEPARATE
+    elif args.segmentation == 'fused':
+        imageProcessing.SEGMENTATION_MODE = ImageProcessing.SEGMENTATION_FUSED
+    if args.blob_backend == 'contour':
+        imageProcessing.BLOB_BACKEND = ImageProcessing.BLOB_BACKEND_CONTOUR
+    elif args.blob_backend == 'components':
+        imageProcessing.BLOB_BACKEND = ImageProcessing.BLOB_BACKEND_COMPONENTS
+    if args.pyramid_scale is not None:
+        imageProcessing.PYRAMID_SCALE = {'RED': args.pyramid_scale, 'YELLOW': args.pyramid_scale,
+                                         'BLUE': args.pyramid_scale, 'GREEN': args.pyramid_scale,
+                                         'BLACK': args.wall_scale or args.pyramid_scale}
+    if args.tracking:
+        imageProcessing.setTracking(ImageProcessing.ENABLE)
+    return {'segmentation_mode': imageProcessing.SEGMENTATION_MODE,
+            'tracking': imageProcessing.TRACKING,
+            'blob_backend': imageProcessing.BLOB_BACKEND,
+            'pyramid_scale': imageProcessing.PYRAMID_SCALE}
+
+
+# @brief 全画像について各段階の処理時間を計測する
+# @param imageProcessing 計測対象の画像処理インスタンス
+# @param frames (ファイル名, 画像) のリスト
+# @param repeat 計測の繰り返し回数
+# @return (段階名をキーとするLatencyStatsの辞書, ファイル名をキーとする検知結果の辞書)
+def measure(imageProcessing, frames, repeat):
+    shmem = DummyShmem()
+    stats = {}
+
+    def add(name, value):
+        if name not in stats:
+            stats[name] = LatencyStats(name, max_samples=repeat * len(frames))
+        stats[name].add(value)
+
+    def timed(name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        add(name, time.perf_counter() - start)
+        return result
+
+    # 色ごとの内訳は、detectColors()が色ごとに呼ぶdetectColor()を計測する(現在の設定での実際の処理)
+    # FUSEDの色ラベルと縮小画像は最初に使った色の時間に含まれる
+    detect_color = imageProcessing.detectColor
+
+    def timedDetectColor(hsv_img, color_name, labels, pyramid):
+        return timed('detectColor.' + color_name, detect_color, hsv_img, color_name, labels, pyramid)
+
+    imageProcessing.detectColor = timedDetectColor
+    results = {}
+    try:
+        for i in range(repeat):
+            # 追跡の状態を前の繰り返しの最後の画像から持ち越さないように、繰り返し毎に作り直す
+            imageProcessing.setTracking(imageProcessing.TRACKING)
+            for file_name, frame in frames:
+                frame_start = time.perf_counter()
+                hsv_img = timed('cvtColor', cv2.cvtColor, frame, cv2.COLOR_BGR2HSV)
+                detections = timed('detectColors', imageProcessing.detectColors, hsv_img)
+                result = timed('decideTargets', imageProcessing.decideTargets, detections, shmem)
+                add('frame', time.perf_counter() - frame_start)
+                results[file_name] = list(result)
+    finally:
+        del imageProcessing.detectColor
+    return stats, results
+
+
+# @brief 検知結果を正解ファイルと比較する
+# @param results ファイル名をキーとする検知結果の辞書
+# @param golden_path 正解ファイルのパス
+def compareGolden(results, golden_path):
+    if not os.path.exists(golden_path):
+        return {'path': golden_path, 'status': 'missing', 'checked': 0, 'mismatches': []}
+    with open(golden_path, mode='r') as f:
+        golden = json.load(f)
+    mismatches = []
+    checked = 0
+    for file_name, result in sorted(results.items()):
+        if file_name not in golden:
+            continue
+        checked += 1
+        if golden[file_name] != result:
+            mismatches.append({'image': file_name, 'expected': golden[file_name], 'actual': result})
+    return {'path': golden_path, 'status': 'ok' if len(mismatches) == 0 else 'mismatch',
+            'checked': checked, 'mismatches': mismatches}
+
+
+def summarize(stats):
+    return {name: {key: (value * 1000 if key != 'count' else value) for key, value in s.summary().items()}
+            for name, s in sorted(stats.items())}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='headless benchmark and golden-output regression for imageProcessing.py')
+    parser.add_argument('--images', default='data/temp/*.jpg', help='glob pattern of captured images')
+    parser.add_argument('--repeat', type=int, default=5, help='repeat count')
+    parser.add_argument('--segmentation', choices=['separate', 'fused'], help='SEGMENTATION_MODE')
+    parser.add_argument('--blob-backend', choices=['contour', 'components'], help='BLOB_BACKEND')
+    parser.add_argument('--pyramid-scale', type=int, help='PYRAMID_SCALE for balls and station')
+    parser.add_argument('--wall-scale', type=int, help='PYRAMID_SCALE for walls (default: same as --pyramid-scale)')
+    parser.add_argument('--tracking', action='store_true', help='enable TRACKING (images are processed in file name order)')
+    parser.add_argument('--baseline', action='store_true', help='also measure the default settings without pyramid and report the speedup')
+    parser.add_argument('--golden', default=DEFAULT_GOLDEN_PATH, help='golden output file')
+    parser.add_argument('--update-golden', action='store_true', help='write the results to the golden file')
+    parser.add_argument('--output', help='output JSON file (default: stdout)')
+    args = parser.parse_args()
+
+    frames = [(os.path.basename(path), cv2.imread(path)) for path in sorted(glob.glob(args.images))]
+    if len(frames) == 0:
+        ERROR('no images found: ' + args.images)
+        sys.exit(1)
+
+    imageProcessing = ImageProcessing()
+    settings = applySettings(imageProcessing, args)
+    stats, results = measure(imageProcessing, frames, args.repeat)
+    frame_summary = stats['frame'].summary()
+    report = {'images': len(frames),
+              'repeat': args.repeat,
+              'settings': settings,
+              'stages_ms': summarize(stats),
+              'fps': 1 / frame_summary['mean'] if frame_summary['mean'] > 0 else 0}
+
+    if args.baseline:
+        # 比較対象は縮小なし(元の解像度で全画面を検知する)のデフォルト設定
+        baseline = ImageProcessing()
+        baseline.PYRAMID_SCALE = {color_name: 1 for color_name in ImageProcessing.PYRAMID_SCALE}
+        baseline_stats, baseline_results = measure(baseline, frames, args.repeat)
+        baseline_mean = baseline_stats['frame'].summary()['mean']
+        report['baseline'] = {'fps': 1 / baseline_mean if baseline_mean > 0 else 0,
+                              'speedup': baseline_mean / frame_summary['mean'] if frame_summary['mean'] > 0 else 0,
+                              'mismatch_frames': sum(1 for name in results if results[name] != baseline_results[name])}
+
+    if args.update_golden:
+        os.makedirs(os.path.dirname(args.golden), exist_ok=True)
+        with open(args.golden, mode='w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        # 標準出力はJSON用なので標準エラー出力に出す
+        print('golden updated: ' + args.golden, file=sys.stderr)
+    report['golden'] = compareGolden(results, args.golden)
+    if report['golden']['status'] == 'missing':
+        ERROR('golden file not found: ' + args.golden + ' (create it with --update-golden)')
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, mode='w') as f:
+            f.write(output)
+    else:
+        print(output)
+    sys.exit(0 if report['golden']['status'] == 'ok' else 1)
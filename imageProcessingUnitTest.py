@@ -4,6 +4,7 @@ from multiprocessing import Value
 from ctypes import Structure, c_int
 import unittest
 from imageProcessing import ImageProcessing
+from previewStreamer import annotateFrame, renderMasks
 from debug import ERROR, WARN, INFO, DEBUG, TRACE
 import cv2
 import time
@@ -34,13 +35,14 @@ if __name__ == '__main__':
     stream = cv2.imread(file_path)
 
     ball_angle, ball_distance, station_angle, station_distance, wall_x, wall_size = imageProcessing.imageProcessingFrame(stream, shmem)
-   
-    cv2.imshow('Frame', cv2.flip(stream, -1))
+
+    # 検知結果の描画は画像処理の外で行う
+    detections = {color_name: detection[:3] for color_name, detection in imageProcessing.last_detections.items()}
+    masks = renderMasks(imageProcessing, stream, imageProcessing.DETECT_COLORS)
+    cv2.imshow('Frame', annotateFrame(stream, detections))
+    cv2.imshow('Mask', masks)
     cv2.moveWindow('Frame', 0, 30)
-    cv2.moveWindow('MaskRED', 482, 30)
-    cv2.moveWindow('MaskYELLOW', 964, 30)
-    cv2.moveWindow('MaskGREEN', 1446, 30)
-    cv2.moveWindow('MaskBLACK', 0, 530)
+    cv2.moveWindow('Mask', 0, 530)
     cv2.waitKey(0)
 
     cv2.destroyAllWindows()
@@ -1,38 +1,333 @@
 # coding: UTF-8
 
-import FaBo9Axis_MPU9250
+import math
 import time
-from debug import DEBUG, TRACE, INFO
+from collections import deque
+from debug import DEBUG, TRACE, INFO, WARN
+
+try:
+    import FaBo9Axis_MPU9250
+except ImportError:
+    # Raspberry Pi以外の環境ではFaBo9Axis_MPU9250が無いので、mpu9250にreadGyro()を持つ代わりのセンサを渡して使う
+    FaBo9Axis_MPU9250 = None
+from ahrs import MadgwickAhrs
+from ak8963 import Ak8963
+from mpu9250Fifo import Mpu9250Fifo
+from sensorLog import openWriter
+from sharedState import ImuSnapshot, writeImu
+from spanTrace import traced, setProcessName
+
+
+class GyroBiasEstimator:
+    """
+
+    Track the gyro bias while the robot is standing still
+
+    モータ値が0になってからsettle_sec経った後、window_sec分の角速度のばらつきがmax_std以下で、
+    平均が今の補正値からmax_offset以内なら止まっていると判断し、補正値を平均に近づける(時定数time_constant_sec)。
+
+    Examples:
+        >>> estimator = GyroBiasEstimator(bias=imu_epsilon)
+        >>> estimator.update(timestamp, gyro_z, is_stopped=(left == 0 and right == 0))
+        >>> rate = gyro_z - estimator.bias
+
+    Attributes:
+        bias (float) : estimated bias [deg/s]
+        update_count (int) : number of samples used to update the bias
+
+    """
+
+    def __init__(self, bias=0, settle_sec=0.3, window_sec=0.5, max_std=0.5, max_offset=2.0, time_constant_sec=1.0):
+        self.bias = bias
+        self.update_count = 0
+        self._settle_sec = settle_sec
+        self._window_sec = window_sec
+        self._max_std = max_std
+        self._max_offset = max_offset
+        self._time_constant_sec = time_constant_sec
+        # 止まっている区間のサンプル(時刻, 角速度)と、その合計、2乗の合計
+        self._window = deque()
+        self._sum = 0
+        self._square_sum = 0
+        self._stop_time = None
+        self._pre_timestamp = None
+        self._interval_start_bias = bias
+        self._interval_update_count = 0
+
+    def reset(self, bias):
+        self.bias = bias
+        self._clear()
+
+    def _clear(self):
+        if self._interval_update_count > 0:
+            INFO('gyro bias updated: ' + '{:.3f}'.format(self._interval_start_bias) + ' -> ' +
+                 '{:.3f}'.format(self.bias) + ' [deg/s], samples = ' + str(self._interval_update_count))
+        self._window.clear()
+        self._sum = 0
+        self._square_sum = 0
+        self._stop_time = None
+        self._pre_timestamp = None
+        self._interval_update_count = 0
+
+    def update(self, timestamp, z, is_stopped):
+        """
+
+        Args:
+            timestamp (float) : sample time (time.monotonic())
+            z (float) : gyro z [deg/s]
+            is_stopped (bool) : True if both motor commands are 0
+
+        Returns:
+            bool: True if the bias was updated with this sample
+
+        """
+        if not is_stopped:
+            if self._stop_time is not None:
+                self._clear()
+            return False
+        if self._stop_time is None:
+            self._stop_time = timestamp
+            self._interval_start_bias = self.bias
+        # 止めた直後は惰性や揺れが残っているので使わない
+        if timestamp - self._stop_time < self._settle_sec:
+            return False
+        self._window.append((timestamp, z))
+        self._sum += z
+        self._square_sum += z * z
+        while timestamp - self._window[0][0] > self._window_sec:
+            old_timestamp, old_z = self._window.popleft()
+            self._sum -= old_z
+            self._square_sum -= old_z * old_z
+        pre_timestamp = self._pre_timestamp
+        self._pre_timestamp = timestamp
+        if timestamp - self._stop_time < self._settle_sec + self._window_sec or pre_timestamp is None:
+            return False
+        count = len(self._window)
+        mean = self._sum / count
+        std = math.sqrt(max(self._square_sum / count - mean * mean, 0))
+        if std > self._max_std or abs(mean - self.bias) > self._max_offset:
+            return False
+        alpha = min((timestamp - pre_timestamp) / self._time_constant_sec, 1)
+        self.bias += alpha * (mean - self.bias)
+        self.update_count += 1
+        self._interval_update_count += 1
+        return True
 
 
 class Imu:
     """
     
     IMU driver class
+
+    | LEGACY  : update_interval_sec毎に1サンプル読み、角速度をそのまま足す(従来の方式)
+    | POLLING : SAMPLE_RATE_HZで角速度を読み、実際のサンプル間隔(time.monotonic())を掛けて積分する
+    | FIFO    : MPU9250のFIFOに溜めたサンプル(Mpu9250Fifo.SAMPLE_RATE_HZ)をFIFO_READ_INTERVAL_SEC毎にまとめて読み、積分する
+
+    POLLING、FIFOの場合、角度と角速度はOUTPUT_RATE_HZで共有メモリに書き込む。
+
+    | HEADING_GYRO : ジャイロのz軸を積分して角度とする(従来の方式)
+    | HEADING_AHRS : 加速度、ジャイロの3軸をFIFOで、磁気センサ(Ak8963)を読み出し毎に読み、ahrs.MadgwickAhrsで求めた方位を角度とする
+
+    HEADING_AHRSの場合、角度は磁気センサで合わせ続けるので時間が経ってもずれない。
+    0度は起動時(最初のcalibrate())の向き、またはAHRS_YAW_REFERENCE_DEGの方位。
+
+    Examples:
+        >>> imu = Imu()
+        >>> imu.calibrate()
+        >>> Process(target=imu.target, args=(shmem,)).start()
     
     """
     
     # このセンサが一周した時の積分値
     ONE_ROUND_VALUE = 3600
+
+    # ジャイロの読み方
+    ACQUISITION_LEGACY = 0
+    ACQUISITION_POLLING = 1
+    ACQUISITION_FIFO = 2
+    ACQUISITION_MODE = ACQUISITION_POLLING
+    # POLLINGでジャイロを読む周期[Hz]
+    SAMPLE_RATE_HZ = 200
+    # FIFOを読み出す間隔[s](FIFOは500Hzで約0.5秒分溜められる)
+    FIFO_READ_INTERVAL_SEC = 0.02
+    # 角度の求め方
+    HEADING_GYRO = 0
+    HEADING_AHRS = 1
+    HEADING_BACKEND = HEADING_GYRO
+    # HEADING_AHRSでFIFOに溜める周期[Hz](加速度とジャイロで1サンプル12byteなので、FIFOには約0.2秒分溜められる)
+    AHRS_SAMPLE_RATE_HZ = 200
+    # Madgwickフィルタのゲイン(姿勢、ジャイロの補正値のずれ)
+    AHRS_BETA = 0.1
+    AHRS_ZETA = 0.02
+    # 角度を0とする方位(北から反時計回り[deg])、Noneの場合は起動時の向き
+    AHRS_YAW_REFERENCE_DEG = None
+    # 角度、角速度を書き込む周期[Hz]
+    OUTPUT_RATE_HZ = 20
+    # 積分に使うサンプル間隔の上限[s](補正中や読み出し失敗で間が空いた場合に、その間の角速度を外挿しない)
+    MAX_SAMPLE_GAP_SEC = 0.1
+    # モータ値が0で止まっている間に補正値を更新し続けるかどうか(GyroBiasEstimator)
+    # 有効な場合、MotorControllerは再スタート準備で補正を待たない(MotorController.WAIT_IMU_CALIBRATION)
+    ONLINE_BIAS_ESTIMATION = True
+    # 止めてから使い始めるまでの時間[s]、ばらつきを見る時間[s]、止まっていると判断する標準偏差と補正値からのずれ[deg/s]
+    BIAS_SETTLE_SEC = 0.3
+    BIAS_WINDOW_SEC = 0.5
+    BIAS_MAX_STD = 0.5
+    BIAS_MAX_OFFSET = 2.0
+    # 補正値を更新する時定数[s]
+    BIAS_TIME_CONSTANT_SEC = 1.0
     
-    def __init__(self, update_interval_sec=0.1):
+    # mpu9250 : readGyro()を持つセンサ(Noneの場合はFaBo9Axis_MPU9250.MPU9250を開く)
+    # fifo : Mpu9250Fifoと同じread()を持つセンサ(FIFOの場合のみ使う、Noneの場合はMpu9250Fifoを開く)
+    # mode : ACQUISITION_LEGACY, ACQUISITION_POLLING, ACQUISITION_FIFO(Noneの場合はACQUISITION_MODE)
+    # backend : HEADING_GYRO, HEADING_AHRS(Noneの場合はHEADING_BACKEND)
+    # magnet : Ak8963と同じread()を持つセンサ(HEADING_AHRSの場合のみ使う、Noneの場合はAk8963を開く)
+    def __init__(self, update_interval_sec=0.1, mpu9250=None, fifo=None, mode=None, backend=None, magnet=None):
         TRACE('Imu generated')
-        self._mpu9250 = FaBo9Axis_MPU9250.MPU9250()
+        self._mode = mode if mode is not None else Imu.ACQUISITION_MODE
+        self._ahrs = None
+        if (backend if backend is not None else Imu.HEADING_BACKEND) == Imu.HEADING_AHRS:
+            # 加速度とジャイロの3軸をFIFOから読む
+            self._mode = Imu.ACQUISITION_FIFO
+            if fifo is None:
+                fifo = Mpu9250Fifo(sample_rate_hz=Imu.AHRS_SAMPLE_RATE_HZ, axes=Mpu9250Fifo.AXES_ACCEL_GYRO)
+                fifo.start()
+            # MPU9250の設定後にバイパスを有効にする
+            if magnet is None:
+                magnet = Ak8963()
+                magnet.start()
+            self._ahrs = MadgwickAhrs(beta=Imu.AHRS_BETA, zeta=Imu.AHRS_ZETA)
+        if self._mode == Imu.ACQUISITION_FIFO:
+            if fifo is None:
+                fifo = Mpu9250Fifo()
+                fifo.start()
+        elif mpu9250 is None:
+            if FaBo9Axis_MPU9250 is None:
+                raise RuntimeError('FaBo9Axis_MPU9250 is not available')
+            mpu9250 = FaBo9Axis_MPU9250.MPU9250()
+        self._mpu9250 = mpu9250
+        self._fifo = fifo
+        self._magnet = magnet
+        # HEADING_AHRSの場合のジャイロ3軸の補正値[deg/s]と、角度を0とする方位[deg]
+        self._gyro_bias = (0.0, 0.0, 0.0)
+        self._yaw_reference = 0
+        self._ahrs_initialized = False
+        # 読んだサンプルの記録(sensorLogのセッションを開始している場合のみ)
+        # main.pyのプロセスで開き、起動時の補正もIMUプロセスでの読み出しも同じファイルに追記する
+        self._sensor_log = openWriter('imu')
         self._epsilon = 0
         self._degree = 0
         self._update_interval_sec = update_interval_sec
+        self._sample_seq = 0
+        self._data_event = None
+        # 前回のサンプルの時刻と補正後の角速度[deg/s](台形積分用)
+        self._pre_sample_time = None
+        self._pre_rate = 0
+        # 前回書き込んでからの角速度の合計とサンプル数
+        self._rate_sum = 0
+        self._rate_count = 0
+        # 止まっている間の補正値の更新(HEADING_AHRSの場合は磁気センサで合わせるので使わない)
+        self._bias_estimator = None
+        if Imu.ONLINE_BIAS_ESTIMATION and self._ahrs is None:
+            self._bias_estimator = GyroBiasEstimator(settle_sec=Imu.BIAS_SETTLE_SEC,
+                                                     window_sec=Imu.BIAS_WINDOW_SEC,
+                                                     max_std=Imu.BIAS_MAX_STD,
+                                                     max_offset=Imu.BIAS_MAX_OFFSET,
+                                                     time_constant_sec=Imu.BIAS_TIME_CONSTANT_SEC)
+    
+    # 角度を書き込んだことをモータ制御プロセスへ知らせる通知(multiprocessing.Event)を設定する
+    def set_data_event(self, data_event):
+        self._data_event = data_event
+
+    def read_samples(self):
+        """
+
+        Returns:
+            list of (float, float): (timestamp (time.monotonic()), gyro z [deg/s])
+
+        """
+        if self._mode == Imu.ACQUISITION_FIFO:
+            samples = self._fifo.read()
+            if self._sensor_log is not None:
+                self._sensor_log.writeGyroSamples(samples)
+            return samples
+        gyro = self._mpu9250.readGyro()
+        timestamp = time.monotonic()
+        if self._sensor_log is not None:
+            self._sensor_log.writeImu(timestamp, None, (gyro["x"], gyro["y"], gyro["z"]))
+        return [(timestamp, gyro["z"])]
+
+    def read_block(self):
+        """
+
+        read the magnetometer and the FIFO block (HEADING_AHRS)
+
+        Returns:
+            (tuple, numpy.ndarray, numpy.ndarray, numpy.ndarray): magnet [uT] (None if not available), timestamps, accel [g], gyro [deg/s]
+
+        """
+        # 読み出しに失敗した場合にFIFOのサンプルを捨てないように、磁気センサを先に読む
+        magnet = self._magnet.read()
+        timestamps, accel, gyro = self._fifo.read_block()
+        if self._sensor_log is not None:
+            if magnet is not None:
+                self._sensor_log.writeMagnet(time.monotonic(), magnet)
+            self._sensor_log.writeImuBlock(timestamps, accel, gyro)
+        return magnet, timestamps, accel, gyro
     
     def calibrate(self, sec=3, interval_sec=0.05):
         DEBUG('Imu.calibrate() start')
+        if self._ahrs is not None:
+            self.calibrate_ahrs(sec, interval_sec)
+            return
         count = int(sec / interval_sec)
         sum = 0
+        sample_count = 0
         for i in range(count):
-            gyro = self._mpu9250.readGyro()
-            sum += gyro["z"]
+            for timestamp, rate in self.read_samples():
+                sum += rate
+                sample_count += 1
             time.sleep(interval_sec)
-        self._epsilon = sum / count
+        if sample_count > 0:
+            self._epsilon = sum / sample_count
+        if self._bias_estimator is not None:
+            self._bias_estimator.reset(self._epsilon)
+        # 補正中は止まっているので、補正前のサンプルから積分し直さない
+        self._pre_sample_time = None
         DEBUG('Imu epsilon = ', self._epsilon)
     
+    # HEADING_AHRSの補正
+    # 止まっている間の平均でジャイロ3軸の補正値を求め、最初の補正では加速度と磁気センサから姿勢と0度の方位を決める
+    def calibrate_ahrs(self, sec, interval_sec):
+        count = int(sec / interval_sec)
+        gyro_sum = [0.0, 0.0, 0.0]
+        accel_sum = [0.0, 0.0, 0.0]
+        sample_count = 0
+        magnet = None
+        for i in range(count):
+            magnet, timestamps, accel, gyro = self.read_block()
+            if len(timestamps) > 0:
+                gyro_sum = [a + b for a, b in zip(gyro_sum, gyro.sum(axis=0).tolist())]
+                accel_sum = [a + b for a, b in zip(accel_sum, accel.sum(axis=0).tolist())]
+                sample_count += len(timestamps)
+                # 2回目以降の補正中も方位を更新し続ける
+                if self._ahrs_initialized:
+                    self._ahrs.update_block(timestamps, gyro - self._gyro_bias, accel, magnet)
+            time.sleep(interval_sec)
+        if sample_count > 0:
+            self._gyro_bias = tuple(value / sample_count for value in gyro_sum)
+            self._epsilon = self._gyro_bias[2]
+            if not self._ahrs_initialized:
+                self._ahrs.initialize([value / sample_count for value in accel_sum], magnet)
+                if Imu.AHRS_YAW_REFERENCE_DEG is not None:
+                    self._yaw_reference = Imu.AHRS_YAW_REFERENCE_DEG
+                else:
+                    self._yaw_reference = self._ahrs.yaw()
+                self._ahrs_initialized = True
+                INFO('Imu AHRS initialized: yaw = ' + '{:.1f}'.format(self._ahrs.yaw()) +
+                     ', reference = ' + '{:.1f}'.format(self._yaw_reference) + ' [deg]')
+        self._pre_sample_time = None
+        DEBUG('Imu gyro bias = ', self._gyro_bias)
+
     def reset(self):
         self._degree = 0
     
@@ -57,32 +352,115 @@ class Imu:
     
     def calc_shortcut_degree(self, degree, one_round_value):
         return self.compress_degree_in_180(self.ignore_round(degree, one_round_value), one_round_value)
-    
+
+    # サンプルを積分する
+    # is_stopped : モータ値が両方0かどうか(止まっている間は補正値を更新する)
+    def integrate(self, samples, is_stopped=False):
+        for timestamp, z in samples:
+            if self._bias_estimator is not None and self._bias_estimator.update(timestamp, z, is_stopped):
+                self._epsilon = self._bias_estimator.bias
+            rate = z - self._epsilon
+            if self._mode == Imu.ACQUISITION_LEGACY:
+                self._degree += rate
+            elif self._pre_sample_time is not None:
+                dt = min(timestamp - self._pre_sample_time, Imu.MAX_SAMPLE_GAP_SEC)
+                if dt > 0:
+                    # 台形積分、_degreeは0.1度単位
+                    self._degree += (rate + self._pre_rate) / 2 * dt * 10
+            self._pre_sample_time = timestamp
+            self._pre_rate = rate
+            self._rate_sum += rate
+            self._rate_count += 1
+
+    # shmem : モータ値を読む共有メモリ(Noneの場合は補正値を更新しない)
+    @traced('Imu.sample')
+    def sample(self, shmem=None):
+        if self._ahrs is not None:
+            self.sample_ahrs()
+            return
+        is_stopped = shmem is not None and shmem.motorCommandLeft == 0 and shmem.motorCommandRight == 0
+        self.integrate(self.read_samples(), is_stopped)
+
+    # FIFOに溜まったサンプルでAHRSを更新し、方位を角度とする
+    def sample_ahrs(self):
+        magnet, timestamps, accel, gyro = self.read_block()
+        if len(timestamps) == 0:
+            return
+        gyro = gyro - self._gyro_bias
+        self._ahrs.update_block(timestamps, gyro, accel, magnet)
+        # ジャイロのみの場合と同じく反時計回りが正、0.1度単位
+        self._degree = ((self._ahrs.yaw() - self._yaw_reference + 180) % 360 - 180) * 10
+        rates = gyro[:, 2]
+        self._rate_sum += float(rates.sum())
+        self._rate_count += len(rates)
+        self._pre_rate = float(rates[-1])
+        self._pre_sample_time = float(timestamps[-1])
+
+    # どうやら10-20秒くらいで補正値を更新しないと、ドリフトの影響が無視出来なくなる
+    # リスタート準備中フラグが立っていたら、他のモジュールが待っていてくれているので、補正値の調整をする
+    # 補正が終わったらフラグをクリアして、他のモジュールに調整完了を知らせる
+    def calibrate_if_requested(self, shmem):
+        if shmem.preparingRestart:
+            INFO('calibrate IMU to prepare restart')
+            self.calibrate()
+            shmem.preparingRestart = False
+
+    @traced('Imu.publish')
+    def publish(self, shmem):
+        # 前回書き込んでからの平均の角速度
+        rate = self._rate_sum / self._rate_count if self._rate_count > 0 else self._pre_rate
+        self._rate_sum = 0
+        self._rate_count = 0
+        # 画像認識は右側正、左側負なので、そちらの挙動と合わせるために符号反転させる
+        self._sample_seq += 1
+        writeImu(shmem, ImuSnapshot(bodyAngle=-int(self.calc_shortcut_degree(self._degree, self.ONE_ROUND_VALUE)),
+                                    bodyRate=-rate,
+                                    sampleSeq=self._sample_seq,
+                                    publishTime=time.monotonic()))
+        if self._data_event is not None:
+            self._data_event.set()
+        DEBUG('bodyAngle = ', shmem.bodyAngle)
+
+    # 1回分の読み出し、積分、書き込み
+    def update(self, shmem):
+        self.calibrate_if_requested(shmem)
+        self.sample(shmem)
+        self.publish(shmem)
+
     def update_loop(self, shmem):
+        if self._mode == Imu.ACQUISITION_LEGACY:
+            while 1:
+                self.update(shmem)
+                time.sleep(self._update_interval_sec)
+        if self._mode == Imu.ACQUISITION_FIFO:
+            read_interval = Imu.FIFO_READ_INTERVAL_SEC
+        else:
+            read_interval = 1 / Imu.SAMPLE_RATE_HZ
+        publish_interval = 1 / Imu.OUTPUT_RATE_HZ
+        next_read_time = next_publish_time = time.monotonic()
         while 1:
-            # どうやら10-20秒くらいで補正値を更新しないと、ドリフトの影響が無視出来なくなる
-            # リスタート準備中フラグが立っていたら、他のモジュールが待っていてくれているので、補正値の調整をする
-            # 補正が終わったらフラグをクリアして、他のモジュールに調整完了を知らせる
-            if shmem.preparingRestart:
-                INFO('calibrate IMU to prepare restart')
-                self.calibrate()
-                shmem.preparingRestart = False
-            gyro = self._mpu9250.readGyro()
-            self._degree += gyro["z"] - self._epsilon
-            # 画像認識は右側正、左側負なので、そちらの挙動と合わせるために符号反転させる
-            shmem.bodyAngle = -int(self.calc_shortcut_degree(self._degree, self.ONE_ROUND_VALUE))
-            DEBUG('bodyAngle = ', shmem.bodyAngle)
-            time.sleep(self._update_interval_sec)
+            self.calibrate_if_requested(shmem)
+            try:
+                self.sample(shmem)
+            except OSError as e:
+                WARN('Imu read failed: ' + str(e))
+            now = time.monotonic()
+            if now >= next_publish_time:
+                self.publish(shmem)
+                # 遅れた場合は追いつこうとせずに次の周期から数え直す
+                next_publish_time = max(next_publish_time + publish_interval, now)
+            next_read_time = max(next_read_time + read_interval, now)
+            time.sleep(max(next_read_time - time.monotonic(), 0))
     
     def print_angle(self):
         while 1:
-            gyro = self._mpu9250.readGyro()
-            self._degree += gyro["z"] - self._epsilon
+            self.sample()
             DEBUG('bodyAngle = ', -int(self.calc_shortcut_degree(self._degree, self.ONE_ROUND_VALUE)))
             time.sleep(self._update_interval_sec)
     
     def target(self, shmem):
         DEBUG('Imu target() start')
+        setProcessName('imu')
         self.update_loop(shmem)
     
     def close(self):
@@ -0,0 +1,245 @@
+# coding: UTF-8
+
+import argparse
+import bisect
+import csv
+import math
+import random
+import imu
+from imu import Imu
+from sharedState import createSharedMemory, readImu
+
+"""
+
+replay test program for imu.py
+
+記録したジャイロのz軸の角速度(またはSPEED_SWING_ROTATEの首振りを模した合成データ)を仮想時計の上で再生し、
+Imu.update_loop()を各読み方(LEGACY、POLLING、FIFO)で動かして、最終的な角度の誤差を比べる。
+仮想時計のsleep()には実機と同じく揺らぎを入れる。
+また、補正値が少しずつずれていくデータ(動く、止まるを繰り返す)で、止まっている間の補正値の更新(GyroBiasEstimator)の有無を比べる。
+
+.. code-block:: bash
+
+    # 合成データで比較する
+    python3 imuReplayUnitTest.py
+    # 記録したデータで比較する(1行が 時刻[s],角速度[deg/s]、最初の3秒は静止していること)
+    python3 imuReplayUnitTest.py --trace gyro_trace.csv
+    # 実機でデータを記録する
+    python3 imuReplayUnitTest.py --record gyro_trace.csv --duration 20
+
+"""
+
+
+class ReplayFinished(Exception):
+    pass
+
+
+class ReplayClock:
+    # sleep()は待たずに時計を進め、jitter_sec以内の遅れを加える
+    # on_advance : 時計を進めた後に呼ぶ関数(引数は今の時刻)
+    def __init__(self, end_time, jitter_sec, rng, on_advance=None):
+        self.now = 0.0
+        self._end_time = end_time
+        self._jitter_sec = jitter_sec
+        self._rng = rng
+        self._on_advance = on_advance
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.now += max(sec, 0) + self._rng.uniform(0, self._jitter_sec)
+        if self.now >= self._end_time:
+            raise ReplayFinished()
+        if self._on_advance is not None:
+            self._on_advance(self.now)
+
+
+class ReplayGyro:
+    # 記録したデータを時計に合わせて返す(FaBo9Axis_MPU9250.MPU9250.readGyro()、Mpu9250Fifo.read()の代わり)
+    def __init__(self, trace, clock, fifo_rate_hz=500):
+        self._times = [timestamp for timestamp, rate in trace]
+        self._rates = [rate for timestamp, rate in trace]
+        self._clock = clock
+        self._fifo_period = 1 / fifo_rate_hz
+        self._fifo_time = 0.0
+
+    def _rateAt(self, timestamp):
+        index = max(bisect.bisect_right(self._times, timestamp) - 1, 0)
+        return self._rates[index]
+
+    def readGyro(self):
+        return {'x': 0, 'y': 0, 'z': self._rateAt(self._clock.now)}
+
+    def read(self):
+        samples = []
+        while self._fifo_time + self._fifo_period <= self._clock.now:
+            self._fifo_time += self._fifo_period
+            samples.append((self._fifo_time, self._rateAt(self._fifo_time)))
+        return samples
+
+
+def makeSwingTrace(duration, rate_hz=1000, bias=0.8, noise=0.3, seed=0):
+    """
+
+    synthesize a trace: 3 s still, then spins of SPEED_SWING_ROTATE alternating in direction
+
+    Returns:
+        list of (float, float): (time [s], gyro z [deg/s])
+
+    """
+    rng = random.Random(seed)
+    trace = []
+    for i in range(int(duration * rate_hz)):
+        t = i / rate_hz
+        if t < 3:
+            rate = 0
+        else:
+            # 約300deg/sで0.7秒毎に向きを変え、加減速は0.1秒
+            phase = (t - 3) % 1.4
+            direction = 1 if phase < 0.7 else -1
+            ramp = min(phase % 0.7, 0.7 - phase % 0.7, 0.1) / 0.1
+            rate = direction * 300 * ramp + 40 * math.sin(2 * math.pi * 7 * t)
+        trace.append((t, rate + bias + rng.gauss(0, noise)))
+    return trace
+
+
+def makeDriftTrace(duration, rate_hz=1000, noise=0.3, seed=0):
+    """
+
+    synthesize a trace whose bias drifts: 5 s still (longer than Imu.calibrate() with jitter), then 4 s turning and 2 s stopped repeatedly
+
+    Returns:
+        (list of (float, float), function, function): trace, true bias of time, whether the motors run at time
+
+    """
+    rng = random.Random(seed)
+
+    def bias_at(t):
+        # 温度変化を模して0.8deg/sから1分で2.0deg/sまでずれていく
+        return 0.8 + 0.02 * t
+
+    def is_moving(t):
+        return t >= 5 and (t - 5) % 6 < 4
+
+    trace = []
+    for i in range(int(duration * rate_hz)):
+        t = i / rate_hz
+        rate = 0
+        if is_moving(t):
+            # 90deg/sで旋回し、加減速は0.2秒
+            phase = (t - 5) % 6
+            rate = 90 * min(phase, 4 - phase, 0.2) / 0.2
+        trace.append((t, rate + bias_at(t) + rng.gauss(0, noise)))
+    return trace, bias_at, is_moving
+
+
+def loadTrace(path):
+    with open(path) as f:
+        return [(float(row[0]), float(row[1])) for row in csv.reader(f) if row and not row[0].startswith('#')]
+
+
+def trueBodyAngle(trace, bias, end_time):
+    # 記録の周期で積分した角度(Imu.bodyAngleと同じく0.1度単位、右回りが正、±1800に丸める)
+    # bias : 補正値[deg/s]、または時刻から補正値を返す関数
+    bias_at = bias if callable(bias) else (lambda t: bias)
+    degree = 0
+    for (t0, z0), (t1, z1) in zip(trace, trace[1:]):
+        if t1 > end_time:
+            break
+        degree += ((z0 + z1) / 2 - bias_at(t0)) * (t1 - t0) * 10
+    degree = -degree
+    return (degree + 1800) % 3600 - 1800
+
+
+# bias_at : 時刻から真の補正値を返す関数(Noneの場合は起動時に補正した値を真とする)
+# is_moving : 時刻からモータを回しているかを返す関数(共有メモリのモータ値に書く)
+def replay(trace, mode, jitter_sec, seed=0, bias_at=None, is_moving=None):
+    duration = trace[-1][0]
+    shmem = createSharedMemory()
+
+    def write_motor_commands(now):
+        command = 50 if is_moving is not None and is_moving(now) else 0
+        shmem.motorCommandLeft = command
+        shmem.motorCommandRight = command
+
+    clock = ReplayClock(duration, jitter_sec, random.Random(seed), write_motor_commands)
+    gyro = ReplayGyro(trace, clock)
+    original_time = imu.time
+    imu.time = clock
+    try:
+        sensor = Imu(mpu9250=gyro, fifo=gyro, mode=mode)
+        sensor.calibrate()
+        try:
+            sensor.update_loop(shmem)
+        except ReplayFinished:
+            pass
+        # 最後に読んだサンプルの時刻までの真値と比べる
+        sensor.publish(shmem)
+        return readImu(shmem), trueBodyAngle(trace, bias_at or sensor._epsilon, sensor._pre_sample_time)
+    finally:
+        imu.time = original_time
+
+
+def record(path, duration):
+    import time
+    from mpu9250Fifo import Mpu9250Fifo
+    fifo = Mpu9250Fifo()
+    fifo.start()
+    start_time = time.monotonic()
+    with open(path, 'w') as f:
+        f.write('# time [s], gyro z [deg/s]\n')
+        while time.monotonic() - start_time < duration:
+            for timestamp, rate in fifo.read():
+                f.write('{:.6f},{:.4f}\n'.format(timestamp - start_time, rate))
+            time.sleep(Imu.FIFO_READ_INTERVAL_SEC)
+    print('recorded ' + path + ', overflow = ' + str(fifo.overflow_count))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay gyro traces through Imu')
+    parser.add_argument('--trace', default=None, help='csv of time [s], gyro z [deg/s]')
+    parser.add_argument('--record', default=None, help='record a trace from the MPU9250 to this path')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--jitter', type=float, default=0.02, help='max sleep jitter [s]')
+    args = parser.parse_args()
+
+    if args.record is not None:
+        record(args.record, args.duration)
+    else:
+        def report(name, snapshot, expected):
+            # ±180度をまたぐ場合も差が小さくなるように丸める
+            error = abs((snapshot.bodyAngle - expected + 1800) % 3600 - 1800) / 10
+            print(name.ljust(8) + ': bodyAngle = ' + '{:7.1f}'.format(snapshot.bodyAngle / 10) +
+                  ', expected = ' + '{:7.1f}'.format(expected / 10) +
+                  ', error = ' + '{:6.1f}'.format(error) + ' [deg]' +
+                  ', publish = ' + str(snapshot.sampleSeq))
+            return error
+
+        trace = loadTrace(args.trace) if args.trace is not None else makeSwingTrace(args.duration)
+        # 記録したデータはモータ値が分からないので、最初の3秒以外は回しているものとする
+        is_swinging = (lambda t: t >= 3)
+        errors = {}
+        for name, mode in [('LEGACY', Imu.ACQUISITION_LEGACY),
+                           ('POLLING', Imu.ACQUISITION_POLLING),
+                           ('FIFO', Imu.ACQUISITION_FIFO)]:
+            snapshot, expected = replay(trace, mode, args.jitter, is_moving=is_swinging)
+            errors[name] = report(name, snapshot, expected)
+        assert errors['POLLING'] < errors['LEGACY'], errors
+        assert errors['FIFO'] < 2, errors
+
+        drift_trace, bias_at, is_moving = makeDriftTrace(60)
+        online_bias_estimation = Imu.ONLINE_BIAS_ESTIMATION
+        try:
+            for name, enabled in [('FIXED', False), ('ONLINE', True)]:
+                Imu.ONLINE_BIAS_ESTIMATION = enabled
+                snapshot, expected = replay(drift_trace, Imu.ACQUISITION_FIFO, args.jitter,
+                                            bias_at=bias_at, is_moving=is_moving)
+                errors[name] = report(name, snapshot, expected)
+        finally:
+            Imu.ONLINE_BIAS_ESTIMATION = online_bias_estimation
+        assert errors['ONLINE'] < errors['FIXED'] / 4, errors
+        print('replay: ok')
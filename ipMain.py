@@ -1,9 +1,12 @@
 # coding: UTF-8
 
-from multiprocessing import Process, Value
-from ctypes import Structure, c_int
+from multiprocessing import Process
 import os
+import sys
 from imageProcessing import ImageProcessing
+from previewStreamer import FrameShare, PreviewStreamer
+from frameSource import FileFrameSource
+from sharedState import createSharedMemory
 from debug import ERROR, WARN, INFO, DEBUG, TRACE
 
 
@@ -11,12 +14,14 @@ from debug import ERROR, WARN, INFO, DEBUG, TRACE
 
 test program for image processing
 
-"""
+画像ファイルのディレクトリを引数に指定すると、カメラの代わりにファイルから画像を読み込む
+
+.. code-block:: bash
 
+    python3 ipMain.py data/temp
+
+"""
 
-# 共有メモリの構造体
-class Point(Structure):
-    _fields_ = [('ballAngle', c_int), ('ballDis', c_int)]
 
 def info(title):
     INFO(title)
@@ -27,13 +32,26 @@ def info(title):
 if __name__ == '__main__':
     info('main line')
     # 共有メモリの準備
-    shmem = Value(Point, 0)
+    shmem = createSharedMemory()
     # 画像処理インスタンスの生成
     imageProcessing = ImageProcessing()
+    # プレビュー配信の準備(デバッグ用)
+    p_preview = None
+    if ImageProcessing.DEBUG_PREVIEW == ImageProcessing.ENABLE:
+        frameShare = FrameShare(max_fps=ImageProcessing.PREVIEW_MAX_FPS)
+        imageProcessing.setFrameShare(frameShare)
+        p_preview = Process(target=PreviewStreamer(frameShare).target, args=(shmem,))
+        p_preview.start()
+        DEBUG('p_preview started')
+
+    # 画像の取得元の準備
+    source = FileFrameSource(sys.argv[1]) if len(sys.argv) > 1 else None
 
-    p_imageProcessing = Process(target=imageProcessing.target, args=(shmem,))
+    p_imageProcessing = Process(target=imageProcessing.target, args=(shmem, source))
 
     p_imageProcessing.start()
     DEBUG('p_imageProcessing started')
 
     p_imageProcessing.join()
+    if p_preview is not None:
+        p_preview.terminate()
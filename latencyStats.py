@@ -0,0 +1,93 @@
+# coding: UTF-8
+
+import collections
+
+
+"""
+
+latency statistics module
+
+処理時間などの計測値を直近の一定数だけ保持し、パーセンタイルを計算する
+
+"""
+
+
+def percentile(sorted_values, p):
+    """
+
+    calculate percentile by linear interpolation
+
+    Args:
+        sorted_values (list) : values sorted in ascending order
+        p (float) : percentile [0-100]
+
+    Returns:
+        float: percentile value, 0 if sorted_values is empty
+
+    """
+    if len(sorted_values) == 0:
+        return 0
+    position = (len(sorted_values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class LatencyStats:
+    """
+
+    Collect samples and summarize them
+
+    Examples:
+        >>> stats = LatencyStats('process')
+        >>> stats.add(0.012)
+        >>> print(stats.format())
+        process: n=1 mean=12.00 p50=12.00 p90=12.00 p99=12.00 max=12.00 [ms]
+
+    Attributes:
+        name (str) : name shown in format()
+        _samples (collections.deque) : recent samples
+        _count (int) : number of samples added since the last clear()
+
+    """
+
+    def __init__(self, name, max_samples=1000):
+        self.name = name
+        self._samples = collections.deque(maxlen=max_samples)
+        self._count = 0
+
+    def add(self, value):
+        self._samples.append(value)
+        self._count += 1
+
+    def count(self):
+        return self._count
+
+    def clear(self):
+        self._samples.clear()
+        self._count = 0
+
+    def summary(self):
+        """
+
+        summarize recent samples
+
+        Returns:
+            dict: count, mean, p50, p90, p99, max
+
+        """
+        values = sorted(self._samples)
+        if len(values) == 0:
+            return {'count': self._count, 'mean': 0, 'p50': 0, 'p90': 0, 'p99': 0, 'max': 0}
+        return {'count': self._count,
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': values[-1]}
+
+    def format(self, unit='ms', scale=1000):
+        summary = self.summary()
+        return self.name + ': n=' + str(summary['count']) + ' ' + \
+            ' '.join(key + '=' + '{:.2f}'.format(summary[key] * scale) for key in ['mean', 'p50', 'p90', 'p99', 'max']) + \
+            ' [' + unit + ']'
@@ -1,13 +1,15 @@
 # coding: UTF-8
 
-from multiprocessing import Process, Value
-from ctypes import Structure, c_int, c_bool
+from multiprocessing import Event, Process
 import os
+from sharedState import createSharedMemory
 from motorContl import MotorController
 from imageProcessing import ImageProcessing
+from previewStreamer import FrameShare, PreviewStreamer
 from imu import Imu
 # from socketServer import Server
 from sound import Sound
+import sensorLog
 from debug import ERROR, WARN, INFO, DEBUG, TRACE
 
 """
@@ -17,15 +19,6 @@ main module
 """
 
 
-# 共有メモリの構造体
-class Point(Structure):
-    _fields_ = [('ballAngle', c_int), ('ballDis', c_int),
-                ('stationAngle', c_int), ('stationDis', c_int),
-                ('bodyAngle', c_int), ('preparingRestart', c_bool),
-                ('soundPhase', c_int),
-                ('wallX', c_int), ('wallSize', c_int)]
-
-
 def info(title):
     INFO(title)
     INFO('module name:', __name__)
@@ -36,16 +29,29 @@ def info(title):
 if __name__ == '__main__':
     info('main line')
     # 共有メモリの準備
-    shmem = Value(Point, 0)
-    shmem.preparingRestart = False
-    shmem.relyStation = False
-    shmem.soundPhase = 0
+    shmem = createSharedMemory()
+    # センサの記録を開始する(各プロセスは起動時にこのセッションのファイルを開く)
+    if sensorLog.RECORD_ENABLE:
+        sensorLog.startSession()
+    # 画像処理、IMUが新しい結果を書き込んだことをモータ制御に知らせる通知
+    dataEvent = Event()
+    # tuner.pyで調整したパラメータがあれば読み込む
+    MotorController.load_params()
     # モータ制御インスタンスの生成
     motorController = MotorController()
+    motorController.setDataEvent(dataEvent)
     # 画像処理インスタンスの生成
     imageProcessing = ImageProcessing()
+    imageProcessing.setDataEvent(dataEvent)
+    # プレビュー配信の準備(デバッグ用)
+    p_preview = None
+    if ImageProcessing.DEBUG_PREVIEW == ImageProcessing.ENABLE:
+        frameShare = FrameShare(max_fps=ImageProcessing.PREVIEW_MAX_FPS)
+        imageProcessing.setFrameShare(frameShare)
+        p_preview = Process(target=PreviewStreamer(frameShare).target, args=(shmem,))
     # 慣性計測インスタンスの生成
     imu = Imu()
+    imu.set_data_event(dataEvent)
     # スタート時に一度ジャイロセンサの補正をしておく
     imu.calibrate()
     # websocketサーバの生成
@@ -68,9 +74,14 @@ if __name__ == '__main__':
     # DEBUG('p_server started')
     p_sound.start()
     DEBUG('p_sound started')
+    if p_preview is not None:
+        p_preview.start()
+        DEBUG('p_preview started')
 
     p_motorContl.join()
     p_imageProcessing.join()
     p_imu.join()
     # p_server.join()
     p_sound.join()
+    if p_preview is not None:
+        p_preview.join()
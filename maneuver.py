@@ -0,0 +1,143 @@
+# coding: UTF-8
+
+import time
+from latencyStats import LatencyStats
+from debug import ERROR, WARN, INFO, DEBUG, TRACE
+
+
+"""
+
+maneuver module
+
+スタック回避や再スタート準備などの時間のかかる動作を、制御ループの1tick毎に少しずつ進める。
+
+動作はジェネレータ関数で書き、待ちたいところでyieldする。
+
+| yield 秒数         : 指定した時間が経つまで次のステップに進まない(0なら次のtick)
+| yield 関数         : 関数がTrueを返すまで次のステップに進まない
+
+待っている間も制御ループは回り続けるので、画像処理、IMUの結果を読み続け、途中で動作を中断できる。
+
+"""
+
+
+class ManeuverScheduler:
+    """
+
+    Run one maneuver at a time, a step per control tick
+
+    Examples:
+        >>> def escape():
+        >>>     motor.drive(-30)
+        >>>     yield 2
+        >>>     motor.drive(0)
+        >>> maneuvers = ManeuverScheduler()
+        >>> maneuvers.start('escape', escape(), abort=lambda vision: vision.stationDis != -1)
+        >>> while True:
+        >>>     vision = readVision(shmem)
+        >>>     if maneuvers.tick(vision):
+        >>>         continue
+        >>>     # 通常の制御
+
+    Attributes:
+        _stats (dict) : maneuver name -> LatencyStats of the duration [s]
+
+    """
+
+    def __init__(self):
+        self._name = None
+        self._steps = None
+        self._abort = None
+        self._wait_until = None
+        self._wait_condition = None
+        self._start_time = 0
+        self._stats = {}
+        self._aborted_counts = {}
+
+    def start(self, name, steps, abort=None):
+        """
+
+        start a maneuver, aborting the running one
+
+        Args:
+            name (str) : maneuver name for the log and statistics
+            steps (generator) : steps of the maneuver
+            abort (function) : called with the vision snapshot every tick, aborts the maneuver if it returns True
+
+        """
+        if self._steps is not None:
+            self.abort('replaced by ' + name)
+        INFO('maneuver ' + name + ' start')
+        self._name = name
+        self._steps = steps
+        self._abort = abort
+        self._wait_until = None
+        self._wait_condition = None
+        self._start_time = time.monotonic()
+
+    def is_running(self):
+        return self._steps is not None
+
+    def name(self):
+        return self._name if self._steps is not None else None
+
+    def abort(self, reason=''):
+        if self._steps is None:
+            return
+        INFO('maneuver ' + self._name + ' aborted: ' + reason)
+        self._steps.close()
+        self._aborted_counts[self._name] = self._aborted_counts.get(self._name, 0) + 1
+        self._finish()
+
+    def _finish(self):
+        elapsed = time.monotonic() - self._start_time
+        if self._name not in self._stats:
+            self._stats[self._name] = LatencyStats(self._name)
+        self._stats[self._name].add(elapsed)
+        DEBUG('maneuver ' + self._name + ' finished: ' + '{:.2f}'.format(elapsed) + ' [s]')
+        self._steps = None
+        self._abort = None
+
+    def tick(self, vision):
+        """
+
+        advance the running maneuver if its wait is over
+
+        Args:
+            vision (VisionSnapshot) : vision snapshot of this tick, passed to the abort condition
+
+        Returns:
+            bool: True if a maneuver is still running (the caller should not drive the motors in this tick)
+
+        """
+        if self._steps is None:
+            return False
+        if self._abort is not None and self._abort(vision):
+            self.abort('abort condition')
+            return False
+        if self._wait_until is not None and time.monotonic() < self._wait_until:
+            return True
+        if self._wait_condition is not None and not self._wait_condition():
+            return True
+        try:
+            wait = next(self._steps)
+        except StopIteration:
+            self._finish()
+            return False
+        if callable(wait):
+            self._wait_condition = wait
+            self._wait_until = None
+        else:
+            self._wait_condition = None
+            self._wait_until = time.monotonic() + wait
+        return True
+
+    def format(self):
+        """
+
+        Returns:
+            list of str: duration statistics of each maneuver
+
+        """
+        return ['maneuver ' + stats.format(unit='s', scale=1) + ', aborted = ' + str(self._aborted_counts.get(name, 0))
+                for name, stats in sorted(self._stats.items())]
@@ -1,7 +1,14 @@
 # coding: UTF-8
 
-import smbus
+import time
 from debug import ERROR, WARN, INFO, DEBUG, TRACE
+from spanTrace import span
+
+try:
+    import smbus
+except ImportError:
+    # Raspberry Pi以外の環境ではsmbusが無いので、busにfakeSmbus.FakeSMBusを渡して使う
+    smbus = None
 
 
 """
@@ -14,28 +21,110 @@ DataSeet:https://www.seeedstudio.com/Grove-I2C-Mini-Motor-Driver.html
 
 
 class MiniMotorDriver:
+    # レジスタ(DRV8830)
+    REG_CONTROL = 0x00
+    REG_FAULT = 0x01
+    # FAULTレジスタのビット
+    FAULT_CLEAR = 0x80
+    FAULT_FLAG = 0x01
+
+    # 書き込みモード
+    # WRITE_THROUGH  : 従来通り、drive()毎にフォルトをクリアしてから速度を書き込む
+    # WRITE_COALESCE : 前回書き込んだ値と同じ場合は書き込まない。
+    #                  フォルトはFAULT_CHECK_INTERVAL_SEC毎にFAULTレジスタを読み、立っている場合のみクリアする
+    WRITE_THROUGH = 0
+    WRITE_COALESCE = 1
+    WRITE_MODE = WRITE_COALESCE
+    # フォルトを確認する間隔[s]
+    FAULT_CHECK_INTERVAL_SEC = 0.5
+
     # @brief コンスタラクタ
     # @detail 初期化処理を行う
-    def __init__(self, addr):
+    # @param bus smbus.SMBusと同じメソッドを持つバス(Noneの場合はI2Cバス1を開く)
+    # @param write_mode WRITE_THROUGH or WRITE_COALESCE(Noneの場合はWRITE_MODE)
+    def __init__(self, addr, bus=None, write_mode=None, fault_check_interval_sec=None):
         TRACE('MiniMotorDriver generated')
-        self._i2c = smbus.SMBus(1)
+        if bus is None:
+            if smbus is None:
+                raise RuntimeError('smbus is not available')
+            bus = smbus.SMBus(1)
+        self._i2c = bus
         self._addr = addr
+        self._write_mode = write_mode if write_mode is not None else MiniMotorDriver.WRITE_MODE
+        self._fault_check_interval_sec = fault_check_interval_sec if fault_check_interval_sec is not None \
+            else MiniMotorDriver.FAULT_CHECK_INTERVAL_SEC
+        # 最後に書き込んだレジスタの値
+        self._reg_cache = {}
+        # 初回のdrive()でフォルトを確認する
+        self._fault_check_time = None
+        self.transaction_count = 0
+        self.skipped_count = 0
+        self.fault_count = 0
+
+    def _write(self, reg, value):
+        if self._write_mode == MiniMotorDriver.WRITE_COALESCE and self._reg_cache.get(reg) == value:
+            self.skipped_count += 1
+            return
+        self.transaction_count += 1
+        try:
+            self._i2c.write_byte_data(self._addr, reg, value)
+        except OSError:
+            # 書き込めたか分からないので、次回は必ず書き込む
+            self._reg_cache.pop(reg, None)
+            raise
+        self._reg_cache[reg] = value
+
+    def _read(self, reg):
+        self.transaction_count += 1
+        return self._i2c.read_byte_data(self._addr, reg)
+
+    def checkFault(self):
+        """
+
+        clear the fault if it is flagged
+
+        フォルトが起きるとドライバは出力を止めるので、速度レジスタのキャッシュも捨てて書き直させる
+
+        Returns:
+            bool: True if a fault was flagged
+
+        """
+        self._fault_check_time = time.monotonic()
+        fault = self._read(MiniMotorDriver.REG_FAULT)
+        if not fault & MiniMotorDriver.FAULT_FLAG:
+            return False
+        WARN('MiniMotorDriver fault: addr = ' + hex(self._addr) + ', fault = ' + hex(fault))
+        self.fault_count += 1
+        self.transaction_count += 1
+        self._i2c.write_byte_data(self._addr, MiniMotorDriver.REG_FAULT, MiniMotorDriver.FAULT_CLEAR)
+        self._reg_cache.pop(MiniMotorDriver.REG_CONTROL, None)
+        return True
 
     def drive(self, speed):
-        reg_value = 0x80
-        self._i2c.write_byte_data(self._addr, 0x01, 0x80)
-        reg_value = abs(int(speed))
-        if reg_value > 63:
-            reg_value = 63
-        reg_value = reg_value << 2
-        if speed < 0:
-            reg_value |= 0x01
-        else:
-            reg_value |= 0x02
-        self._i2c.write_byte_data(self._addr, 0x00, reg_value)
+        with span('MiniMotorDriver.drive', int(speed)):
+            if self._write_mode == MiniMotorDriver.WRITE_THROUGH:
+                self.transaction_count += 1
+                self._i2c.write_byte_data(self._addr, MiniMotorDriver.REG_FAULT, MiniMotorDriver.FAULT_CLEAR)
+            elif self._fault_check_time is None or \
+                    time.monotonic() - self._fault_check_time > self._fault_check_interval_sec:
+                self.checkFault()
+            reg_value = abs(int(speed))
+            if reg_value > 63:
+                reg_value = 63
+            reg_value = reg_value << 2
+            if speed < 0:
+                reg_value |= 0x01
+            else:
+                reg_value |= 0x02
+            self._write(MiniMotorDriver.REG_CONTROL, reg_value)
 
     def stop(self):
-        self._i2c.write_byte_data(self._addr, 0x00, 0x00)
+        self._write(MiniMotorDriver.REG_CONTROL, 0x00)
 
     def brake(self):
-        self._i2c.write_byte_data(self._addr, 0x00, 0x03)
+        self._write(MiniMotorDriver.REG_CONTROL, 0x03)
+
+    # @brief バスアクセス回数を文字列にする(ログ用)
+    def format(self):
+        return 'motor ' + hex(self._addr) + ': i2c transactions = ' + str(self.transaction_count) + \
+            ', skipped = ' + str(self.skipped_count) + ', faults = ' + str(self.fault_count)
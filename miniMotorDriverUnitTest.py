@@ -0,0 +1,73 @@
+# coding: UTF-8
+
+import miniMotorDriver
+from miniMotorDriver import MiniMotorDriver
+from fakeSmbus import FakeSMBus
+
+"""
+
+test program for mini motor driver
+
+FakeSMBusを使うので、I2Cデバイスがない環境でも実行できる。
+制御ループと同じように左右のモータへ100ms毎に速度を送り、
+WRITE_THROUGHとWRITE_COALESCEのバスアクセス回数を比べる。
+
+"""
+
+
+# 10秒分の左右のモータ値(同じ値が続く区間と、変化し続ける区間)
+def motorSpeeds():
+    for tick in range(100):
+        if tick < 40:
+            yield 45, 45
+        elif tick < 60:
+            yield 45 + (tick - 40), 45 - (tick - 40)
+        elif tick < 70:
+            yield 0, 0
+        else:
+            yield 100, -100
+
+
+# 実際に待たずに時間を進めるための時計
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+def run(write_mode):
+    clock = VirtualClock()
+    miniMotorDriver.time = clock
+    bus = FakeSMBus()
+    left_motor = MiniMotorDriver(0x65, bus=bus, write_mode=write_mode, fault_check_interval_sec=0.5)
+    right_motor = MiniMotorDriver(0x60, bus=bus, write_mode=write_mode, fault_check_interval_sec=0.5)
+    for left, right in motorSpeeds():
+        left_motor.drive(left)
+        right_motor.drive(right)
+        clock.now += 0.1
+    return bus, left_motor, right_motor
+
+
+if __name__ == '__main__':
+    for name, write_mode in [('write through', MiniMotorDriver.WRITE_THROUGH),
+                             ('coalesce', MiniMotorDriver.WRITE_COALESCE)]:
+        bus, left_motor, right_motor = run(write_mode)
+        print(name.ljust(14) + ': bus transactions = ' + str(bus.transaction_count()))
+        print('  ' + left_motor.format())
+        print('  ' + right_motor.format())
+        assert bus.transaction_count() == left_motor.transaction_count + right_motor.transaction_count
+
+    # フォルトが立ったらクリアして速度を書き直す
+    bus = FakeSMBus()
+    motor = MiniMotorDriver(0x65, bus=bus, write_mode=MiniMotorDriver.WRITE_COALESCE, fault_check_interval_sec=-1)
+    motor.drive(30)
+    bus.set_register(0x65, MiniMotorDriver.REG_FAULT, 0x03)
+    bus.set_register(0x65, MiniMotorDriver.REG_CONTROL, 0x00)
+    bus.clear()
+    motor.drive(30)
+    assert bus.transactions == [('read', 0x65, MiniMotorDriver.REG_FAULT, None),
+                                ('write', 0x65, MiniMotorDriver.REG_FAULT, MiniMotorDriver.FAULT_CLEAR),
+                                ('write', 0x65, MiniMotorDriver.REG_CONTROL, (30 << 2) | 0x02)]
+    print('fault clear: ok')
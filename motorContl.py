@@ -1,13 +1,22 @@
 # coding: UTF-8
 
+import json
+import os
 import time
 from enum import Enum
-from debug import ERROR, INFO, DEBUG, TRACE
+from debug import ERROR, WARN, INFO, DEBUG, TRACE, INFOF
 from miniMotorDriver import MiniMotorDriver
 from servo import Servo
-from gp2y0e import Gp2y0e
-import json
+from gp2y0e import Gp2y0e, Gp2y0eSampler
 from sound import SoundPhaseE
+from sharedState import readVision, readImu, ProducerMonitor, VISION_LOST
+from controlLoopTimer import ControlLoopTimer
+from latencyStats import LatencyStats
+from guideChannel import GuideReader, GUIDE_DEGREE_NONE
+from maneuver import ManeuverScheduler
+from i2cBus import I2cBusScheduler, PRIORITY_MOTOR, PRIORITY_SENSOR, PRIORITY_SERVO
+from spanTrace import traced, setProcessName
+from imu import Imu
 
 """
 
@@ -67,22 +76,92 @@ class MotorController:
     # 再スタート準備時の比例項の係数
     K_TURN_ANGLE = 1.5
 
+    # 画像処理結果が古い場合の扱い
+    # HOLD : 前回のモータ値を維持する
+    # SLOW : 計算したモータ値にSTALE_SPEED_RATIOを掛けて減速する
+    # LOST : 対象を見失ったものとして扱う
+    STALE_POLICY_HOLD = 0
+    STALE_POLICY_SLOW = 1
+    STALE_POLICY_LOST = 2
+    STALE_VISION_POLICY = STALE_POLICY_LOST
+    # 撮影からこの時間[s]以上経った画像処理結果は古いと判断する
+    MAX_VISION_AGE_SEC = 0.3
+    # SLOW時のモータ値の倍率
+    STALE_SPEED_RATIO = 0.5
+    # 画像処理、IMUの結果の経過時間と更新頻度をログに出す間隔[s]
+    PRODUCER_LOG_INTERVAL_SEC = 5
+    # モータ値をINFOでログに出す間隔[s](EVENTでは制御周期が短くなるので、tick毎には出さない)
+    MOTOR_LOG_INTERVAL_SEC = 0.1
+
+    # 制御ループの周期の決め方
+    # PERIODIC : CONTROL_MAX_PERIOD_SEC毎に制御する
+    # EVENT    : 画像処理、IMUの新しい結果が書き込まれたら制御する(setDataEvent()が必要)
+    # EVENTは実機で制御周期に依存する処理を確認するまでは使わない
+    CONTROL_LOOP_PERIODIC = ControlLoopTimer.PERIODIC
+    CONTROL_LOOP_EVENT = ControlLoopTimer.EVENT
+    CONTROL_LOOP_MODE = CONTROL_LOOP_PERIODIC
+    # 制御周期の最大値[s]、EVENTの場合は新しい結果が来なくてもこの時間で制御する(ウォッチドッグ)
+    CONTROL_MAX_PERIOD_SEC = 0.1
+    # 制御周期の最小値[s]、EVENTの場合に通知が続いてもこの時間は空ける
+    CONTROL_MIN_PERIOD_SEC = 0.02
+
+    # 距離センサを読む周期[Hz]と、中央値を取るサンプル数
+    DISTANCE_SAMPLE_RATE_HZ = 50
+    DISTANCE_FILTER_WINDOW = 5
+
+    # モータドライバ、距離センサ、サーボのバスアクセスをI2cBusSchedulerにまとめるかどうか
+    USE_I2C_BUS_SCHEDULER = True
+
+    # 再スタート準備でIMUの補正(Imu.calibrate())が終わるまで待つかどうか
+    # Imu.ONLINE_BIAS_ESTIMATIONが有効な場合は、止まっている間に補正値が更新されるので待たなくてよい
+    WAIT_IMU_CALIBRATION = not Imu.ONLINE_BIAS_ESTIMATION
+
+    # tuner.pyで調整したパラメータのファイル(load_params()で読み込む)
+    PARAMS_FILE = './motor_params.json'
+
     # コンストラクタ
-    def __init__(self):
+    # 各デバイスを渡した場合はハードウェアを開かずにそれを使う(simulator.pyなど)
+    # @param left_motor, right_motor MiniMotorDriverと同じdrive()を持つモータ
+    # @param servo Servoと同じup(), down(), is_lifting()を持つサーボ
+    # @param distanceSensor Gp2y0eSamplerと同じread(), start()を持つ距離センサ
+    # @param guideReader GuideReaderと同じread()を持つ誘導情報の読み出し
+    def __init__(self, left_motor=None, right_motor=None, servo=None, distanceSensor=None, guideReader=None):
         DEBUG('MotorController generated')
         # インスタンス変数初期化
         # ドリブル状態に入ったかを記憶する変数
         self.is_dribble_started = False
         # モータ制御後処理インスタンス生成
         self.motorControlPostProcessor = MotorControlPostProcessor()
-        self.motorControlPostProcessor.enable_escape_press_wall(speed=MotorController.SPEED_BACK)
-        # 距離センサ用インスタンス生成
-        self.distanceSensor = Gp2y0e(0x40)
+        self.motorControlPostProcessor.enable_escape_press_wall(
+            detect_time=MotorControlPostProcessor.PRESS_WALL_DETECT_TIME,
+            diff_angle=MotorControlPostProcessor.PRESS_WALL_DIFF_ANGLE,
+            back_time=MotorControlPostProcessor.PRESS_WALL_BACK_TIME,
+            speed=MotorController.SPEED_BACK)
+        # I2Cバスのスケジューラ生成(使わない場合は各ドライバがバスを開く)
+        self.i2cBus = None
+        motor_bus = sensor_bus = servo_i2c = None
+        is_all_given = None not in (left_motor, right_motor, servo, distanceSensor)
+        if MotorController.USE_I2C_BUS_SCHEDULER and not is_all_given:
+            self.i2cBus = I2cBusScheduler()
+            motor_bus = self.i2cBus.device(PRIORITY_MOTOR)
+            sensor_bus = self.i2cBus.device(PRIORITY_SENSOR)
+            servo_i2c = self.i2cBus.adafruitI2c(PRIORITY_SERVO)
+        # 距離センサ用インスタンス生成(バックグラウンドで読み続け、read()はキャッシュした中央値を返す)
+        if distanceSensor is None:
+            distanceSensor = Gp2y0eSampler(Gp2y0e(0x40, bus=sensor_bus),
+                                           rate_hz=MotorController.DISTANCE_SAMPLE_RATE_HZ,
+                                           window=MotorController.DISTANCE_FILTER_WINDOW)
+        self.distanceSensor = distanceSensor
         # モータドライバ制御用インスタンス生成
-        self.left_motor = MiniMotorDriver(0x65)
-        self.right_motor = MiniMotorDriver(0x60)
-        self.servo = Servo(0x41)
-        self.servo.up()
+        # 最後に送ったモータ値をtick毎に共有メモリに書き込むので、記録するモータ越しに送る
+        self.left_motor = MotorCommandRecorder(left_motor if left_motor is not None else MiniMotorDriver(0x65, bus=motor_bus))
+        self.right_motor = MotorCommandRecorder(right_motor if right_motor is not None else MiniMotorDriver(0x60, bus=motor_bus))
+        self.servo = servo if servo is not None else Servo(0x41, i2c=servo_i2c)
+        # 初期化(周波数設定のスリープ切り替え)は1つずつ待って書き込み、上げ下げのステップは待たずに溜めて後の書き込みで省略させる
+        if servo_i2c is not None:
+            servo_i2c.set_wait_writes(False)
+        # プロセス生成前に上げ終わっておく
+        self.servo.up().wait()
         # ボール追跡モード管理用インスタンス生成
         self.chaseBallMode = ChaseMode()
         # 動作状態初期化
@@ -90,6 +169,87 @@ class MotorController:
         # 壁付近走行中かどうか保持用変数初期化
         self._is_near_wall = False
         self._near_wall_start_time = time.time()
+        # 前回送信したモータ値
+        self._pre_motor_powers = MotorController.SPEED_STOP
+        # 画像処理結果が古いかどうか
+        self._is_vision_stale = False
+        # 画像処理、IMUの結果の経過時間と更新頻度の監視用
+        self._vision_monitor = ProducerMonitor('vision')
+        self._imu_monitor = ProducerMonitor('imu')
+        self._producer_log_time = time.monotonic()
+        self._motor_log_time = time.monotonic() - MotorController.MOTOR_LOG_INTERVAL_SEC
+        # 新しい結果の通知用(multiprocessing.Event)
+        self._data_event = None
+        # 制御周期の管理(calcAndSendMotorPowers()で生成する)
+        self._loop_timer = None
+        # 画像処理結果の公開からモータ値送信までの時間
+        self._reaction_stats = LatencyStats('vision->motor')
+        self._pre_vision_frame_seq = 0
+        # センターカメラからの誘導情報
+        self.guideReader = guideReader if guideReader is not None else GuideReader()
+        # 時間のかかる動作(捕獲、スタック回避、再スタート準備など)を制御ループの中で少しずつ進める
+        self.maneuvers = ManeuverScheduler()
+
+    @classmethod
+    def apply_params(cls, params):
+        """
+
+        overwrite the class constants of MotorController, ChaseMode and MotorControlPostProcessor
+
+        Args:
+            params (dict) : 'ClassName.CONSTANT_NAME' -> value
+
+        Returns:
+            dict: previous values of the overwritten constants (apply_params()に渡すと元に戻せる)
+
+        Note:
+            インスタンスを生成する前に呼ぶこと(ChaseMode、MotorControlPostProcessorは生成時の値を使う)
+
+        """
+        classes = {'MotorController': MotorController,
+                   'ChaseMode': ChaseMode,
+                   'MotorControlPostProcessor': MotorControlPostProcessor}
+        previous = {}
+        for key, value in params.items():
+            class_name, _, name = key.partition('.')
+            target = classes.get(class_name)
+            if target is None or not hasattr(target, name):
+                WARN('unknown motor parameter: ' + key)
+                continue
+            previous[key] = getattr(target, name)
+            setattr(target, name, value)
+        return previous
+
+    @classmethod
+    def load_params(cls, path=None):
+        """
+
+        load the parameters written by tuner.py
+
+        Returns:
+            bool: True if the file was loaded
+
+        """
+        path = path if path is not None else MotorController.PARAMS_FILE
+        if not os.path.exists(path):
+            DEBUG('motor params file not found: ' + path)
+            return False
+        try:
+            with open(path) as f:
+                params = json.load(f)['params']
+        except (OSError, ValueError, KeyError) as e:
+            ERROR('failed to load motor params: ' + str(e))
+            return False
+        MotorController.apply_params(params)
+        INFO('motor params loaded: ' + path)
+        for key, value in sorted(params.items()):
+            DEBUG(key + ' = ' + str(value))
+        return True
+
+    # 画像処理、IMUが新しい結果を書き込んだ時に立てる通知を設定する
+    # プロセス生成前に呼ぶこと
+    def setDataEvent(self, data_event):
+        self._data_event = data_event
 
     # 数値の絶対値を100に丸める
     def roundOffWithin100(self, num):
@@ -181,12 +341,14 @@ class MotorController:
             return MotorController.SPEED_STOP
     
     # モータの値を計算する
-    def calcMotorPowers(self, shmem, motion_status):
+    # visionはこのtickで読み出した画像処理結果のスナップショット
+    @traced('calcMotorPowers')
+    def calcMotorPowers(self, shmem, motion_status, vision):
         # 現在の状態に応じて追跡対象を変える
         if motion_status == MotionStateE.CHASE_BALL:
             TRACE('motion_status = CHASE_BALL')
-            if shmem.ballDis != -1:
-                return self.calcMotorPowersByBallAngle(shmem.ballAngle, MotorController.SPEED_CHASE, MotorController.K_CHASE_ANGLE)
+            if vision.ballDis != -1:
+                return self.calcMotorPowersByBallAngle(vision.ballAngle, MotorController.SPEED_CHASE, MotorController.K_CHASE_ANGLE)
             TRACE('shmem.ballDis is invalid value')
             if self.chaseBallMode.now() == ChaseMode.NORMAL:
                 TRACE('chaseBallMode = NORMAL')
@@ -196,45 +358,76 @@ class MotorController:
             return MotorController.SPEED_SWING_ROTATE
         elif motion_status == MotionStateE.GO_TO_STATION:
             TRACE('motion_status = GO_TO_STATION')
-            if shmem.stationDis != -1:
+            if vision.stationDis != -1:
                 shmem.soundPhase = SoundPhaseE.DETECT_STATION
-                return self.calcMotorPowersByBallAngle(shmem.stationAngle, MotorController.SPEED_CHASE, MotorController.K_CHASE_ANGLE)
+                return self.calcMotorPowersByBallAngle(vision.stationAngle, MotorController.SPEED_CHASE, MotorController.K_CHASE_ANGLE)
             TRACE('shmem.ballDis is invalid value')
-            # センターカメラから指令が来ていたらguide_info.jsonに有効な値が入っている
-            with open('./guide_info.json', mode='r') as f:
-                try:
-                    guide_info_json = json.load(f)
-                    guide_degree = guide_info_json.get('degree', 360)
-                    if guide_degree != 360:
-                        shmem.soundPhase = SoundPhaseE.RECV_CAMERA_INFO
-                        DEBUG('guide_degree = ' + str(guide_degree))
-                        # センターから停止命令が来ていたらモータ止める
-                        if guide_info_json.get('wait', False):
-                            DEBUG('recieved stop order!')
-                            return 0, 0
-                        return self.calcMotorPowersByBallAngle(-guide_degree, MotorController.SPEED_STATION_GUIDE,
-                                                               MotorController.K_STATION_GUIDE_ANGLE)
-                except json.JSONDecodeError:
-                    ERROR('faild to load guide_info.json')
+            # センターカメラから指令が来ていたら有効な値が入っている
+            guide = self.guideReader.read()
+            if guide.degree != GUIDE_DEGREE_NONE:
+                shmem.soundPhase = SoundPhaseE.RECV_CAMERA_INFO
+                DEBUG('guide_degree = ' + str(guide.degree))
+                # センターから停止命令が来ていたらモータ止める
+                if guide.wait:
+                    DEBUG('recieved stop order!')
+                    return 0, 0
+                return self.calcMotorPowersByBallAngle(-guide.degree, MotorController.SPEED_STATION_GUIDE,
+                                                       MotorController.K_STATION_GUIDE_ANGLE)
             body_angle = shmem.bodyAngle
-            return self.calcMotorPowersByBallAngle(body_angle / 10 - (body_angle / abs(body_angle) * 180), MotorController.SPEED_CHASE,
+            # 真正面(body_angle == 0)の場合は右回りで振り返る
+            half_round = 180 if body_angle >= 0 else -180
+            return self.calcMotorPowersByBallAngle(body_angle / 10 - half_round, MotorController.SPEED_CHASE,
                                                    MotorController.K_CHASE_ANGLE)
         # PREPARE_RETART
         TRACE('motion_status = PREPARE_RESTART')
         return (0, 0)
         # return self.calcMotorPowersByBallAngle(shmem.stationAngle)
     
+    # ボールを掴む(動作)
+    def capture_ball(self):
+        self.left_motor.drive(0)
+        self.right_motor.drive(0)
+        move = self.servo.down()
+        yield move.done
+        yield 1
+        self.motion_status = MotionStateE.GO_TO_STATION
+
+    # ステーションでボールを離す(動作)
+    def release_ball(self, shmem):
+        self.left_motor.drive(0)
+        self.right_motor.drive(0)
+        # ボールを離し終わってから下がる
+        move = self.servo.up()
+        yield move.done
+        # ステーションに向かっている間に追跡モードがどうなっているか分からないので、通常にリセットしておく
+        shmem.soundPhase = SoundPhaseE.DONE
+        self.chaseBallMode.set_mode(ChaseMode.NORMAL)
+        self.motion_status = MotionStateE.PREPARE_RESTART
+
+    # 再スタート準備(動作)
     def prepare_restart(self, shmem):
+        INFO('PREPARE RESTART start')
+        self.left_motor.drive(0)
+        self.right_motor.drive(0)
+        shmem.soundPhase = SoundPhaseE.PREPARE_RESTART
+        # IMUが止まっている間に補正値を更新し続けている場合は待たない
+        if MotorController.WAIT_IMU_CALIBRATION:
+            # IMUの補正が終わるまで待つ
+            shmem.preparingRestart = True
+            yield lambda: not shmem.preparingRestart
         self.left_motor.drive(-50)
         self.right_motor.drive(-50)
-        time.sleep(1)
+        yield 1
         while True:
             angle = shmem.bodyAngle / 10
             if abs(angle) < 30:
                 break
             self.left_motor.drive(MotorController.SPEED_TURN + MotorController.K_TURN_ANGLE * angle)
             self.right_motor.drive(-MotorController.SPEED_TURN - MotorController.K_TURN_ANGLE * angle)
-            time.sleep(0.1)
+            yield 0.1
+        self.chaseBallMode.set_mode(ChaseMode.NORMAL)
+        INFO('PREPARE RESTART end -> CHASE BALL')
+        self.motion_status = MotionStateE.CHASE_BALL
     
     def is_going_into_corner(self, wall_size):
         if wall_size == -1:
@@ -252,104 +445,190 @@ class MotorController:
                 self._is_near_wall = True
         return False
     
+    # 壁付近走行の判定をやり直す(隅から抜け出す動作の開始時と終了、中断時)
+    def reset_near_wall(self):
+        self._is_near_wall = False
+
+    # 隅から抜け出す(動作)
     def escape_from_corner(self, shmem):
         shmem.soundPhase = SoundPhaseE.DETECT_PRESS_WALL
         INFO('### escape from corner')
-        self.left_motor.drive(-MotorController.SPEED_BACK)
-        self.right_motor.drive(-MotorController.SPEED_BACK)
-        time.sleep(2)
-        if shmem.wallX > 0:
-            self.left_motor.drive(-100)
-            self.right_motor.drive(100)
-        else:
-            self.left_motor.drive(100)
-            self.right_motor.drive(-100)
-        time.sleep(1)
-        self.left_motor.drive(MotorController.SPEED_CHASE)
-        self.right_motor.drive(MotorController.SPEED_CHASE)
-        time.sleep(3)
+        try:
+            self.left_motor.drive(-MotorController.SPEED_BACK)
+            self.right_motor.drive(-MotorController.SPEED_BACK)
+            yield 2
+            if readVision(shmem).wallX > 0:
+                self.left_motor.drive(-100)
+                self.right_motor.drive(100)
+            else:
+                self.left_motor.drive(100)
+                self.right_motor.drive(-100)
+            yield 1
+            self.left_motor.drive(MotorController.SPEED_CHASE)
+            self.right_motor.drive(MotorController.SPEED_CHASE)
+            yield 3
+        finally:
+            # 中断された場合(ManeuverScheduler.abort()でclose()される)も、壁が見え始めた時刻から数え直す
+            # そうしないと、中断したtickで壁が見えたままなのですぐに動作をやり直してしまう
+            self.reset_near_wall()
     
-    # モータの値を計算しドライバへ送る
-    def calcAndSendMotorPowers(self, shmem):
-        self.chaseBallMode.set_mode(ChaseMode.NORMAL)
-        while 1:
-            if self.motion_status == MotionStateE.CHASE_BALL:
-                # ボール捕獲に移る
-                if 100 < shmem.ballDis < 160 and -20 < shmem.ballAngle < 20:
-                    INFO('capture ball')
-                    self.left_motor.drive(0)
-                    self.right_motor.drive(0)
-                    self.servo.down()
-                    time.sleep(1)
-                    self.motion_status = MotionStateE.GO_TO_STATION
-            elif self.motion_status == MotionStateE.GO_TO_STATION:
-                distanceSensorValue = self.distanceSensor.read()
-                DEBUG('distanceSensor = ' + str(distanceSensorValue))
-                # ボール消失してる
-                if distanceSensorValue > MotorController.DISTANCE_HAVE_BALL:
-                    INFO('lost ball')
-                    self.left_motor.drive(0)
-                    self.right_motor.drive(0)
-                    self.servo.up()
-                    # ステーションが見えている場合はステーションにボールを渡せたと判断して再スタートする
-                    if shmem.stationDis != -1:
-                        shmem.soundPhase = SoundPhaseE.DONE
-                        INFO('lost ball -> in station')
-                        self.chaseBallMode.set_mode(ChaseMode.NORMAL)
-                        self.motion_status = MotionStateE.PREPARE_RESTART
-                    self.motion_status = MotionStateE.CHASE_BALL
-                # TODO: ステーション到着後の動き
-                if 200 < shmem.stationDis < 310:
-                    INFO('reached station')
-                    self.left_motor.drive(0)
-                    self.right_motor.drive(0)
-                    self.servo.up()
-                    # ステーションに向かっている間に追跡モードがどうなっているか分からないので、通常にリセットしておく
+    # 画像処理結果を読み出し、古すぎる場合はSTALE_VISION_POLICYに従って扱う
+    def readFreshVision(self, shmem):
+        vision = readVision(shmem)
+        now = time.monotonic()
+        age = self._vision_monitor.update(vision.frameSeq, vision.captureTime, now)
+        imu = readImu(shmem)
+        self._imu_monitor.update(imu.sampleSeq, imu.publishTime, now)
+
+        # 一度も書き込まれていない場合も古いものとして扱う
+        is_stale = vision.frameSeq == 0 or age > MotorController.MAX_VISION_AGE_SEC
+        if is_stale != self._is_vision_stale:
+            INFO('vision stale' if is_stale else 'vision fresh', ': age =', int(age * 1000), '[ms]')
+            self._is_vision_stale = is_stale
+        if is_stale and MotorController.STALE_VISION_POLICY == MotorController.STALE_POLICY_LOST:
+            return VISION_LOST
+        return vision
+
+    # 新しい画像処理結果をモータ値に反映するまでの時間を記録し、定期的にログに出す
+    def recordReaction(self, vision):
+        now = time.monotonic()
+        if vision.frameSeq != 0 and vision.frameSeq != self._pre_vision_frame_seq:
+            self._reaction_stats.add(now - vision.publishTime)
+            self._pre_vision_frame_seq = vision.frameSeq
+        if now - self._producer_log_time > MotorController.PRODUCER_LOG_INTERVAL_SEC:
+            INFO(self._vision_monitor.format())
+            INFO(self._imu_monitor.format())
+            if self._loop_timer is None:
+                mode_name = 'external'
+            else:
+                mode_name = 'event' if self._loop_timer.mode() == ControlLoopTimer.EVENT else 'periodic'
+            INFO('control loop ' + mode_name + ' ' + self._reaction_stats.format())
+            self._reaction_stats.clear()
+            INFO(self.left_motor.format())
+            INFO(self.right_motor.format())
+            INFO(self.distanceSensor.format())
+            for line in self.maneuvers.format():
+                INFO(line)
+            if self.i2cBus is not None:
+                for line in self.i2cBus.format():
+                    INFO(line)
+            self._producer_log_time = now
+
+    # 画像処理結果が古い場合のモータ値を求める
+    def applyStalePolicy(self, motorPowers):
+        if not self._is_vision_stale:
+            return motorPowers
+        if MotorController.STALE_VISION_POLICY == MotorController.STALE_POLICY_HOLD:
+            return self._pre_motor_powers
+        elif MotorController.STALE_VISION_POLICY == MotorController.STALE_POLICY_SLOW:
+            return motorPowers[0] * MotorController.STALE_SPEED_RATIO, motorPowers[1] * MotorController.STALE_SPEED_RATIO
+        return motorPowers
+
+    # 状態遷移の判定、時間のかかる遷移は動作として開始する
+    def updateMotionStatus(self, shmem, vision):
+        if self.motion_status == MotionStateE.CHASE_BALL:
+            # ボール捕獲に移る
+            if 100 < vision.ballDis < 160 and -20 < vision.ballAngle < 20:
+                INFO('capture ball')
+                self.maneuvers.start('capture_ball', self.capture_ball())
+        elif self.motion_status == MotionStateE.GO_TO_STATION:
+            distanceSensorValue = self.distanceSensor.read()
+            DEBUG('distanceSensor = ' + str(distanceSensorValue))
+            # ボール消失してる
+            if distanceSensorValue > MotorController.DISTANCE_HAVE_BALL:
+                INFO('lost ball')
+                self.left_motor.drive(0)
+                self.right_motor.drive(0)
+                # ボールは持っていないので、上げている間も制御を続ける
+                self.servo.up()
+                # ステーションが見えている場合はステーションにボールを渡せたと判断して再スタートする
+                if vision.stationDis != -1:
                     shmem.soundPhase = SoundPhaseE.DONE
+                    INFO('lost ball -> in station')
                     self.chaseBallMode.set_mode(ChaseMode.NORMAL)
                     self.motion_status = MotionStateE.PREPARE_RESTART
-            elif self.motion_status == MotionStateE.PREPARE_RESTART:
-                INFO('PREPARE RESTART start')
-                self.left_motor.drive(0)
-                self.right_motor.drive(0)
-                shmem.preparingRestart = True
-                shmem.soundPhase = SoundPhaseE.PREPARE_RESTART
-                while(shmem.preparingRestart):
-                    time.sleep(0.1)
-                self.prepare_restart(shmem)
-                self.chaseBallMode.set_mode(ChaseMode.NORMAL)
-                INFO('PREPARE RESTART end -> CHASE BALL')
                 self.motion_status = MotionStateE.CHASE_BALL
-                continue
-                    
-            # モータ値計算
-            motorPowers = self.calcMotorPowers(shmem, self.motion_status)
-            # モーター値後処理(現在は首振り検知処理のみ)
-            # motorPowers = self.motorControlPostProcessor.escapeSwing(motorPowers)
-            # ステーションに戻るとき隅っこにハマる場合があるので、その時は中央に戻ることを試みる
-            if self.motion_status == MotionStateE.GO_TO_STATION and self.is_going_into_corner(shmem.wallSize):
-                self.escape_from_corner(shmem)
-            motorPowers = self.motorControlPostProcessor.run(motorPowers, shmem.bodyAngle / 10)
-            # ボール保持中じゃないのに前方近くに何かあったら後退して回避する
-            if self.servo.is_lifting() and self.distanceSensor.read() < MotorController.DISTANCE_STUCK:
-                INFO('### detect something barrier')
-                motorPowers = (-MotorController.SPEED_BACK, -MotorController.SPEED_BACK)
-            # モータ値を正常値にまるめる
-            motorPowers = self.roundOffMotorSpeeds(motorPowers)
-            # モータ値送信
-            self.left_motor.drive(motorPowers[0])
-            self.right_motor.drive(motorPowers[1])
-            # とりあえず一定時間間隔で動かす
-            INFO('motor r=' + str(motorPowers[0]).rjust(4) + ', l=' + str(motorPowers[1]).rjust(4),
-                 ',ball angle, distance=' + str(shmem.ballAngle).rjust(4) + ',' + str(shmem.ballDis).rjust(4),
-                 ',station angle, distance=' + str(shmem.stationAngle).rjust(4) + ',' + str(shmem.stationDis).rjust(4),
-                 ',body angle=' + str(shmem.bodyAngle / 10).rjust(4),
-                 )
-            time.sleep(0.1)
+            # TODO: ステーション到着後の動き
+            if 200 < vision.stationDis < 310:
+                INFO('reached station')
+                self.maneuvers.start('release_ball', self.release_ball(shmem))
+        elif self.motion_status == MotionStateE.PREPARE_RESTART:
+            self.maneuvers.start('prepare_restart', self.prepare_restart(shmem))
+
+    # 1tick分の制御(画像処理、IMUの結果を読み、モータ値を計算して送る)
+    @traced('MotorController.tick')
+    def tick(self, shmem):
+        self.controlStep(shmem)
+        # IMUが止まっている区間を判定できるように、このtickで最後に送ったモータ値を書き込む
+        shmem.motorCommandLeft = int(self.left_motor.speed)
+        shmem.motorCommandRight = int(self.right_motor.speed)
+
+    # 1tick分の制御の本体
+    def controlStep(self, shmem):
+        # 1フレーム分の画像処理結果をまとめて読み出す
+        vision = self.readFreshVision(shmem)
+        # 動作中は状態遷移の判定をしない
+        if not self.maneuvers.is_running():
+            self.updateMotionStatus(shmem, vision)
+        # 動作中はモータ値を動作に任せる
+        if self.maneuvers.tick(vision):
+            return
+
+        # モータ値計算
+        motorPowers = self.calcMotorPowers(shmem, self.motion_status, vision)
+        # モーター値後処理(現在は首振り検知処理のみ)
+        # motorPowers = self.motorControlPostProcessor.escapeSwing(motorPowers)
+        # ステーションに戻るとき隅っこにハマる場合があるので、その時は中央に戻ることを試みる
+        if self.motion_status == MotionStateE.GO_TO_STATION and self.is_going_into_corner(vision.wallSize):
+            # 抜け出す途中でステーションが見えたら中断してステーションに向かう
+            is_station_visible = vision.stationDis != -1
+            self.reset_near_wall()
+            self.maneuvers.start('escape_from_corner', self.escape_from_corner(shmem),
+                                 abort=lambda vision: not is_station_visible and vision.stationDis != -1)
+            self.maneuvers.tick(vision)
+            return
+        motorPowers = self.motorControlPostProcessor.run(motorPowers, shmem.bodyAngle / 10)
+        # ボール保持中じゃないのに前方近くに何かあったら後退して回避する
+        if self.servo.is_lifting() and self.distanceSensor.read() < MotorController.DISTANCE_STUCK:
+            INFO('### detect something barrier')
+            motorPowers = (-MotorController.SPEED_BACK, -MotorController.SPEED_BACK)
+        # 画像処理結果が古い場合の補正
+        motorPowers = self.applyStalePolicy(motorPowers)
+        # モータ値を正常値にまるめる
+        motorPowers = self.roundOffMotorSpeeds(motorPowers)
+        # モータ値送信
+        self.left_motor.drive(motorPowers[0])
+        self.right_motor.drive(motorPowers[1])
+        self._pre_motor_powers = motorPowers
+        # このtickで使った画像処理結果の反映時間を記録する
+        self.recordReaction(vision)
+        # 制御周期によらずMOTOR_LOG_INTERVAL_SEC毎に出力する(文字列の組み立てはdebugの書き出しスレッドに任せる)
+        now = time.monotonic()
+        if now - self._motor_log_time >= MotorController.MOTOR_LOG_INTERVAL_SEC:
+            self._motor_log_time = now
+            INFOF('motor r={!s:>4}, l={!s:>4} ,ball angle, distance={!s:>4},{!s:>4}'
+                  ' ,station angle, distance={!s:>4},{!s:>4} ,body angle={!s:>4}',
+                  motorPowers[0], motorPowers[1], vision.ballAngle, vision.ballDis,
+                  vision.stationAngle, vision.stationDis, shmem.bodyAngle / 10)
+
+    # モータの値を計算しドライバへ送る
+    def calcAndSendMotorPowers(self, shmem):
+        self.chaseBallMode.set_mode(ChaseMode.NORMAL)
+        self._loop_timer = ControlLoopTimer(MotorController.CONTROL_LOOP_MODE,
+                                            period_sec=MotorController.CONTROL_MAX_PERIOD_SEC,
+                                            min_period_sec=MotorController.CONTROL_MIN_PERIOD_SEC,
+                                            data_event=self._data_event)
+        while 1:
+            self.tick(shmem)
+            # 次の結果が来るまで(最大CONTROL_MAX_PERIOD_SEC)待つ
+            self._loop_timer.wait()
     
     # 起動処理
     def target(self, shmem):
         DEBUG('MotorController target() start')
+        setProcessName('motorContl')
+        # スレッドはfork後のプロセスで開始する
+        self.distanceSensor.start()
         self.calcAndSendMotorPowers(shmem)
 
     # 停止処理(仮)
@@ -367,6 +646,14 @@ class MotorControlPostProcessor:
     TIME_ESCAPE_FROM_SWING = 1
     # 首振り回避の際のモータの値
     SPEED_ESCAPE_FROM_SWING = 5, 5
+    # 壁押し付け検知時間[s]、旋回しようとしても角度が変わらない状態がこの時間続いたら壁に押し付けていると判断する
+    # 制御周期やIMUの更新周期によらないように、tick数ではなく時間で判定する
+    PRESS_WALL_DETECT_TIME = 1.0
+    # 壁押し付け検知角度閾値[deg]、PRESS_WALL_DETECT_TIMEの間の角度変化がこれより小さければ角度が変わっていないと判断する
+    # (従来の100ms周期で1tickあたり3度、10tick分に相当する)
+    PRESS_WALL_DIFF_ANGLE = 30
+    # 壁押し付け回避時の後退時間[s]
+    PRESS_WALL_BACK_TIME = 2
 
     def __init__(self):
         # 前回モータ値
@@ -382,6 +669,7 @@ class MotorControlPostProcessor:
         self._is_escape_press_wall = False
         TRACE('MotorControlPostProcessor generated')
     
+    @traced('MotorControlPostProcessor.run')
     def run(self, motorPowers, bodyAngle):
         if self._is_escape_press_wall:
             motorPowers = self.__escape_press_wall(motorPowers, bodyAngle)
@@ -390,12 +678,14 @@ class MotorControlPostProcessor:
         return motorPowers
     
     # TODO: スタック回避処理を別クラスにする
-    def enable_escape_press_wall(self, error_count=10, diff_angle=3, back_time=2, speed=30):
+    def enable_escape_press_wall(self, detect_time=1.0, diff_angle=30, back_time=2, speed=30):
         if self._is_escape_press_wall:
             return False
-        self._pw_error_count_limit = error_count
-        self._pw_error_count_now = 0
+        self._pw_detect_time = detect_time
         self._pw_diff_angle = diff_angle
+        # 旋回しようとし始めた時刻と角度(旋回しようとしていない間はNone)
+        self._pw_turn_start_time = None
+        self._pw_turn_start_angle = 0
         self._pw_back_time = back_time
         self._pw_speed = speed
         self._is_escape_press_wall = True
@@ -415,18 +705,25 @@ class MotorControlPostProcessor:
                 DEBUG('### END back for escape press wall')
                 self._pw_enable_force_back = False
                 # 壁押し付け状態判定用変数初期化
-                self._pw_error_count_now = 0
+                self._pw_turn_start_time = None
             TRACE('### CONTINUE back for escape press wall')
             return -self._pw_speed, -self._pw_speed
         # 旋回しようとしているかどうか
         # TODO: このパラメータも上位側で指定可能にする
-        if abs(self._pw_pre_power[0] - self._pw_pre_power[1]) > 50 and abs(self._pw_pre_body_angle - bodyAngle) < self._pw_diff_angle:
-            DEBUG('### pressing wall count +1')
-            self._pw_error_count_now += 1
-        else:
-            self._pw_error_count_now = 0
-        if self._pw_error_count_now >= self._pw_error_count_limit:
-            INFO('### detect pressing wall count')
+        if abs(self._pw_pre_power[0] - self._pw_pre_power[1]) <= 50:
+            self._pw_turn_start_time = None
+            return motorPowers
+        now = time.time()
+        if self._pw_turn_start_time is None:
+            # 前回のtickから旋回しようとしている
+            self._pw_turn_start_time = now
+            self._pw_turn_start_angle = self._pw_pre_body_angle
+        elif abs(self._pw_turn_start_angle - bodyAngle) >= self._pw_diff_angle:
+            # 回れているので、ここから判定し直す
+            self._pw_turn_start_time = now
+            self._pw_turn_start_angle = bodyAngle
+        elif now - self._pw_turn_start_time >= self._pw_detect_time:
+            INFO('### detect pressing wall')
             self._pw_enable_force_back = True
             self._pw_start_back_time = time.time()
             # 別にこの時はバックしなくてもいいかもしれないが一応
@@ -509,12 +806,15 @@ class ChaseMode:
     """
     NORMAL = 0
     SWING = 1
+    # 通常モード、首振りモードを続ける最大時間[s]
+    MAX_NORMAL_TIME_SEC = 10
+    MAX_SWING_TIME_SEC = 6
     
-    def __init__(self, max_normal_time_sec=10, max_swing_time_sec=6):
+    def __init__(self, max_normal_time_sec=None, max_swing_time_sec=None):
         self._mode = ChaseMode.NORMAL
         self._now_mode_start_time = time.time()
-        self._MAX_NORMAL_TIME_SEC = max_normal_time_sec
-        self._MAX_SWING_TIME_SEC = max_swing_time_sec
+        self._MAX_NORMAL_TIME_SEC = max_normal_time_sec if max_normal_time_sec is not None else ChaseMode.MAX_NORMAL_TIME_SEC
+        self._MAX_SWING_TIME_SEC = max_swing_time_sec if max_swing_time_sec is not None else ChaseMode.MAX_SWING_TIME_SEC
     
     def now(self):
         self.__update()
@@ -533,3 +833,33 @@ class ChaseMode:
             if time.time() - self._now_mode_start_time > self._MAX_SWING_TIME_SEC:
                 self._now_mode_start_time = time.time()
                 self._mode = ChaseMode.NORMAL
+
+
+class MotorCommandRecorder:
+    """
+
+    Motor wrapper remembering the last command
+
+    Attributes:
+        speed (float) : last speed sent by drive() (stop(), brake()の後は0)
+
+    """
+
+    def __init__(self, motor):
+        self._motor = motor
+        self.speed = 0
+
+    def drive(self, speed):
+        self.speed = speed
+        self._motor.drive(speed)
+
+    def stop(self):
+        self.speed = 0
+        self._motor.stop()
+
+    def brake(self):
+        self.speed = 0
+        self._motor.brake()
+
+    def format(self):
+        return self._motor.format()
@@ -0,0 +1,118 @@
+# coding: UTF-8
+
+import argparse
+import controlLoopTimer
+import debug
+import maneuver
+import motorContl
+import sharedState
+from motorContl import MotorController, MotionStateE
+from sharedState import VISION_LOST, createSharedMemory, writeVision
+from simulator import SimGuideReader, SimServo, VirtualClock
+
+"""
+
+test program for motorContl.py
+
+画像処理結果の列を仮想時計の上でMotorControllerに与え、状態遷移と動作の組み合わせを確認する。
+実機のデバイスは使わない。
+
+| escape : ステーションに戻る途中で壁が見え続けて隅から抜け出す動作を始め、その途中でステーションが見えたら、
+  動作を中断してステーションに向かう(抜け出す動作をやり直さない)。
+
+.. code-block:: bash
+
+    python3 motorContlUnitTest.py
+
+"""
+
+# 制御周期[s]
+TICK_SEC = 0.1
+
+
+class FakeMotor:
+    # 送られたモータ値を記録するだけのモータ
+    def __init__(self):
+        self.commands = []
+
+    def drive(self, speed):
+        self.commands.append(speed)
+
+    def stop(self):
+        self.drive(0)
+
+    def brake(self):
+        self.drive(0)
+
+    def format(self):
+        return 'fake motor: commands = ' + str(len(self.commands))
+
+
+class FakeDistanceSensor:
+    # ボールを持っている時の値を返し続ける距離センサ
+    def start(self):
+        pass
+
+    def read(self):
+        return MotorController.DISTANCE_HAVE_BALL - 1
+
+    def format(self):
+        return 'fake distance sensor'
+
+
+def makeController(clock):
+    clock.install([motorContl, maneuver, controlLoopTimer, sharedState])
+    shmem = createSharedMemory()
+    controller = MotorController(left_motor=FakeMotor(), right_motor=FakeMotor(), servo=SimServo(None, clock),
+                                 distanceSensor=FakeDistanceSensor(), guideReader=SimGuideReader())
+    controller.motion_status = MotionStateE.GO_TO_STATION
+    # IMUは動かさない(bodyAngleが変わらない)ので、旋回中に壁押し付けと判定されないようにする
+    controller.motorControlPostProcessor.disable_escape_press_wall()
+    return controller, shmem
+
+
+def step(controller, shmem, clock, frame_seq, **vision):
+    writeVision(shmem, VISION_LOST._replace(frameSeq=frame_seq, captureTime=clock.now, publishTime=clock.now, **vision))
+    controller.tick(shmem)
+    clock.now += TICK_SEC
+
+
+def testEscapeAbortedByStation():
+    clock = VirtualClock()
+    controller, shmem = makeController(clock)
+    try:
+        frame_seq = 0
+        # 生成時にサーボを上げ終わるまで時計が進むので、そこから数える
+        start_time = clock.now
+        # 壁が見え続けると、TIME_WALL_STUCK後に隅から抜け出す動作を始める
+        while controller.maneuvers.name() != 'escape_from_corner':
+            frame_seq += 1
+            step(controller, shmem, clock, frame_seq, wallX=-50, wallSize=100000)
+            assert clock.now - start_time < MotorController.TIME_WALL_STUCK + 1, 'escape did not start'
+        # 後退している途中でステーションが見える(壁も見えたまま)
+        for i in range(5):
+            frame_seq += 1
+            step(controller, shmem, clock, frame_seq, wallX=-50, wallSize=100000)
+        steering = []
+        for i in range(int(MotorController.TIME_WALL_STUCK / TICK_SEC) - 1):
+            frame_seq += 1
+            step(controller, shmem, clock, frame_seq, stationAngle=60, stationDis=150, wallX=-50, wallSize=100000)
+            # 抜け出す動作をやり直さず、ステーションに向かってモータ値を計算し続ける
+            assert not controller.maneuvers.is_running(), 'maneuver restarted: ' + str(controller.maneuvers.name())
+            assert controller.motion_status == MotionStateE.GO_TO_STATION
+            steering.append((controller.left_motor.speed, controller.right_motor.speed))
+        # ステーションは右側に見えているので右に曲がる(後退していない)
+        assert all(left > right and left + right > 0 for left, right in steering), steering
+    finally:
+        clock.uninstall()
+    print('escape: ok')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='scripted tests of MotorController')
+    parser.add_argument('--verbose', action='store_true', help='show INFO logs')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        debug.setDebugLevel(debug.DEBUG_LEVEL_WARN)
+    testEscapeAbortedByStation()
@@ -0,0 +1,189 @@
+# coding: UTF-8
+
+import time
+import numpy as np
+from debug import DEBUG, TRACE, INFO, WARN
+
+try:
+    import smbus
+except ImportError:
+    # Raspberry Pi以外の環境ではsmbusが無いので、busにfakeSmbus.FakeSMBusを渡して使う
+    smbus = None
+
+
+class Mpu9250Fifo:
+    """
+
+    MPU9250 gyro reader using the FIFO
+
+    MPU9250が一定周期(SAMPLE_RATE_HZ)でジャイロのz軸をFIFOに溜め、read()でまとめて読み出す。
+    読み出す間隔が多少ずれてもサンプルの間隔はMPU9250のクロックで決まるので、積分の精度が読み出し側の揺らぎに左右されない。
+    axes=AXES_ACCEL_GYROの場合は加速度とジャイロの3軸ずつを溜め、read_block()でNumPyの配列として読み出す(ahrs.MadgwickAhrs用)。
+
+    Examples:
+        >>> fifo = Mpu9250Fifo()
+        >>> fifo.start()
+        >>> for timestamp, rate in fifo.read():
+        >>>     print(timestamp, rate)
+        >>> fifo = Mpu9250Fifo(axes=Mpu9250Fifo.AXES_ACCEL_GYRO, sample_rate_hz=200)
+        >>> fifo.start()
+        >>> timestamps, accel, gyro = fifo.read_block()
+
+    Attributes:
+        _address (int) : slave address
+        _bus (smbus.SMBus) : i2c bus, or a compatible one (i2cBus.I2cBusProxy, fakeSmbus.FakeSMBus)
+        overflow_count (int) : number of FIFO overflows (読み出しが遅れてサンプルを失った回数)
+
+    """
+
+    # レジスタ
+    REG_SMPLRT_DIV = 0x19
+    REG_CONFIG = 0x1A
+    REG_GYRO_CONFIG = 0x1B
+    REG_ACCEL_CONFIG = 0x1C
+    REG_ACCEL_CONFIG2 = 0x1D
+    REG_FIFO_EN = 0x23
+    REG_INT_STATUS = 0x3A
+    REG_USER_CTRL = 0x6A
+    REG_PWR_MGMT_1 = 0x6B
+    REG_FIFO_COUNTH = 0x72
+    REG_FIFO_R_W = 0x74
+    # レジスタのビット
+    FIFO_EN_GYRO_XOUT = 0x40
+    FIFO_EN_GYRO_YOUT = 0x20
+    FIFO_EN_GYRO_ZOUT = 0x10
+    FIFO_EN_ACCEL = 0x08
+    USER_CTRL_FIFO_EN = 0x40
+    USER_CTRL_FIFO_RST = 0x04
+    INT_STATUS_FIFO_OVERFLOW = 0x10
+    # DLPF 184Hz(内部サンプリング1kHz)
+    DLPF_CFG = 0x01
+    # ±250dps、1[deg/s]あたりの値
+    GYRO_FS_SEL = 0x00
+    GYRO_SENSITIVITY = 131.0
+    # ±2g、1[g]あたりの値、加速度のDLPF 41Hz
+    ACCEL_FS_SEL = 0x00
+    ACCEL_SENSITIVITY = 16384.0
+    ACCEL_DLPF_CFG = 0x03
+
+    # FIFOに溜める軸(ジャイロのz軸のみ、加速度とジャイロの3軸ずつ)
+    AXES_GYRO_Z = 0
+    AXES_ACCEL_GYRO = 1
+
+    # FIFOに溜める周期[Hz](1000 / (1 + SMPLRT_DIV))
+    SAMPLE_RATE_HZ = 500
+    # FIFOの大きさ[byte]と1サンプルの大きさ[byte](AXES_GYRO_Z、AXES_ACCEL_GYRO)
+    # AXES_ACCEL_GYROの場合は42サンプルしか溜められないので、200Hzなら約0.2秒以内に読み出す
+    FIFO_SIZE = 512
+    SAMPLE_SIZE = 2
+    ACCEL_GYRO_SAMPLE_SIZE = 12
+    # SMBusの1回のブロック読み出しの最大長[byte]
+    MAX_BLOCK_LENGTH = 32
+
+    # axes : AXES_GYRO_Z, AXES_ACCEL_GYRO
+    def __init__(self, address=0x68, bus=None, sample_rate_hz=None, axes=AXES_GYRO_Z):
+        TRACE('Mpu9250Fifo generated: address = ' + str(address))
+        if bus is None:
+            if smbus is None:
+                raise RuntimeError('smbus is not available')
+            bus = smbus.SMBus(1)
+        self._bus = bus
+        self._address = address
+        self._divider = max(int(round(1000 / (sample_rate_hz or Mpu9250Fifo.SAMPLE_RATE_HZ))) - 1, 0)
+        self.sample_rate_hz = 1000 / (1 + self._divider)
+        self.overflow_count = 0
+        self._axes = axes
+        if axes == Mpu9250Fifo.AXES_ACCEL_GYRO:
+            self._sample_size = Mpu9250Fifo.ACCEL_GYRO_SAMPLE_SIZE
+            self._fifo_enable = (Mpu9250Fifo.FIFO_EN_ACCEL | Mpu9250Fifo.FIFO_EN_GYRO_XOUT |
+                                 Mpu9250Fifo.FIFO_EN_GYRO_YOUT | Mpu9250Fifo.FIFO_EN_GYRO_ZOUT)
+        else:
+            self._sample_size = Mpu9250Fifo.SAMPLE_SIZE
+            self._fifo_enable = Mpu9250Fifo.FIFO_EN_GYRO_ZOUT
+
+    def start(self):
+        bus = self._bus
+        address = self._address
+        # スリープ解除、クロックはジャイロのPLL
+        bus.write_byte_data(address, Mpu9250Fifo.REG_PWR_MGMT_1, 0x01)
+        bus.write_byte_data(address, Mpu9250Fifo.REG_CONFIG, Mpu9250Fifo.DLPF_CFG)
+        bus.write_byte_data(address, Mpu9250Fifo.REG_SMPLRT_DIV, self._divider)
+        bus.write_byte_data(address, Mpu9250Fifo.REG_GYRO_CONFIG, Mpu9250Fifo.GYRO_FS_SEL << 3)
+        bus.write_byte_data(address, Mpu9250Fifo.REG_ACCEL_CONFIG, Mpu9250Fifo.ACCEL_FS_SEL << 3)
+        bus.write_byte_data(address, Mpu9250Fifo.REG_ACCEL_CONFIG2, Mpu9250Fifo.ACCEL_DLPF_CFG)
+        bus.write_byte_data(address, Mpu9250Fifo.REG_FIFO_EN, self._fifo_enable)
+        self.reset()
+        INFO('Mpu9250Fifo started: sample rate = ' + str(self.sample_rate_hz) + ' [Hz]')
+
+    def reset(self):
+        self._bus.write_byte_data(self._address, Mpu9250Fifo.REG_USER_CTRL, Mpu9250Fifo.USER_CTRL_FIFO_RST)
+        self._bus.write_byte_data(self._address, Mpu9250Fifo.REG_USER_CTRL, Mpu9250Fifo.USER_CTRL_FIFO_EN)
+
+    def _read_raw(self):
+        # FIFOに溜まっている全サンプルのバイト列を読み出す(読み出し時刻、サンプル数、バイト列)
+        bus = self._bus
+        address = self._address
+        now = time.monotonic()
+        # 溢れていた場合は途中のサンプルが失われているので捨てて読み直す
+        if bus.read_byte_data(address, Mpu9250Fifo.REG_INT_STATUS) & Mpu9250Fifo.INT_STATUS_FIFO_OVERFLOW:
+            self.overflow_count += 1
+            WARN('Mpu9250Fifo overflow: count = ' + str(self.overflow_count))
+            self.reset()
+            return now, 0, []
+        high, low = bus.read_i2c_block_data(address, Mpu9250Fifo.REG_FIFO_COUNTH, 2)
+        # 書き込み途中のサンプルは次回に読む
+        count = ((high << 8) | low) // self._sample_size
+        data = []
+        remaining = count * self._sample_size
+        while remaining > 0:
+            # サンプルの途中で区切らないように、ブロックの長さをサンプルの大きさの倍数にする
+            length = min(remaining, Mpu9250Fifo.MAX_BLOCK_LENGTH // self._sample_size * self._sample_size)
+            data += bus.read_i2c_block_data(address, Mpu9250Fifo.REG_FIFO_R_W, length)
+            remaining -= length
+        DEBUG('Mpu9250Fifo samples = ' + str(count))
+        return now, count, data
+
+    def read(self):
+        """
+
+        read all samples in the FIFO (AXES_GYRO_Z)
+
+        Returns:
+            list of (float, float): (timestamp (time.monotonic()), gyro z [deg/s]) in order
+
+        Raises:
+            OSError: i2c error
+
+        """
+        if self._axes != Mpu9250Fifo.AXES_GYRO_Z:
+            timestamps, accel, gyro = self.read_block()
+            return list(zip(timestamps.tolist(), gyro[:, 2].tolist()))
+        now, count, data = self._read_raw()
+        period = 1 / self.sample_rate_hz
+        samples = []
+        for i in range(count):
+            value = (data[2 * i] << 8) | data[2 * i + 1]
+            if value >= 0x8000:
+                value -= 0x10000
+            # 最後のサンプルを読み出し時刻とし、それより前はサンプル周期ずつ遡る
+            samples.append((now - (count - 1 - i) * period, value / Mpu9250Fifo.GYRO_SENSITIVITY))
+        return samples
+
+    def read_block(self):
+        """
+
+        read all samples in the FIFO (AXES_ACCEL_GYRO)
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): timestamps (N), accel (N x 3) [g], gyro (N x 3) [deg/s]
+
+        Raises:
+            OSError: i2c error
+
+        """
+        now, count, data = self._read_raw()
+        # 1サンプルはACCEL_XOUT..ACCEL_ZOUT、GYRO_XOUT..GYRO_ZOUT(ビッグエンディアン)の順
+        values = np.frombuffer(bytes(data), dtype='>i2').reshape(count, 6).astype(np.float64)
+        timestamps = now - np.arange(count - 1, -1, -1) / self.sample_rate_hz
+        return (timestamps, values[:, 0:3] / Mpu9250Fifo.ACCEL_SENSITIVITY,
+                values[:, 3:6] / Mpu9250Fifo.GYRO_SENSITIVITY)
@@ -0,0 +1,263 @@
+# coding: UTF-8
+
+import threading
+import time
+from ctypes import Structure, c_int, c_uint, c_uint8, c_double
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import RawArray, RawValue
+from socketserver import ThreadingMixIn
+import cv2
+import numpy as np
+from imageProcessing import ImageProcessing
+from sharedState import readVision
+from debug import ERROR, WARN, INFO, DEBUG, TRACE
+
+
+"""
+
+preview streamer module
+
+画像処理プロセスが共有メモリに書き込んだ最新の画像と検知結果を読み出し、
+検知結果の描画、マスク画像の生成を画像処理プロセスの外で行って、localhostにMJPEGで配信する。
+
+ブラウザで http://localhost:8080/ を開くと表示される。
+
+"""
+
+
+# プレビューに載せる色(FrameHeaderの配列の並び順)
+PREVIEW_COLORS = ['RED', 'YELLOW', 'BLUE', 'GREEN', 'BLACK']
+
+
+# 共有メモリ上の画像のヘッダ
+class FrameHeader(Structure):
+    _fields_ = [('seq', c_uint), ('frameSeq', c_uint), ('captureTime', c_double),
+                ('cx', c_int * len(PREVIEW_COLORS)), ('cy', c_int * len(PREVIEW_COLORS)),
+                ('area', c_double * len(PREVIEW_COLORS))]
+
+
+class FrameShare:
+    """
+
+    Latest frame and detections shared from the vision process
+
+    画像処理プロセスだけが書き込む(seqlock)。書き込みはmax_fpsに間引く。
+
+    Examples:
+        >>> frameShare = FrameShare()
+        >>> # 画像処理プロセス
+        >>> frameShare.publish(frame, frame_seq, capture_time, detections)
+        >>> # プレビュープロセス
+        >>> frame, frame_seq, capture_time, detections = frameShare.read()
+
+    """
+
+    def __init__(self, resolution=(480, 480), max_fps=5):
+        width, height = resolution
+        self._shape = (height, width, 3)
+        self._header = RawValue(FrameHeader)
+        self._pixels = RawArray(c_uint8, height * width * 3)
+        self._interval_sec = 1 / max_fps
+        self._last_publish_time = 0
+
+    def _view(self):
+        return np.frombuffer(self._pixels, dtype=np.uint8).reshape(self._shape)
+
+    def publish(self, frame, frame_seq, capture_time, detections):
+        """
+
+        copy the frame and detections if the rate limit allows
+
+        Returns:
+            bool: True if published
+
+        """
+        now = time.monotonic()
+        if now - self._last_publish_time < self._interval_sec:
+            return False
+        self._last_publish_time = now
+        header = self._header
+        seq = header.seq
+        header.seq = seq + 1
+        np.copyto(self._view(), frame)
+        header.frameSeq = frame_seq
+        header.captureTime = capture_time
+        for index, color_name in enumerate(PREVIEW_COLORS):
+            cx, cy, area_size, convex = detections.get(color_name, (-1, -1, 0.0, []))
+            header.cx[index] = cx
+            header.cy[index] = cy
+            header.area[index] = area_size
+        header.seq = seq + 2
+        return True
+
+    def read(self):
+        """
+
+        Returns:
+            tuple: (frame copy, frame_seq, capture_time, detections), None if nothing has been published.
+            detections maps color name to (cx, cy, area_size).
+
+        """
+        frame = np.empty(self._shape, dtype=np.uint8)
+        header = self._header
+        while True:
+            seq = header.seq
+            if seq == 0:
+                return None
+            if not seq & 1:
+                np.copyto(frame, self._view())
+                frame_seq = header.frameSeq
+                capture_time = header.captureTime
+                detections = {color_name: (header.cx[index], header.cy[index], header.area[index])
+                              for index, color_name in enumerate(PREVIEW_COLORS)}
+                if header.seq == seq:
+                    return frame, frame_seq, capture_time, detections
+            time.sleep(0.001)
+
+
+# @brief 十字マーカーを描画する
+# @param x 十字マーカーのx座標
+# @param y 十字マーカーのy座標
+# @param marker_color 十字マーカーの色
+def drawMarker(img, x, y, marker_color):
+    cv2.line(img, (x - 7, y), (x + 7, y), color=(255, 255, 255), thickness=2)
+    cv2.line(img, (x, y - 7), (x, y + 7), color=(255, 255, 255), thickness=2)
+    cv2.line(img, (x - 7, y), (x + 7, y), color=marker_color, thickness=1)
+    cv2.line(img, (x, y - 7), (x, y + 7), color=marker_color, thickness=1)
+
+
+# @brief 画像に画面中心線と検知結果を描画する
+# @param frame 描画対象の画像(上書きする)
+# @param detections 色の名前をキー、(cx, cy, area_size) を値とする辞書
+# @return 画角の前後左右と表示の上下左右を揃えるために反転した画像
+def annotateFrame(frame, detections):
+    height, width = frame.shape[:2]
+    cv2.line(frame, (ImageProcessing.CAMERA_CENTER_CX, 0), (ImageProcessing.CAMERA_CENTER_CX, height),
+             (0, 0, 255), thickness=1)
+    cv2.line(frame, (0, ImageProcessing.CAMERA_CENTER_CY), (width, ImageProcessing.CAMERA_CENTER_CY),
+             (0, 0, 255), thickness=1)
+    for color_name, detection in detections.items():
+        cx, cy = detection[0], detection[1]
+        if cx > -1:
+            drawMarker(frame, cx, cy, ImageProcessing.MARKER_COLORS[color_name])
+    return cv2.flip(frame, -1)
+
+
+# @brief 色ごとのマスク画像を並べた画像を生成する
+# @param imageProcessing マスク生成に使う画像処理インスタンス
+# @param frame 元画像
+# @param colors マスクを生成する色の名前のリスト
+def renderMasks(imageProcessing, frame, colors):
+    hsv_img = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    height, width = frame.shape[:2]
+    tiles = []
+    for color_name in colors:
+        mask = cv2.flip(imageProcessing.makeColorMask(hsv_img, color_name), -1)
+        tile = cv2.cvtColor(cv2.resize(mask, (width // 2, height // 2)), cv2.COLOR_GRAY2BGR)
+        cv2.putText(tile, color_name, (5, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+        tiles.append(tile)
+    return cv2.hconcat(tiles)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PreviewStreamer:
+    """
+
+    Serve the annotated frame and masks as MJPEG streams on localhost
+
+    Examples:
+        >>> streamer = PreviewStreamer(frameShare)
+        >>> p_preview = Process(target=streamer.target, args=(shmem,))
+
+    """
+
+    BOUNDARY = 'previewframe'
+
+    def __init__(self, frameShare, port=8080, max_fps=5, jpeg_quality=70):
+        self._frameShare = frameShare
+        self._port = port
+        self._interval_sec = 1 / max_fps
+        self._jpeg_quality = jpeg_quality
+        self._lock = threading.Lock()
+        self._cache_frame_seq = None
+        self._cache = {}
+        self._imageProcessing = None
+        self._shmem = None
+        TRACE('PreviewStreamer generated')
+
+    def render(self, kind):
+        """
+
+        get the latest JPEG of 'frame' or 'mask', rendered at most once per frame
+
+        Returns:
+            bytes: JPEG data, None if no frame has been published
+
+        """
+        with self._lock:
+            shared = self._frameShare.read()
+            if shared is None:
+                return None
+            frame, frame_seq, capture_time, detections = shared
+            if frame_seq != self._cache_frame_seq:
+                self._cache = {}
+                self._cache_frame_seq = frame_seq
+            if kind not in self._cache:
+                if kind == 'mask':
+                    image = renderMasks(self._imageProcessing, frame, self._imageProcessing.DETECT_COLORS)
+                else:
+                    image = annotateFrame(frame, detections)
+                    vision = readVision(self._shmem)
+                    cv2.putText(image, 'ball ' + str(vision.ballAngle) + ',' + str(vision.ballDis) +
+                                ' station ' + str(vision.stationAngle) + ',' + str(vision.stationDis),
+                                (5, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+                _, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self._jpeg_quality])
+                self._cache[kind] = jpeg.tobytes()
+            return self._cache[kind]
+
+    def _make_handler(self):
+        streamer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/':
+                    body = b'<html><body><img src="/frame"><br><img src="/mask"></body></html>'
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/html')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                if self.path not in ['/frame', '/mask']:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + streamer.BOUNDARY)
+                self.end_headers()
+                try:
+                    while True:
+                        jpeg = streamer.render(self.path[1:])
+                        if jpeg is not None:
+                            self.wfile.write(b'--' + streamer.BOUNDARY.encode() + b'\r\n')
+                            self.wfile.write(b'Content-Type: image/jpeg\r\n')
+                            self.wfile.write(b'Content-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n')
+                            self.wfile.write(jpeg + b'\r\n')
+                        time.sleep(streamer._interval_sec)
+                except (BrokenPipeError, ConnectionResetError):
+                    DEBUG('preview client left')
+
+            def log_message(self, format, *args):
+                DEBUG('preview: ' + format % args)
+
+        return Handler
+
+    def target(self, shmem):
+        DEBUG('PreviewStreamer target() start')
+        self._shmem = shmem
+        self._imageProcessing = ImageProcessing()
+        server = _ThreadingHTTPServer(('127.0.0.1', self._port), self._make_handler())
+        INFO('preview: http://localhost:' + str(self._port) + '/')
+        server.serve_forever()
@@ -0,0 +1,269 @@
+# coding: UTF-8
+
+import argparse
+import math
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from ctypes import Structure, c_char, c_uint, c_uint64, sizeof
+from debug import INFO, WARN
+from sharedState import VisionSnapshot
+
+
+"""
+
+sensor log module
+
+試合中にIMU(ジャイロ、加速度、磁気センサ)、距離センサ、画像処理結果を記録し、後からsensorReplay.pyで再生できるようにする。
+
+| 記録は1セッション(main.pyの1回の起動)毎のディレクトリに、種類毎のファイル(imu.log, distance.log, vision.log)として残す。
+| 各ファイルは書き込むプロセス、スレッドが1つだけなので、ロックなしで追記する。
+| ファイルは64byteのヘッダと、64byte固定長のレコードの並び。mmapした領域にstruct.pack_into()で直接書き込む。
+| ヘッダのcountはレコードを書き終えてから増やすので、途中で落ちてもcountまでのレコードは読める。
+| 時刻は全てtime.monotonic()(全プロセス共通)。
+
+.. code-block:: bash
+
+    # 記録する(main.pyでRECORD_ENABLEを見てセッションを開始する)
+    python3 main.py
+    # 記録の中身を確認する
+    python3 sensorLog.py sensor_log/20201010_101010
+
+"""
+
+
+# 記録するかどうか(main.pyが見る)
+RECORD_ENABLE = False
+# セッションのディレクトリを作る場所
+SENSOR_LOG_DIRECTORY = './sensor_log'
+# レコードの大きさ[byte]と、ファイルを広げる時に増やすレコード数
+RECORD_SIZE = 64
+GROW_RECORDS = 16384
+
+LOG_MAGIC = b'CBSLOG'
+LOG_VERSION = 1
+
+# レコードの種類
+KIND_IMU = 1
+KIND_MAGNET = 2
+KIND_DISTANCE = 3
+KIND_VISION = 4
+
+
+# ファイルのヘッダ
+class LogHeader(Structure):
+    _fields_ = [('magic', c_char * 8), ('version', c_uint), ('recordSize', c_uint),
+                # 書き終えたレコードの数
+                ('count', c_uint64),
+                ('reserved', c_char * 40)]
+
+
+# レコードの形式(先頭は種類、予備、時刻)。無い値はNaN
+# IMU      : 加速度xyz[g]、ジャイロxyz[deg/s]
+# MAGNET   : 磁気センサxyz[uT](MPU9250の軸)
+# DISTANCE : 読んだ距離[cm]、中央値を取った距離[cm]、累計の読み出し失敗回数
+# VISION   : VisionSnapshot(時刻はpublishTime)
+_RECORD_STRUCTS = {
+    KIND_IMU: struct.Struct('<IId6d'),
+    KIND_MAGNET: struct.Struct('<IId3d24x'),
+    KIND_DISTANCE: struct.Struct('<IIdddI28x'),
+    KIND_VISION: struct.Struct('<IId6iId12x'),
+}
+_KIND_STRUCT = struct.Struct('<I')
+
+ImuRecord = namedtuple('ImuRecord', ['timestamp', 'accel', 'gyro'])
+MagnetRecord = namedtuple('MagnetRecord', ['timestamp', 'magnet'])
+DistanceRecord = namedtuple('DistanceRecord', ['timestamp', 'raw', 'distance', 'errorCount'])
+VisionRecord = namedtuple('VisionRecord', ['timestamp', 'snapshot'])
+
+_NAN3 = (math.nan, math.nan, math.nan)
+
+_session_directory = None
+
+
+def startSession(directory=None):
+    """
+
+    start recording in a new session directory (call it before starting the processes)
+
+    Returns:
+        str: session directory
+
+    """
+    global _session_directory
+    if directory is None:
+        directory = os.path.join(SENSOR_LOG_DIRECTORY, time.strftime('%Y%m%d_%H%M%S'))
+    os.makedirs(directory, exist_ok=True)
+    _session_directory = directory
+    INFO('sensor log session: ' + directory)
+    return directory
+
+
+def openWriter(channel):
+    """
+
+    open the log of a channel in the current session
+
+    Args:
+        channel (str) : 'imu', 'distance', 'vision'
+
+    Returns:
+        SensorLogWriter: writer, or None if no session is started (記録しない)
+
+    """
+    if _session_directory is None:
+        return None
+    return SensorLogWriter(os.path.join(_session_directory, channel + '.log'))
+
+
+class SensorLogWriter:
+    """
+
+    Append-only writer of one log file
+
+    Examples:
+        >>> writer = SensorLogWriter('sensor_log/test/imu.log')
+        >>> writer.writeImu(time.monotonic(), (0, 0, 1), (0.1, 0.2, 0.3))
+        >>> writer.close()
+
+    Attributes:
+        count (int) : number of records written
+
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        self._capacity = GROW_RECORDS
+        os.ftruncate(self._fd, sizeof(LogHeader) + RECORD_SIZE * self._capacity)
+        self._mmap = mmap.mmap(self._fd, sizeof(LogHeader) + RECORD_SIZE * self._capacity)
+        self._header = LogHeader.from_buffer(self._mmap)
+        self._header.magic = LOG_MAGIC
+        self._header.version = LOG_VERSION
+        self._header.recordSize = RECORD_SIZE
+        self._header.count = 0
+        self.count = 0
+
+    def _grow(self):
+        # ヘッダの参照を外してから広げる(mmapを参照しているバッファがあるとresize()できない)
+        self._header = None
+        self._capacity += GROW_RECORDS
+        self._mmap.resize(sizeof(LogHeader) + RECORD_SIZE * self._capacity)
+        self._header = LogHeader.from_buffer(self._mmap)
+
+    def _append(self, kind, timestamp, *values):
+        if self.count >= self._capacity:
+            self._grow()
+        _RECORD_STRUCTS[kind].pack_into(self._mmap, sizeof(LogHeader) + RECORD_SIZE * self.count,
+                                        kind, 0, timestamp, *values)
+        self.count += 1
+        self._header.count = self.count
+
+    def writeImu(self, timestamp, accel, gyro):
+        self._append(KIND_IMU, timestamp, *(accel if accel is not None else _NAN3), *gyro)
+
+    def writeGyroSamples(self, samples):
+        # ジャイロのz軸のみのサンプル(Imu.read_samples()の戻り値)
+        for timestamp, z in samples:
+            self._append(KIND_IMU, timestamp, math.nan, math.nan, math.nan, math.nan, math.nan, z)
+
+    def writeImuBlock(self, timestamps, accel, gyro):
+        # Mpu9250Fifo.read_block()の戻り値
+        for timestamp, (ax, ay, az), (gx, gy, gz) in zip(timestamps.tolist(), accel.tolist(), gyro.tolist()):
+            self._append(KIND_IMU, timestamp, ax, ay, az, gx, gy, gz)
+
+    def writeMagnet(self, timestamp, magnet):
+        self._append(KIND_MAGNET, timestamp, *magnet)
+
+    def writeDistance(self, timestamp, raw, distance, error_count):
+        self._append(KIND_DISTANCE, timestamp, raw if raw is not None else math.nan, distance, error_count)
+
+    def writeVision(self, snapshot):
+        self._append(KIND_VISION, snapshot.publishTime,
+                     snapshot.ballAngle, snapshot.ballDis, snapshot.stationAngle, snapshot.stationDis,
+                     snapshot.wallX, snapshot.wallSize, snapshot.frameSeq, snapshot.captureTime)
+
+    def close(self):
+        if self._mmap is None:
+            return
+        self._header = None
+        self._mmap.flush()
+        self._mmap.close()
+        self._mmap = None
+        # 使わなかった領域を切り詰める
+        os.ftruncate(self._fd, sizeof(LogHeader) + RECORD_SIZE * self.count)
+        os.close(self._fd)
+
+
+def readLog(path):
+    """
+
+    read all records of a log file
+
+    Returns:
+        list: ImuRecord, MagnetRecord, DistanceRecord, VisionRecord in the written order
+
+    Raises:
+        ValueError: not a sensor log
+
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < sizeof(LogHeader):
+        raise ValueError('too short sensor log: ' + path)
+    header = LogHeader.from_buffer_copy(data)
+    if header.magic != LOG_MAGIC or header.version != LOG_VERSION or header.recordSize != RECORD_SIZE:
+        raise ValueError('unknown sensor log: ' + path)
+    count = min(header.count, (len(data) - sizeof(LogHeader)) // RECORD_SIZE)
+    records = []
+    for i in range(count):
+        offset = sizeof(LogHeader) + RECORD_SIZE * i
+        kind, = _KIND_STRUCT.unpack_from(data, offset)
+        if kind not in _RECORD_STRUCTS:
+            WARN('unknown sensor log record: kind = ' + str(kind) + ', index = ' + str(i))
+            continue
+        values = _RECORD_STRUCTS[kind].unpack_from(data, offset)
+        timestamp = values[2]
+        if kind == KIND_IMU:
+            records.append(ImuRecord(timestamp, values[3:6], values[6:9]))
+        elif kind == KIND_MAGNET:
+            records.append(MagnetRecord(timestamp, values[3:6]))
+        elif kind == KIND_DISTANCE:
+            raw = values[3] if not math.isnan(values[3]) else None
+            records.append(DistanceRecord(timestamp, raw, values[4], values[5]))
+        else:
+            records.append(VisionRecord(timestamp, VisionSnapshot(*values[3:9], frameSeq=values[9],
+                                                                  captureTime=values[10], publishTime=timestamp)))
+    return records
+
+
+def readSession(directory):
+    """
+
+    read all logs of a session
+
+    Returns:
+        dict: channel name -> records
+
+    """
+    session = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.log'):
+            session[name[:-len('.log')]] = readLog(os.path.join(directory, name))
+    return session
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='summarize a sensor log session')
+    parser.add_argument('directory')
+    args = parser.parse_args()
+
+    for channel, records in readSession(args.directory).items():
+        if not records:
+            print(channel + ': empty')
+            continue
+        duration = records[-1].timestamp - records[0].timestamp
+        print(channel + ': ' + str(len(records)) + ' records, ' + '{:.1f}'.format(duration) + ' [s], ' +
+              '{:.1f}'.format(len(records) / duration if duration > 0 else 0) + ' [records/s]')
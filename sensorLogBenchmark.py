@@ -0,0 +1,65 @@
+# coding: UTF-8
+
+import argparse
+import shutil
+import tempfile
+import time
+import numpy as np
+import sensorLog
+from sharedState import VISION_LOST
+
+
+"""
+
+benchmark for sensorLog.py
+
+1レコードあたりの書き込み時間を計測し、試合中の頻度(IMU 200Hz、距離センサ 50Hz、画像処理 15fps)で記録した場合のCPU使用率を求める。
+一時ディレクトリに書き込み、計測後に消す。
+
+.. code-block:: bash
+
+    python3 sensorLogBenchmark.py --count 100000
+
+"""
+
+
+def measure(writer, count):
+    results = {}
+    # Mpu9250Fifo.read_block()の1回分(200Hzで0.02秒毎に読むと4サンプル)
+    timestamps = np.arange(4) * 0.005
+    accel = np.tile([0.0, 0.0, 1.0], (4, 1))
+    gyro = np.tile([0.1, 0.2, 0.3], (4, 1))
+    start = time.perf_counter()
+    for i in range(count // 4):
+        writer.writeImuBlock(timestamps, accel, gyro)
+    results['imu'] = (time.perf_counter() - start) / (count // 4 * 4)
+    start = time.perf_counter()
+    for i in range(count):
+        writer.writeDistance(i * 0.02, 10.5, 10.5, 0)
+    results['distance'] = (time.perf_counter() - start) / count
+    snapshot = VISION_LOST._replace(frameSeq=1, captureTime=1.0, publishTime=1.05)
+    start = time.perf_counter()
+    for i in range(count):
+        writer.writeVision(snapshot)
+    results['vision'] = (time.perf_counter() - start) / count
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measure the overhead of sensor logging')
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        writer = sensorLog.SensorLogWriter(directory + '/benchmark.log')
+        results = measure(writer, args.count)
+        writer.close()
+        records = sensorLog.readLog(directory + '/benchmark.log')
+        print('records = ' + str(len(records)))
+    finally:
+        shutil.rmtree(directory)
+    rates = {'imu': 200, 'distance': 50, 'vision': 15}
+    for name, per_record in results.items():
+        print(name.ljust(8) + ': ' + '{:.2f}'.format(per_record * 1e6) + ' [us/record], ' +
+              '{:.3f}'.format(per_record * rates[name] * 100) + ' [%] of a core at ' + str(rates[name]) + ' [Hz]')
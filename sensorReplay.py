@@ -0,0 +1,390 @@
+# coding: UTF-8
+
+import argparse
+import bisect
+import json
+import sys
+import time
+import numpy as np
+import debug
+from gp2y0e import DistanceSample, Gp2y0eSampler
+from imu import Imu
+from motorContl import MotorController, ChaseMode
+from sensorLog import ImuRecord, MagnetRecord, readSession
+from sharedState import createSharedMemory, readImu, writeVision
+from simulator import Simulator, SimGuideReader, SimServo, VirtualClock
+
+
+"""
+
+sensor replay module
+
+sensorLog.pyで記録したセッションを仮想時計の上で再生し、本物のImu、MotorControllerを記録したセンサ値で動かす。
+
+| IMU     : 記録したジャイロ、加速度、磁気センサの値をMpu9250Fifo、FaBo9Axis_MPU9250.MPU9250、Ak8963の代わりに返す。
+|           起動時の補正(Imu.calibrate())も記録に含まれるので、再生の最初に同じように補正する。
+| 距離センサ : 記録した中央値の距離をGp2y0eSamplerの代わりに返す。
+| 画像処理 : 記録した結果を記録した時刻に共有メモリに書き込む。
+| モータ  : MotorControllerが送ったモータ値を記録し、最後にJSONで出力する(--commandsでCSVにも出力する)。
+
+--speedを指定しない場合はできるだけ速く、指定した場合は記録の速さのspeed倍で再生する。
+記録したのは実機の動きの結果なので、パラメータを変えて再生した場合のモータ値はその場面での判断の違いとして見る(ロボットの動きは変わらない)。
+
+.. code-block:: bash
+
+    python3 sensorReplay.py sensor_log/20201010_101010
+    python3 sensorReplay.py sensor_log/20201010_101010 --speed 1
+    python3 sensorReplay.py sensor_log/20201010_101010 --imu-only
+
+"""
+
+
+class EndOfLog(Exception):
+    pass
+
+
+class ReplayClock(VirtualClock):
+    """
+
+    Virtual clock ending at the end of the log
+
+    speedを指定した場合は、仮想時計の進みが実時間のspeed倍を超えないように実際に待つ。
+    sleep()で記録の最後を過ぎるとEndOfLogを投げる(Imu.update_loop()などの無限ループを抜けるため)。
+
+    """
+
+    def __init__(self, start, end, speed=None):
+        super().__init__(start)
+        self.start = start
+        self.end = end
+        self._speed = speed
+        self._wall_start = None
+
+    def pace(self):
+        if self._speed is None:
+            return
+        # 最初にpace()を呼んだ時から実時間を数える
+        if self._wall_start is None:
+            self._wall_start = time.monotonic() - (self.now - self.start) / self._speed
+        wait = (self.now - self.start) / self._speed - (time.monotonic() - self._wall_start)
+        if wait > 0:
+            time.sleep(wait)
+
+    def sleep(self, sec):
+        super().sleep(sec)
+        if self.now >= self.end:
+            raise EndOfLog()
+        self.pace()
+
+
+def _timestamps(records):
+    return [record.timestamp for record in records]
+
+
+def _sortByTime(records):
+    # FIFOのサンプル時刻は読み出し時刻から遡って求めるので、ブロックの境目で前後することがある
+    return sorted(records, key=lambda record: record.timestamp)
+
+
+class LogImu:
+    """
+
+    IMU returning the recorded samples (Mpu9250Fifo.read(), read_block(), FaBo9Axis_MPU9250.MPU9250.readGyro())
+
+    """
+
+    def __init__(self, records, clock):
+        self._timestamps = np.array(_timestamps(records))
+        # 記録が無い軸(ジャイロのz軸のみの記録の加速度など)は、水平に置いて止まっている値にする
+        accel = np.array([record.accel for record in records]).reshape(-1, 3)
+        gyro = np.array([record.gyro for record in records]).reshape(-1, 3)
+        self._accel = np.where(np.isnan(accel), [0.0, 0.0, 1.0], accel)
+        self._gyro = np.nan_to_num(gyro)
+        self.has_accel = len(records) > 0 and not np.isnan(accel).all()
+        self._clock = clock
+        self._index = 0
+
+    def read_block(self):
+        end = int(np.searchsorted(self._timestamps, self._clock.now, side='right'))
+        start = self._index
+        self._index = end
+        return self._timestamps[start:end], self._accel[start:end], self._gyro[start:end]
+
+    def read(self):
+        timestamps, accel, gyro = self.read_block()
+        return list(zip(timestamps.tolist(), gyro[:, 2].tolist()))
+
+    def readGyro(self):
+        index = max(int(np.searchsorted(self._timestamps, self._clock.now, side='right')) - 1, 0)
+        x, y, z = self._gyro[index].tolist()
+        return {'x': x, 'y': y, 'z': z}
+
+
+class LogMagnet:
+    """
+
+    Magnetometer returning the recorded value (Ak8963.read())
+
+    """
+
+    def __init__(self, records, clock):
+        self._timestamps = _timestamps(records)
+        self._records = records
+        self._clock = clock
+
+    def read(self):
+        index = bisect.bisect_right(self._timestamps, self._clock.now) - 1
+        return self._records[index].magnet if index >= 0 else None
+
+
+class LogDistanceSensor:
+    """
+
+    Distance sensor returning the recorded filtered distance (Gp2y0eSampler)
+
+    """
+
+    def __init__(self, records, clock, max_age_sec=0.2):
+        self._timestamps = _timestamps(records)
+        self._records = records
+        self._clock = clock
+        self._max_age_sec = max_age_sec
+        # 各記録の時点で最後に読めた時刻
+        self._valid_times = []
+        valid_time = 0
+        for record in records:
+            if record.raw is not None:
+                valid_time = record.timestamp
+            self._valid_times.append(valid_time)
+
+    def start(self):
+        pass
+
+    def latest(self):
+        index = bisect.bisect_right(self._timestamps, self._clock.now) - 1
+        if index < 0:
+            return DistanceSample(Gp2y0eSampler.DISTANCE_INVALID, 0, 0)
+        record = self._records[index]
+        return DistanceSample(record.distance, self._valid_times[index], record.errorCount)
+
+    def read(self):
+        sample = self.latest()
+        if self._clock.now - sample.timestamp > self._max_age_sec:
+            return Gp2y0eSampler.DISTANCE_INVALID
+        return sample.distance
+
+    def format(self):
+        return 'log distance sensor: distance = ' + str(self.read())
+
+
+class CommandRecorder:
+    """
+
+    Motor driver recording the commands instead of driving
+
+    Attributes:
+        commands (list of (float, float)) : (time, speed) when the command changed
+
+    """
+
+    def __init__(self, clock, side):
+        self._clock = clock
+        self._side = side
+        self.speed = 0
+        self.commands = []
+
+    def drive(self, speed):
+        if speed != self.speed or not self.commands:
+            self.commands.append((self._clock.now, speed))
+        self.speed = speed
+
+    def stop(self):
+        self.drive(0)
+
+    def brake(self):
+        self.drive(0)
+
+    def format(self):
+        return 'log motor ' + self._side
+
+
+class LogReplayer:
+    """
+
+    Run Imu and MotorController on a recorded session
+
+    Examples:
+        >>> replayer = LogReplayer('sensor_log/20201010_101010')
+        >>> report = replayer.run()
+        >>> replayer.close()
+
+    """
+
+    # 仮想時計の刻み[s]
+    STEP_SEC = 0.005
+
+    # speed : 記録の速さの何倍で再生するか(Noneの場合はできるだけ速く)
+    # params : MotorController.apply_params()に渡すパラメータ(close()で元に戻す)
+    def __init__(self, directory, speed=None, params=None):
+        session = readSession(directory)
+        records = [record for channel_records in session.values() for record in channel_records]
+        if not records:
+            raise ValueError('empty sensor log: ' + directory)
+        imu_records = _sortByTime(record for record in session.get('imu', []) if isinstance(record, ImuRecord))
+        magnet_records = _sortByTime(record for record in session.get('imu', []) if isinstance(record, MagnetRecord))
+        self._vision_records = _sortByTime(session.get('vision', []))
+        self._distance_records = _sortByTime(session.get('distance', []))
+        self._imu_sample_count = len(imu_records)
+        self._previous_params = MotorController.apply_params(params) if params else {}
+        self.clock = ReplayClock(min(record.timestamp for record in records),
+                                 max(record.timestamp for record in records), speed)
+        self.clock.install(Simulator.CLOCK_MODULES)
+        self.shmem = createSharedMemory()
+        self.left_motor = CommandRecorder(self.clock, 'left')
+        self.right_motor = CommandRecorder(self.clock, 'right')
+        self.servo = SimServo(None, self.clock)
+        self.motorController = MotorController(left_motor=self.left_motor,
+                                               right_motor=self.right_motor,
+                                               servo=self.servo,
+                                               distanceSensor=LogDistanceSensor(self._distance_records, self.clock),
+                                               guideReader=SimGuideReader())
+        log_imu = LogImu(imu_records, self.clock)
+        backend = Imu.HEADING_BACKEND
+        if backend == Imu.HEADING_AHRS and not log_imu.has_accel:
+            debug.WARN('no accelerometer in the log, replay with HEADING_GYRO')
+            backend = Imu.HEADING_GYRO
+        # 記録したサンプルを記録した時刻のまま1回ずつ渡すため、POLLINGの記録もFIFOとして読む
+        # (LEGACYはサンプル間隔を使わないので、update_interval_sec毎に最新のサンプルを読む)
+        mode = Imu.ACQUISITION_LEGACY if Imu.ACQUISITION_MODE == Imu.ACQUISITION_LEGACY else Imu.ACQUISITION_FIFO
+        self.imu = Imu(mpu9250=log_imu, fifo=log_imu, mode=mode, backend=backend,
+                       magnet=LogMagnet(magnet_records, self.clock))
+        # MotorControllerの生成時にアームを上げ終わるまで時計が進むので、記録の最初に戻す
+        self.clock.now = self.clock.start
+
+    def close(self):
+        self.clock.uninstall()
+        MotorController.apply_params(self._previous_params)
+        self._previous_params = {}
+
+    def runImu(self):
+        """
+
+        replay only the IMU with Imu.update_loop()
+
+        Returns:
+            ImuSnapshot: last published body angle
+
+        """
+        try:
+            self.imu.calibrate()
+            self.imu.update_loop(self.shmem)
+        except EndOfLog:
+            pass
+        return readImu(self.shmem)
+
+    def run(self):
+        """
+
+        replay Imu, MotorController and the vision results until the end of the log
+
+        Imu.update_loop()と同じ順で読み出し、書き込みを行い、ControlLoopTimerと同じ条件でMotorController.tick()を呼ぶ。
+
+        Returns:
+            dict: result of the replay
+
+        """
+        clock = self.clock
+        start_time = clock.now
+        wall_start_time = time.monotonic()
+        try:
+            # 記録の最初は起動時の補正
+            self.imu.calibrate()
+        except EndOfLog:
+            pass
+        self.motorController.chaseBallMode.set_mode(ChaseMode.NORMAL)
+        is_event_mode = MotorController.CONTROL_LOOP_MODE == MotorController.CONTROL_LOOP_EVENT
+        if self.imu._mode == Imu.ACQUISITION_LEGACY:
+            read_interval = publish_interval = self.imu._update_interval_sec
+        else:
+            read_interval = Imu.FIFO_READ_INTERVAL_SEC
+            publish_interval = 1 / Imu.OUTPUT_RATE_HZ
+        vision_index = bisect.bisect_right(_timestamps(self._vision_records), clock.now)
+        next_read_time = next_publish_time = clock.now
+        last_tick_time = clock.now - MotorController.CONTROL_MAX_PERIOD_SEC
+        is_notified = False
+        tick_count = 0
+        try:
+            while clock.now < clock.end:
+                clock.now += LogReplayer.STEP_SEC
+                clock.pace()
+                self.servo.update()
+                now = clock.now
+                while vision_index < len(self._vision_records) and self._vision_records[vision_index].timestamp <= now:
+                    writeVision(self.shmem, self._vision_records[vision_index].snapshot)
+                    vision_index += 1
+                    is_notified = True
+                if now >= next_read_time:
+                    self.imu.calibrate_if_requested(self.shmem)
+                    self.imu.sample(self.shmem)
+                    next_read_time = max(next_read_time + read_interval, clock.now)
+                if now >= next_publish_time:
+                    self.imu.publish(self.shmem)
+                    next_publish_time = max(next_publish_time + publish_interval, clock.now)
+                    is_notified = True
+                elapsed = clock.now - last_tick_time
+                if elapsed >= MotorController.CONTROL_MAX_PERIOD_SEC or \
+                        (is_event_mode and is_notified and elapsed >= MotorController.CONTROL_MIN_PERIOD_SEC):
+                    self.motorController.tick(self.shmem)
+                    last_tick_time = clock.now
+                    is_notified = False
+                    tick_count += 1
+        except EndOfLog:
+            pass
+        wall_time = time.monotonic() - wall_start_time
+        replay_time = clock.now - start_time
+        return {'replay_time_sec': round(replay_time, 2),
+                'wall_time_sec': round(wall_time, 2),
+                'speedup': round(replay_time / wall_time, 1) if wall_time > 0 else None,
+                'imu_samples': self._imu_sample_count,
+                'distance_readings': len(self._distance_records),
+                'vision_frames': len(self._vision_records),
+                'ticks': tick_count,
+                'motor_command_changes': len(self.left_motor.commands) + len(self.right_motor.commands),
+                'body_angle': readImu(self.shmem).bodyAngle / 10,
+                'maneuvers': self.motorController.maneuvers.format()}
+
+    def writeCommands(self, path):
+        # モータ値の変化をCSVに出力する(時刻は記録の最初からの秒数)
+        start_time = min([t for t, speed in self.left_motor.commands + self.right_motor.commands], default=0)
+        events = sorted([(t, 'left', speed) for t, speed in self.left_motor.commands] +
+                        [(t, 'right', speed) for t, speed in self.right_motor.commands])
+        with open(path, 'w') as f:
+            f.write('# time [s], motor, speed\n')
+            for t, side, speed in events:
+                f.write('{:.3f},{},{}\n'.format(t - start_time, side, speed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay a sensor log session through Imu and MotorController')
+    parser.add_argument('directory')
+    parser.add_argument('--speed', type=float, default=None, help='replay at this multiple of the recorded speed')
+    parser.add_argument('--imu-only', action='store_true', help='replay only Imu.update_loop()')
+    parser.add_argument('--commands', default=None, help='write the motor commands to this csv')
+    parser.add_argument('--verbose', action='store_true', help='keep INFO logs of the replayed modules')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        debug.setDebugLevel(debug.DEBUG_LEVEL_WARN)
+    replayer = LogReplayer(args.directory, speed=args.speed)
+    try:
+        if args.imu_only:
+            snapshot = replayer.runImu()
+            report = {'body_angle': snapshot.bodyAngle / 10, 'publish': snapshot.sampleSeq}
+        else:
+            report = replayer.run()
+            if args.commands is not None:
+                replayer.writeCommands(args.commands)
+    finally:
+        replayer.close()
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -1,8 +1,79 @@
 # coding: UTF-8
 
+import math
+import threading
 import time
 from debug import ERROR, WARN, INFO, DEBUG, TRACE
-import Adafruit_PCA9685
+
+try:
+    import Adafruit_PCA9685
+except ImportError:
+    # Raspberry Pi以外の環境ではAdafruit_PCA9685が無いので、Servoは生成できない(simulator.pyは代わりのサーボを使う)
+    Adafruit_PCA9685 = None
+
+
+# 軌道の形(0-1の経過割合を0-1の移動割合に変換する)
+# LINEAR      : 一定速度(従来の動き)
+# EASE_IN_OUT : 動き始めと止まる直前をゆっくりにする
+PROFILE_LINEAR = 'linear'
+PROFILE_EASE_IN_OUT = 'ease_in_out'
+
+_PROFILES = {
+    PROFILE_LINEAR: lambda ratio: ratio,
+    PROFILE_EASE_IN_OUT: lambda ratio: (1 - math.cos(math.pi * ratio)) / 2,
+}
+
+
+class ServoMove:
+    """
+
+    Handle of a servo move running in the background
+
+    Examples:
+        >>> move = servo.down()
+        >>> # モータ制御を続けながら
+        >>> if move.done():
+        >>>     ...
+        >>> # 終わるまで待つ場合
+        >>> move.wait()
+
+    Attributes:
+        target_pulse_length (int) : target pulse length of this move
+
+    """
+
+    def __init__(self, target_pulse_length):
+        self.target_pulse_length = target_pulse_length
+        self._done_event = threading.Event()
+        self._cancel_event = threading.Event()
+        self._is_completed = False
+
+    def wait(self, timeout=None):
+        """
+
+        Returns:
+            bool: True if the move has finished (completed or cancelled)
+
+        """
+        return self._done_event.wait(timeout)
+
+    def done(self):
+        return self._done_event.is_set()
+
+    def completed(self):
+        """
+
+        Returns:
+            bool: True if the servo has reached the target
+
+        """
+        return self._is_completed
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def cancelled(self):
+        return self._cancel_event.is_set()
 
 
 class Servo:
@@ -10,16 +81,23 @@ class Servo:
 
     PCA9685 driver class
 
+    up()/down()/move()はすぐに戻り、軌道はバックグラウンドのスレッドで実行する。
+    移動中に新しい目標が来た場合は、実行中の移動をキャンセルしてから現在位置から動き直す。
+
     Examples:
         >>> from servo import Servo
         >>> adress = 0x41
         >>> s = Servo(address, 400)
+        >>> move = s.up()
+        >>> move.wait()
         >>> Servo.write(610, 3, 0.1)
 
     Attributes:
         _address (int) : slave address
         _pwm (Adafruit_PCA9685.PCA9685) : pwm control class
         _current_pulse_length (int) : pulse length [us?]
+        _move (ServoMove) : latest move
+        _thread (threading.Thread) : thread running the latest move
 
     Note:
         set 0 degree : pulse length = 400
@@ -27,32 +105,118 @@ class Servo:
 
     """
 
-    def __init__(self, address, initial_pulse_length=390):
+    # 上げ下げのパルス幅
+    PULSE_LENGTH_UP = 610
+    PULSE_LENGTH_DOWN = 390
+    # 上げ下げにかける時間[s]と、パルス幅を更新する間隔[s]
+    MOVE_DURATION_SEC = 3
+    MOVE_STEP_SEC = 0.1
+    # 上げ下げの軌道の形
+    MOVE_PROFILE = PROFILE_LINEAR
+
+    # i2c : Adafruit_GPIO.I2C互換のモジュール(i2cBus.AdafruitI2cAdapterなど)、Noneの場合は標準のI2Cバスを使う
+    def __init__(self, address, initial_pulse_length=390, i2c=None):
         TRACE('Servo generated: address = ' + str(address))
         self._address = address
-        self._pwm = Adafruit_PCA9685.PCA9685(address=address)
+        if Adafruit_PCA9685 is None:
+            raise RuntimeError('Adafruit_PCA9685 is not available')
+        if i2c is None:
+            self._pwm = Adafruit_PCA9685.PCA9685(address=address)
+        else:
+            self._pwm = Adafruit_PCA9685.PCA9685(address=address, i2c=i2c)
         # Set frequency to 60hz, good for servos.
         self._pwm.set_pwm_freq(60)
         # Set initial pluse length
         self._pwm.set_pwm(0, 0, initial_pulse_length)
         self._current_pulse_length = initial_pulse_length
         self._is_lifting = False
+        self._lock = threading.Lock()
+        self._move = None
+        self._thread = None
+
+    def move(self, target_pulse_length, duration, diff_t, profile=PROFILE_LINEAR, on_completed=None):
+        """
+
+        start moving to the target in the background
+
+        Args:
+            target_pulse_length (int) : target pulse length
+            duration (float) : time to reach the target [s]
+            diff_t (float) : interval of pulse length updates [s]
+            profile (str) : PROFILE_LINEAR or PROFILE_EASE_IN_OUT
+            on_completed (function) : called in the move thread when the target is reached (not when cancelled)
+
+        Returns:
+            ServoMove: handle of the move
+
+        """
+        with self._lock:
+            if self._move is not None and not self._move.done():
+                DEBUG('Servo move cancelled: target = ' + str(self._move.target_pulse_length))
+                self._move.cancel()
+            previous_thread = self._thread
+            move = ServoMove(target_pulse_length)
+            self._move = move
+            self._thread = threading.Thread(target=self._run,
+                                            args=(move, previous_thread, duration, diff_t, _PROFILES[profile],
+                                                  on_completed))
+            self._thread.daemon = True
+            self._thread.start()
+        return move
 
+    def _run(self, move, previous_thread, duration, diff_t, profile, on_completed):
+        # キャンセルした移動が止まって、現在位置が確定してから動き始める
+        if previous_thread is not None:
+            previous_thread.join()
+        try:
+            start_pulse_length = self._current_pulse_length
+            count = max(int(duration / diff_t), 1)
+            for i in range(count):
+                if move.cancelled():
+                    return
+                pulse_length = int(start_pulse_length + profile((i + 1) / count) *
+                                   (move.target_pulse_length - start_pulse_length))
+                self._pwm.set_pwm(0, 0, pulse_length)
+                self._current_pulse_length = pulse_length
+                # キャンセルされたらすぐ起きる
+                if move._cancel_event.wait(diff_t):
+                    return
+            self._current_pulse_length = move.target_pulse_length
+            move._is_completed = True
+            if on_completed is not None:
+                on_completed()
+        except Exception as e:
+            ERROR('Servo move failed: ' + str(e))
+        finally:
+            move._done_event.set()
+
+    # 移動が終わるまで待つ
     def write(self, target_pulse_length, duration, diff_t):
-        count = int(duration / diff_t)
-        for i in range(count):
-            self._pwm.set_pwm(0, 0, int(self._current_pulse_length + ((i + 1) * ((target_pulse_length - self._current_pulse_length) / count))))
-            time.sleep(diff_t)
-        
-        self._current_pulse_length = target_pulse_length
-    
+        self.move(target_pulse_length, duration, diff_t).wait()
+
     def up(self):
-        self.write(610, 3, 0.1)
-        self._is_lifting = True
-    
+        return self.move(Servo.PULSE_LENGTH_UP, Servo.MOVE_DURATION_SEC, Servo.MOVE_STEP_SEC, Servo.MOVE_PROFILE,
+                         on_completed=self._set_lifting)
+
     def down(self):
-        self.write(390, 3, 0.1)
+        return self.move(Servo.PULSE_LENGTH_DOWN, Servo.MOVE_DURATION_SEC, Servo.MOVE_STEP_SEC, Servo.MOVE_PROFILE,
+                         on_completed=self._clear_lifting)
+
+    def _set_lifting(self):
+        self._is_lifting = True
+
+    def _clear_lifting(self):
         self._is_lifting = False
-    
+
+    # 上げ終わっている場合にTrue
     def is_lifting(self):
         return self._is_lifting
+
+    def is_moving(self):
+        move = self._move
+        return move is not None and not move.done()
+
+    def cancel(self):
+        move = self._move
+        if move is not None:
+            move.cancel()
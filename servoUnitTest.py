@@ -12,3 +12,12 @@ if __name__ == "__main__":
     servo.write(12, 5, 0.1)
     time.sleep(3)
     servo.write(7.25, 5, 0.1)
+    time.sleep(3)
+
+    # 移動中に新しい目標を与えると、実行中の移動はキャンセルされて現在位置から動き直す
+    move = servo.up()
+    time.sleep(1)
+    print('moving: ' + str(servo.is_moving()))
+    down_move = servo.down()
+    down_move.wait()
+    print('up cancelled: ' + str(move.cancelled()) + ', lifting: ' + str(servo.is_lifting()))
@@ -0,0 +1,237 @@
+# coding: UTF-8
+
+import time
+from collections import namedtuple
+from ctypes import Structure, c_int, c_bool, c_uint, c_double
+from multiprocessing import Value
+from latencyStats import LatencyStats
+
+
+"""
+
+shared state module
+
+プロセス間の共有メモリの定義と、seqlockによる一括書き込み、一括読み出し
+
+seqlockの使い方
+
+| 書き込み側はシーケンス番号を奇数にしてからフィールドを書き込み、書き終わったら偶数にする。
+| 読み出し側はシーケンス番号が偶数かつ読み出し前後で変わっていない場合のみ値を採用し、そうでなければ読み直す。
+| 書き込み側は読み出し側を待たない。1つのseqlockに書き込めるのは1プロセスのみ。
+| Pythonからはメモリバリアを明示できないので、フィールドの読み書きの順序はインタプリタの処理に頼っている。
+
+"""
+
+
+# 共有メモリの構造体
+class Point(Structure):
+    _fields_ = [('ballAngle', c_int), ('ballDis', c_int),
+                ('stationAngle', c_int), ('stationDis', c_int),
+                ('bodyAngle', c_int), ('preparingRestart', c_bool),
+                ('soundPhase', c_int),
+                ('wallX', c_int), ('wallSize', c_int),
+                # 画像処理結果のフレーム番号、撮影時刻、書き込み時刻(time.monotonic())
+                ('visionFrameSeq', c_uint), ('visionCaptureTime', c_double), ('visionPublishTime', c_double),
+                # 画像処理結果(ballAngle-visionPublishTime)用seqlockのシーケンス番号
+                ('visionSeq', c_uint),
+                # IMUの角速度[deg/s](右回りが正)、サンプル番号、書き込み時刻(time.monotonic())
+                ('bodyRate', c_double), ('imuSampleSeq', c_uint), ('imuPublishTime', c_double),
+                # IMU結果(bodyAngle, bodyRate, imuSampleSeq, imuPublishTime)用seqlockのシーケンス番号
+                ('imuSeq', c_uint),
+                # 最後に送ったモータ値(IMUが止まっている区間を判定するのに使う)
+                ('motorCommandLeft', c_int), ('motorCommandRight', c_int)]
+
+
+# 画像処理結果のスナップショット
+# frameSeqが0の場合はまだ一度も書き込まれていない
+VisionSnapshot = namedtuple('VisionSnapshot', ['ballAngle', 'ballDis', 'stationAngle', 'stationDis', 'wallX', 'wallSize',
+                                               'frameSeq', 'captureTime', 'publishTime'])
+# 対象が何も見えていない画像処理結果
+VISION_LOST = VisionSnapshot(ballAngle=0, ballDis=-1, stationAngle=0, stationDis=-1, wallX=0, wallSize=-1,
+                             frameSeq=0, captureTime=0, publishTime=0)
+
+# IMU結果のスナップショット
+ImuSnapshot = namedtuple('ImuSnapshot', ['bodyAngle', 'bodyRate', 'sampleSeq', 'publishTime'])
+
+
+def createSharedMemory():
+    """
+
+    create shared memory for all processes
+
+    フィールド単位のアクセスはc_intの読み書きなので、ロックなしで生成する。
+    複数フィールドをまとめて読み書きする場合はseqlockを使う。
+
+    Returns:
+        Point: shared memory
+
+    """
+    shmem = Value(Point, lock=False)
+    shmem.preparingRestart = False
+    shmem.soundPhase = 0
+    shmem.visionSeq = 0
+    shmem.imuSeq = 0
+    shmem.motorCommandLeft = 0
+    shmem.motorCommandRight = 0
+    return shmem
+
+
+def seqlockWrite(shmem, seq_name, values):
+    """
+
+    write fields at once
+
+    Args:
+        shmem : shared memory
+        seq_name (str) : field name of the sequence number
+        values (list of tuple) : (field name, value) pairs
+
+    """
+    seq = getattr(shmem, seq_name)
+    # 奇数の間は書き込み中
+    setattr(shmem, seq_name, seq + 1)
+    for name, value in values:
+        setattr(shmem, name, value)
+    setattr(shmem, seq_name, seq + 2)
+
+
+def seqlockRead(shmem, seq_name, names):
+    """
+
+    read a consistent snapshot of fields
+
+    Args:
+        shmem : shared memory
+        seq_name (str) : field name of the sequence number
+        names (list of str) : field names
+
+    Returns:
+        list: field values
+
+    """
+    retry = 0
+    while True:
+        seq = getattr(shmem, seq_name)
+        if not seq & 1:
+            values = [getattr(shmem, name) for name in names]
+            if getattr(shmem, seq_name) == seq:
+                return values
+        # 書き込み側のプロセスが書き込み途中で止まっている場合に備えて、CPUを譲る
+        retry += 1
+        if retry % 16 == 0:
+            time.sleep(0)
+
+
+def writeVision(shmem, snapshot):
+    """
+
+    publish an image processing result
+
+    Args:
+        shmem : shared memory
+        snapshot (VisionSnapshot) : result
+
+    """
+    seqlockWrite(shmem, 'visionSeq', zip(_VISION_FIELD_NAMES, snapshot))
+
+
+def readVision(shmem):
+    """
+
+    read the latest image processing result
+
+    Returns:
+        VisionSnapshot: consistent result of one frame
+
+    """
+    return VisionSnapshot(*seqlockRead(shmem, 'visionSeq', _VISION_FIELD_NAMES))
+
+
+def writeImu(shmem, snapshot):
+    """
+
+    publish a body angle
+
+    Args:
+        shmem : shared memory
+        snapshot (ImuSnapshot) : result
+
+    """
+    seqlockWrite(shmem, 'imuSeq', zip(_IMU_FIELD_NAMES, snapshot))
+
+
+def readImu(shmem):
+    """
+
+    read the latest body angle
+
+    Returns:
+        ImuSnapshot: consistent result of one sample
+
+    """
+    return ImuSnapshot(*seqlockRead(shmem, 'imuSeq', _IMU_FIELD_NAMES))
+
+
+# スナップショットのフィールドと共有メモリのフィールドの対応
+_VISION_FIELD_NAMES = ['ballAngle', 'ballDis', 'stationAngle', 'stationDis', 'wallX', 'wallSize',
+                       'visionFrameSeq', 'visionCaptureTime', 'visionPublishTime']
+_IMU_FIELD_NAMES = ['bodyAngle', 'bodyRate', 'imuSampleSeq', 'imuPublishTime']
+
+
+class ProducerMonitor:
+    """
+
+    Track age and rate of a producer publishing through shared memory
+
+    Examples:
+        >>> monitor = ProducerMonitor('vision')
+        >>> vision = readVision(shmem)
+        >>> monitor.update(vision.frameSeq, vision.captureTime)
+        >>> INFO(monitor.format())
+
+    Attributes:
+        _age_stats (LatencyStats) : age of the data when it was used
+        _seq_count (int) : number of new seq observed since the last format()
+
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._age_stats = LatencyStats(name + ' age')
+        self._pre_seq = None
+        self._seq_count = 0
+        self._start_time = time.monotonic()
+
+    def update(self, seq, timestamp, now=None):
+        """
+
+        Args:
+            seq (int) : sequence number of the data
+            timestamp (float) : time.monotonic() when the data was produced
+            now (float) : current time.monotonic()
+
+        Returns:
+            float: age of the data [s]
+
+        """
+        if now is None:
+            now = time.monotonic()
+        if self._pre_seq is not None and seq != self._pre_seq:
+            self._seq_count += (seq - self._pre_seq) & 0xffffffff
+        self._pre_seq = seq
+        age = now - timestamp
+        self._age_stats.add(age)
+        return age
+
+    def rate(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self._seq_count / max(now - self._start_time, 1e-6)
+
+    def format(self):
+        now = time.monotonic()
+        text = self._name + ': rate=' + '{:.1f}'.format(self.rate(now)) + ' Hz, ' + self._age_stats.format()
+        self._age_stats.clear()
+        self._seq_count = 0
+        self._start_time = now
+        return text
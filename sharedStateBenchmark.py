@@ -0,0 +1,111 @@
+# coding: UTF-8
+
+import argparse
+import time
+from multiprocessing import Array, Process, Value
+from sharedState import Point, VisionSnapshot, createSharedMemory, readVision, writeVision
+
+
+"""
+
+contention benchmark for sharedState.py
+
+main.pyと同じ構成(画像処理、IMU、モータ制御、音声の4プロセスと親プロセス)で共有メモリにアクセスし、
+ロック付きValueをフィールド毎に読み書きする従来方式と、seqlockによる一括読み書きを比較する。
+画像処理プロセスは1フレーム毎に6フィールド全てに同じ値を書き込むので、
+読み出した6フィールドの値が揃っていなければ2フレームの結果が混ざっている(torn read)。
+
+.. code-block:: bash
+
+    python3 sharedStateBenchmark.py --duration 5
+
+"""
+
+
+def visionWriter(shmem, mode, duration, counts, index):
+    end_time = time.monotonic() + duration
+    count = 0
+    while time.monotonic() < end_time:
+        count += 1
+        value = count & 0x7fffffff
+        if mode == 'seqlock':
+            writeVision(shmem, VisionSnapshot(value, value, value, value, value, value, value, 0, 0))
+        else:
+            shmem.ballAngle = value
+            shmem.ballDis = value
+            shmem.stationAngle = value
+            shmem.stationDis = value
+            shmem.wallX = value
+            shmem.wallSize = value
+            shmem.visionFrameSeq = value
+    counts[index] = count
+
+
+def imuWriter(shmem, mode, duration, counts, index):
+    end_time = time.monotonic() + duration
+    count = 0
+    while time.monotonic() < end_time:
+        count += 1
+        shmem.bodyAngle = count & 0x7fff
+    counts[index] = count
+
+
+def motorReader(shmem, mode, duration, counts, index, torn):
+    end_time = time.monotonic() + duration
+    count = 0
+    torn_count = 0
+    while time.monotonic() < end_time:
+        count += 1
+        if mode == 'seqlock':
+            vision = readVision(shmem)
+        else:
+            vision = VisionSnapshot(shmem.ballAngle, shmem.ballDis, shmem.stationAngle,
+                                    shmem.stationDis, shmem.wallX, shmem.wallSize, shmem.visionFrameSeq, 0, 0)
+        body_angle = shmem.bodyAngle
+        if len(set(vision[:7])) != 1:
+            torn_count += 1
+    counts[index] = count
+    torn.value = torn_count
+
+
+def soundReader(shmem, mode, duration, counts, index):
+    end_time = time.monotonic() + duration
+    count = 0
+    while time.monotonic() < end_time:
+        count += 1
+        phase = shmem.soundPhase
+    counts[index] = count
+
+
+def run(mode, duration):
+    if mode == 'seqlock':
+        shmem = createSharedMemory()
+    else:
+        shmem = Value(Point, 0)
+    torn = Value('l', 0, lock=False)
+    shared_counts = Array('l', 4, lock=False)
+    processes = [Process(target=visionWriter, args=(shmem, mode, duration, shared_counts, 0)),
+                 Process(target=imuWriter, args=(shmem, mode, duration, shared_counts, 1)),
+                 Process(target=motorReader, args=(shmem, mode, duration, shared_counts, 2, torn)),
+                 Process(target=soundReader, args=(shmem, mode, duration, shared_counts, 3))]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return {'vision writes/s': shared_counts[0] / duration,
+            'imu writes/s': shared_counts[1] / duration,
+            'motor reads/s': shared_counts[2] / duration,
+            'sound reads/s': shared_counts[3] / duration,
+            'torn reads': torn.value}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare locked Value and seqlock under main.py process layout')
+    parser.add_argument('--duration', type=float, default=3, help='duration of each mode [s]')
+    args = parser.parse_args()
+
+    for mode in ['value', 'seqlock']:
+        result = run(mode, args.duration)
+        print(mode)
+        for key, value in result.items():
+            print('  ' + key.ljust(16) + ': ' + '{:.0f}'.format(value))
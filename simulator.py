@@ -0,0 +1,697 @@
+# coding: UTF-8
+
+import argparse
+import json
+import math
+import random
+import sys
+import time
+import controlLoopTimer
+import debug
+import imageProcessing
+import imu
+import maneuver
+import motorContl
+import sharedState
+from guideChannel import GUIDE_NONE
+from imageProcessing import ImageProcessing
+from imu import Imu
+from motorContl import MotorController, ChaseMode
+from sharedState import createSharedMemory
+
+
+"""
+
+collect ball simulator
+
+2次元の差動二輪ロボットとフィールド(ボール、黄色のステーション、黒い壁)を再現し、
+本物のMotorController(状態遷移、ChaseMode、MotorControlPostProcessor、動作)を仮想時計で実時間より速く動かす。
+
+| 画像処理 : geometry の場合はボール、ステーション、壁の画面上の位置と面積を幾何計算で求め、ImageProcessing.decideTargets()に渡す。
+|           render の場合は上から見た画像を描画し、ImageProcessing.imageProcessingFrame()で処理する。
+| IMU     : 本物のImuに、ロボットの回転速度にバイアスとノイズを加えたジャイロを渡す。
+| 距離センサ : ボールを持っている場合は近い値、そうでなければ正面の壁、ボールまでの距離を返す。
+
+| 実機以外でも動かせるように、geometry ではOpenCVを使わない(numpyは必要)。render にはOpenCVが必要。
+
+ボール1個をステーションに届けると、フィールドのどこかに新しいボールを置く。
+結果(1分あたりの配達数など)はJSONで標準出力に出す。
+
+.. code-block:: bash
+
+    python3 simulator.py --duration 300 --runs 5
+    python3 simulator.py --duration 60 --vision render
+
+"""
+
+
+class VirtualClock:
+    """
+
+    Virtual time replacing the time module of the simulated modules
+
+    install()したモジュールのtime.time(), time.monotonic(), time.sleep()は仮想時計を使う。
+    sleep()は待たずに時計を進める。
+
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self._installed = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, sec):
+        if sec > 0:
+            self.now += sec
+
+    def install(self, modules):
+        for module in modules:
+            self._installed.append((module, module.time))
+            module.time = self
+
+    def uninstall(self):
+        for module, original in reversed(self._installed):
+            module.time = original
+        self._installed = []
+
+
+class SimWorld:
+    """
+
+    Field, balls and the differential drive robot
+
+    座標系はフィールド左下が原点、x右、y上、単位はcm。ロボットの向きthetaはx軸から反時計回り[rad]。
+    ステーションは下側の壁の中央にあり、ロボットはステーションの前からフィールドの奥を向いてスタートする。
+
+    """
+
+    FIELD_WIDTH_CM = 300
+    FIELD_HEIGHT_CM = 300
+    # ステーション(下側の壁に接する黄色の矩形)
+    STATION_X_CM = (120, 180)
+    STATION_Y_CM = (0, 15)
+    BALL_COUNT = 6
+    BALL_RADIUS_CM = 6
+    ROBOT_RADIUS_CM = 12
+    # 車輪間の距離と、モータ値63(これ以上は同じ)の時の車輪の速度
+    TRACK_WIDTH_CM = 15
+    MAX_WHEEL_SPEED_CM_S = 40
+    # モータの応答の時定数[s]
+    MOTOR_TIME_CONSTANT_SEC = 0.1
+    # アームを下ろし終えた時に、この範囲にあるボールを掴める(ロボットの前端からの距離)
+    CAPTURE_REACH_CM = 45
+    CAPTURE_HALF_WIDTH_CM = 12
+    # アームを上げた時に、ロボットの前端からステーションまでがこの距離以内なら届けたとする
+    DELIVERY_RANGE_CM = 90
+    # ボールを持っている時の距離センサの値[cm]
+    HOLDING_DISTANCE_CM = 8
+    # 距離センサの最大値[cm]
+    DISTANCE_SENSOR_MAX_CM = 63
+
+    # balls : 最初に置くボールの[x, y, 'RED' or 'BLUE']のリスト(Noneの場合はBALL_COUNT個をランダムに置く)
+    def __init__(self, rng, balls=None):
+        self._rng = rng
+        self.x = (self.STATION_X_CM[0] + self.STATION_X_CM[1]) / 2
+        self.y = self.STATION_Y_CM[1] + 30
+        self.theta = math.pi / 2
+        self.left_command = 0
+        self.right_command = 0
+        self._left_speed = 0
+        self._right_speed = 0
+        self.omega = 0
+        self.balls = []
+        self.held_ball = None
+        self.delivered = 0
+        self.captures = 0
+        self.capture_misses = 0
+        self.drops = 0
+        if balls is not None:
+            self.balls = [list(ball) for ball in balls]
+        else:
+            for i in range(self.BALL_COUNT):
+                self.spawnBall()
+
+    def spawnBall(self):
+        r = self.BALL_RADIUS_CM
+        while True:
+            x = self._rng.uniform(r, self.FIELD_WIDTH_CM - r)
+            y = self._rng.uniform(r, self.FIELD_HEIGHT_CM - r)
+            # ステーションとロボットの近くには置かない
+            if math.hypot(x - self.x, y - self.y) > 40 and y > self.STATION_Y_CM[1] + 40:
+                break
+        self.balls.append([x, y, self._rng.choice(['RED', 'BLUE'])])
+
+    # @brief ロボット座標(前方、右方向)に変換する
+    def toRobot(self, x, y):
+        dx = x - self.x
+        dy = y - self.y
+        c = math.cos(self.theta)
+        s = math.sin(self.theta)
+        return dx * c + dy * s, dx * s - dy * c
+
+    # @brief ロボット座標(前方、右方向)からフィールド座標に変換する
+    def toWorld(self, forward, right):
+        c = math.cos(self.theta)
+        s = math.sin(self.theta)
+        return self.x + forward * c + right * s, self.y + forward * s - right * c
+
+    def isInField(self, x, y):
+        return 0 <= x <= self.FIELD_WIDTH_CM and 0 <= y <= self.FIELD_HEIGHT_CM
+
+    def isInStation(self, x, y):
+        return self.STATION_X_CM[0] <= x <= self.STATION_X_CM[1] and self.STATION_Y_CM[0] <= y <= self.STATION_Y_CM[1]
+
+    def _wheelSpeed(self, command):
+        # MiniMotorDriverと同じく整数にして63で頭打ちにする
+        value = min(abs(int(command)), 63)
+        return math.copysign(value / 63 * self.MAX_WHEEL_SPEED_CM_S, command)
+
+    def step(self, dt):
+        ratio = min(dt / self.MOTOR_TIME_CONSTANT_SEC, 1)
+        self._left_speed += (self._wheelSpeed(self.left_command) - self._left_speed) * ratio
+        self._right_speed += (self._wheelSpeed(self.right_command) - self._right_speed) * ratio
+        v = (self._left_speed + self._right_speed) / 2
+        self.omega = (self._right_speed - self._left_speed) / self.TRACK_WIDTH_CM
+        self.theta = (self.theta + self.omega * dt) % (2 * math.pi)
+        r = self.ROBOT_RADIUS_CM
+        self.x = min(max(self.x + v * math.cos(self.theta) * dt, r), self.FIELD_WIDTH_CM - r)
+        self.y = min(max(self.y + v * math.sin(self.theta) * dt, r), self.FIELD_HEIGHT_CM - r)
+        # ロボットに当たったボールは押し出す
+        for ball in self.balls:
+            dx = ball[0] - self.x
+            dy = ball[1] - self.y
+            distance = math.hypot(dx, dy)
+            min_distance = r + self.BALL_RADIUS_CM
+            if 0 < distance < min_distance:
+                ball[0] = min(max(self.x + dx / distance * min_distance, 0), self.FIELD_WIDTH_CM)
+                ball[1] = min(max(self.y + dy / distance * min_distance, 0), self.FIELD_HEIGHT_CM)
+
+    # アームを下ろし終えた時に呼ばれる
+    def capture(self):
+        if self.held_ball is not None:
+            return
+        candidates = []
+        for ball in self.balls:
+            forward, right = self.toRobot(ball[0], ball[1])
+            forward -= self.ROBOT_RADIUS_CM
+            if 0 <= forward <= self.CAPTURE_REACH_CM and abs(right) <= self.CAPTURE_HALF_WIDTH_CM:
+                candidates.append((forward, ball))
+        if not candidates:
+            self.capture_misses += 1
+            return
+        ball = min(candidates, key=lambda candidate: candidate[0])[1]
+        self.balls.remove(ball)
+        self.held_ball = ball
+        self.captures += 1
+
+    # アームを上げ始めた時に呼ばれる
+    def release(self):
+        if self.held_ball is None:
+            return
+        ball = self.held_ball
+        self.held_ball = None
+        # ステーションの最も近い点までの距離
+        nearest_x = min(max(self.x, self.STATION_X_CM[0]), self.STATION_X_CM[1])
+        nearest_y = min(max(self.y, self.STATION_Y_CM[0]), self.STATION_Y_CM[1])
+        forward, right = self.toRobot(nearest_x, nearest_y)
+        if 0 < forward - self.ROBOT_RADIUS_CM <= self.DELIVERY_RANGE_CM:
+            self.delivered += 1
+            self.spawnBall()
+            return
+        ball[0], ball[1] = self.toWorld(self.ROBOT_RADIUS_CM + self.BALL_RADIUS_CM, 0)
+        self.balls.append(ball)
+        self.drops += 1
+
+    # @brief 正面の壁、ボールまでの距離[cm]
+    def distanceAhead(self):
+        if self.held_ball is not None:
+            return self.HOLDING_DISTANCE_CM
+        distance = self.DISTANCE_SENSOR_MAX_CM
+        c = math.cos(self.theta)
+        s = math.sin(self.theta)
+        front_x = self.x + c * self.ROBOT_RADIUS_CM
+        front_y = self.y + s * self.ROBOT_RADIUS_CM
+        for wall_distance in [(self.FIELD_WIDTH_CM - front_x) / c if c > 1e-6 else None,
+                              -front_x / c if c < -1e-6 else None,
+                              (self.FIELD_HEIGHT_CM - front_y) / s if s > 1e-6 else None,
+                              -front_y / s if s < -1e-6 else None]:
+            if wall_distance is not None:
+                distance = min(distance, max(wall_distance, 0))
+        for ball in self.balls:
+            forward, right = self.toRobot(ball[0], ball[1])
+            if abs(right) < self.BALL_RADIUS_CM and forward > 0:
+                distance = min(distance, max(forward - self.ROBOT_RADIUS_CM - self.BALL_RADIUS_CM, 0))
+        return distance
+
+
+class SimCamera:
+    """
+
+    Top-down camera in front of the robot
+
+    画像の座標はImageProcessingと同じく、cx - CAMERA_CENTER_CXが正なら右、cyが小さいほど近い。
+    画素(cx, cy)はロボットの前端からCAMERA_NEAR_CM + cy / PIXELS_PER_CM前方、(cx - 240) / PIXELS_PER_CM右の床を写す。
+
+    """
+
+    WIDTH = 480
+    HEIGHT = 480
+    PIXELS_PER_CM = 4
+    CAMERA_NEAR_CM = 0
+    # geometryで壁とステーションの面積を求める時のサンプル間隔[px]
+    SAMPLE_STEP_PX = 15
+    # 描画色(BGR)、ImageProcessingのHSVの範囲に入る色
+    COLORS = {'FLOOR': (180, 180, 180), 'BLACK': (20, 20, 20), 'YELLOW': (0, 200, 220),
+              'RED': (0, 0, 200), 'BLUE': (200, 0, 0)}
+
+    def __init__(self, world):
+        self._world = world
+        self._grid = None
+
+    def _toPixel(self, forward, right):
+        cx = ImageProcessing.CAMERA_CENTER_CX + right * self.PIXELS_PER_CM
+        cy = (forward - self._world.ROBOT_RADIUS_CM - self.CAMERA_NEAR_CM) * self.PIXELS_PER_CM
+        return cx, cy
+
+    def _toFloor(self, cx, cy):
+        forward = self._world.ROBOT_RADIUS_CM + self.CAMERA_NEAR_CM + cy / self.PIXELS_PER_CM
+        right = (cx - ImageProcessing.CAMERA_CENTER_CX) / self.PIXELS_PER_CM
+        return self._world.toWorld(forward, right)
+
+    def detections(self):
+        """
+
+        Returns:
+            dict: the same form as ImageProcessing.detectColors(), computed geometrically
+
+        """
+        world = self._world
+        detections = {color_name: (-1, -1, 0.0, []) for color_name in ['RED', 'YELLOW', 'BLUE', 'GREEN', 'BLACK']}
+        ball_area = math.pi * (world.BALL_RADIUS_CM * self.PIXELS_PER_CM) ** 2
+        nearest = {}
+        for x, y, color_name in world.balls:
+            forward, right = world.toRobot(x, y)
+            cx, cy = self._toPixel(forward, right)
+            if 0 <= cx < self.WIDTH and 0 <= cy < self.HEIGHT:
+                if color_name not in nearest or cy < nearest[color_name][1]:
+                    nearest[color_name] = (int(cx), int(cy))
+        for color_name, (cx, cy) in nearest.items():
+            detections[color_name] = (cx, cy, ball_area, [])
+        # 壁とステーションは画面をサンプリングして面積と重心を求める
+        step = self.SAMPLE_STEP_PX
+        sums = {'YELLOW': [0, 0, 0], 'BLACK': [0, 0, 0]}
+        for cy in range(step // 2, self.HEIGHT, step):
+            for cx in range(step // 2, self.WIDTH, step):
+                x, y = self._toFloor(cx, cy)
+                if not world.isInField(x, y):
+                    color_name = 'BLACK'
+                elif world.isInStation(x, y):
+                    color_name = 'YELLOW'
+                else:
+                    continue
+                sums[color_name][0] += 1
+                sums[color_name][1] += cx
+                sums[color_name][2] += cy
+        for color_name, (count, sum_x, sum_y) in sums.items():
+            if count > 0:
+                detections[color_name] = (sum_x // count, sum_y // count, float(count * step * step), [])
+        return detections
+
+    def render(self):
+        """
+
+        Returns:
+            numpy.ndarray: BGR frame for ImageProcessing.imageProcessingFrame()
+
+        """
+        import numpy as np
+        world = self._world
+        if self._grid is None:
+            cy, cx = np.mgrid[0:self.HEIGHT, 0:self.WIDTH].astype(np.float32)
+            forward = world.ROBOT_RADIUS_CM + self.CAMERA_NEAR_CM + cy / self.PIXELS_PER_CM
+            right = (cx - ImageProcessing.CAMERA_CENTER_CX) / self.PIXELS_PER_CM
+            self._grid = (forward, right)
+        forward, right = self._grid
+        c = math.cos(world.theta)
+        s = math.sin(world.theta)
+        x = world.x + forward * c + right * s
+        y = world.y + forward * s - right * c
+        frame = np.empty((self.HEIGHT, self.WIDTH, 3), dtype=np.uint8)
+        frame[:] = self.COLORS['FLOOR']
+        frame[(x < 0) | (x > world.FIELD_WIDTH_CM) | (y < 0) | (y > world.FIELD_HEIGHT_CM)] = self.COLORS['BLACK']
+        frame[(x >= world.STATION_X_CM[0]) & (x <= world.STATION_X_CM[1]) &
+              (y >= world.STATION_Y_CM[0]) & (y <= world.STATION_Y_CM[1])] = self.COLORS['YELLOW']
+        for ball_x, ball_y, color_name in world.balls:
+            frame[(x - ball_x) ** 2 + (y - ball_y) ** 2 < world.BALL_RADIUS_CM ** 2] = self.COLORS[color_name]
+        return frame
+
+
+class SimMotor:
+    """
+
+    Motor driver writing the command to the world
+
+    """
+
+    def __init__(self, world, side):
+        self._world = world
+        self._side = side
+
+    def drive(self, speed):
+        if self._side == 'left':
+            self._world.left_command = speed
+        else:
+            self._world.right_command = speed
+
+    def stop(self):
+        self.drive(0)
+
+    def brake(self):
+        self.drive(0)
+
+    def format(self):
+        return 'sim motor ' + self._side
+
+
+class SimServoMove:
+    """
+
+    servo.ServoMove on the virtual clock
+
+    """
+
+    def __init__(self, servo, target, end_time):
+        self.target = target
+        self.end_time = end_time
+        self._servo = servo
+        self._is_completed = False
+        self._is_cancelled = False
+
+    def wait(self, timeout=None):
+        # 待つ代わりに仮想時計を進める
+        clock = self._servo.clock
+        end_time = self.end_time if timeout is None else min(self.end_time, clock.now + timeout)
+        clock.now = max(clock.now, end_time)
+        self._servo.update()
+        return self.done()
+
+    def done(self):
+        return self._is_completed or self._is_cancelled
+
+    def completed(self):
+        return self._is_completed
+
+    def cancel(self):
+        self._is_cancelled = True
+
+    def cancelled(self):
+        return self._is_cancelled
+
+
+class SimServo:
+    """
+
+    Arm servo with the same interface as servo.Servo
+
+    下ろし終えた時にボールを掴み、上げ始めた時にボールを離す(worldがNoneの場合は時間だけ進める、sensorReplay.py用)
+
+    """
+
+    def __init__(self, world, clock, duration_sec=3):
+        self._world = world
+        self.clock = clock
+        self._duration_sec = duration_sec
+        self._move = None
+        self._is_lifting = False
+
+    def _start(self, target):
+        if self._move is not None and not self._move.done():
+            self._move.cancel()
+        self._move = SimServoMove(self, target, self.clock.now + self._duration_sec)
+        return self._move
+
+    def up(self):
+        if self._world is not None:
+            self._world.release()
+        return self._start('up')
+
+    def down(self):
+        return self._start('down')
+
+    # シミュレーションの1ステップ毎に呼ばれる
+    def update(self):
+        move = self._move
+        if move is None or move.done() or self.clock.now < move.end_time:
+            return
+        move._is_completed = True
+        if move.target == 'up':
+            self._is_lifting = True
+        else:
+            self._is_lifting = False
+            if self._world is not None:
+                self._world.capture()
+
+    def is_lifting(self):
+        return self._is_lifting
+
+    def is_moving(self):
+        return self._move is not None and not self._move.done()
+
+
+class SimDistanceSensor:
+    """
+
+    Distance sensor with the same interface as gp2y0e.Gp2y0eSampler
+
+    """
+
+    def __init__(self, world):
+        self._world = world
+
+    def start(self):
+        pass
+
+    def read(self):
+        return self._world.distanceAhead()
+
+    def format(self):
+        return 'sim distance sensor: distance = ' + str(self.read())
+
+
+class SimGyro:
+    """
+
+    Gyro with the same readGyro() as FaBo9Axis_MPU9250.MPU9250
+
+    前回読んだ時からの平均の回転速度[deg/s](MPU9250のローパスフィルタ相当)にバイアスとノイズを加える
+
+    """
+
+    # z軸の向き
+    # MotorControllerはbodyAngleが正なら右に旋回して初期方向に戻すので、右回り(上から見て時計回り)を正とする
+    Z_SIGN = -1
+
+    def __init__(self, world, clock, rng, bias=0.8, noise=0.3):
+        self._world = world
+        self._clock = clock
+        self._rng = rng
+        self._bias = bias
+        self._noise = noise
+        self._pre_theta = world.theta
+        self._pre_time = clock.now
+
+    def readGyro(self):
+        dt = self._clock.now - self._pre_time
+        # thetaは0-2πに丸めているので、差分を-π-πに戻す
+        diff_theta = (self._world.theta - self._pre_theta + math.pi) % (2 * math.pi) - math.pi
+        rate = math.degrees(diff_theta) / dt if dt > 0 else 0
+        self._pre_theta = self._world.theta
+        self._pre_time = self._clock.now
+        return {'x': 0, 'y': 0, 'z': SimGyro.Z_SIGN * rate + self._bias + self._rng.gauss(0, self._noise)}
+
+
+class SimGuideReader:
+    """
+
+    Guide reader without the center camera
+
+    """
+
+    def read(self):
+        return GUIDE_NONE
+
+
+class Simulator:
+    """
+
+    Run MotorController in the simulated world on the virtual clock
+
+    Examples:
+        >>> report = Simulator(seed=0).run(300)
+        >>> report['delivered_per_min']
+        >>> # 決まった配置から1個届けるまでの時間を、パラメータを変えて測る
+        >>> simulator = Simulator(balls=[[150, 150, 'RED']], params={'MotorController.SPEED_CHASE': 60})
+        >>> report = simulator.run(60, stop_after_deliveries=1)
+        >>> simulator.close()
+
+    """
+
+    # geometry : 幾何計算で検知結果を求める(速い)
+    # render   : 画像を描画して画像処理を通す(遅いが画像処理も含めて確認できる)
+    VISION_GEOMETRY = 'geometry'
+    VISION_RENDER = 'render'
+    # 画像処理の周期[s]と、撮影から書き込みまでの時間[s]
+    VISION_PERIOD_SEC = 1 / 15
+    VISION_LATENCY_SEC = 0.05
+    # 物理計算の刻み[s]
+    PHYSICS_DT_SEC = 0.01
+
+    # 仮想時計を使うモジュール
+    CLOCK_MODULES = [motorContl, maneuver, controlLoopTimer, sharedState, imu, imageProcessing]
+
+    # balls : SimWorldに置くボール(Noneの場合はランダム)
+    # params : MotorController.apply_params()に渡すパラメータ(close()で元に戻す)
+    def __init__(self, seed=0, vision=VISION_GEOMETRY, balls=None, params=None):
+        if vision == Simulator.VISION_RENDER and imageProcessing.cv2 is None:
+            raise RuntimeError('cv2 is not available (--vision render requires OpenCV)')
+        self._rng = random.Random(seed)
+        self._vision = vision
+        self._previous_params = MotorController.apply_params(params) if params else {}
+        self.clock = VirtualClock()
+        self.clock.install(Simulator.CLOCK_MODULES)
+        self.world = SimWorld(self._rng, balls)
+        self.camera = SimCamera(self.world)
+        self.shmem = createSharedMemory()
+        self.servo = SimServo(self.world, self.clock)
+        self.motorController = MotorController(left_motor=SimMotor(self.world, 'left'),
+                                               right_motor=SimMotor(self.world, 'right'),
+                                               servo=self.servo,
+                                               distanceSensor=SimDistanceSensor(self.world),
+                                               guideReader=SimGuideReader())
+        self.imageProcessing = ImageProcessing()
+        self.imu = Imu(mpu9250=SimGyro(self.world, self.clock, self._rng))
+        self.imu.calibrate()
+
+    def close(self):
+        self.clock.uninstall()
+        MotorController.apply_params(self._previous_params)
+        self._previous_params = {}
+
+    def _captureVision(self):
+        if self._vision == Simulator.VISION_RENDER:
+            return self.imageProcessing.imageProcessingFrame(self.camera.render(), self.shmem)
+        return self.imageProcessing.decideTargets(self.camera.detections(), self.shmem)
+
+    def run(self, duration_sec, stop_after_deliveries=None):
+        """
+
+        Args:
+            duration_sec (float) : simulated time [s]
+            stop_after_deliveries (int) : stop when this number of balls are delivered in this run
+
+        Returns:
+            dict: result of the run
+
+        """
+        clock = self.clock
+        start_time = clock.now
+        end_time = start_time + duration_sec
+        wall_start_time = time.monotonic()
+        self.motorController.chaseBallMode.set_mode(ChaseMode.NORMAL)
+        is_event_mode = MotorController.CONTROL_LOOP_MODE == MotorController.CONTROL_LOOP_EVENT
+        next_vision_time = clock.now
+        next_imu_time = clock.now
+        last_tick_time = clock.now - MotorController.CONTROL_MAX_PERIOD_SEC
+        pending_visions = []
+        frame_seq = 0
+        is_notified = False
+        world = self.world
+        start_delivered = world.delivered
+        # 捕獲までの時間(開始、前回の配達から)と、捕獲から配達までの時間
+        capture_times = []
+        station_times = []
+        pre_captures = world.captures
+        pre_delivered = world.delivered
+        pre_event_time = start_time
+        while clock.now < end_time:
+            world.step(Simulator.PHYSICS_DT_SEC)
+            clock.now += Simulator.PHYSICS_DT_SEC
+            self.servo.update()
+            now = clock.now
+            if world.captures != pre_captures:
+                capture_times.append(now - pre_event_time)
+                pre_captures = world.captures
+                pre_event_time = now
+            if world.delivered != pre_delivered:
+                station_times.append(now - pre_event_time)
+                pre_delivered = world.delivered
+                pre_event_time = now
+                if stop_after_deliveries is not None and world.delivered - start_delivered >= stop_after_deliveries:
+                    break
+            # 撮影して、VISION_LATENCY_SEC後に書き込む
+            if now >= next_vision_time:
+                frame_seq += 1
+                pending_visions.append((now + Simulator.VISION_LATENCY_SEC, frame_seq, now, self._captureVision()))
+                next_vision_time = now + Simulator.VISION_PERIOD_SEC
+            while pending_visions and pending_visions[0][0] <= now:
+                publish_time, seq, capture_time, result = pending_visions.pop(0)
+                self.imageProcessing.writeResult(self.shmem, result, seq, capture_time)
+                is_notified = True
+            if now >= next_imu_time:
+                # 再スタート準備中の補正(calibrate())は仮想時計を進める
+                self.imu.update(self.shmem)
+                next_imu_time = clock.now + 0.1
+                is_notified = True
+            # ControlLoopTimerと同じ条件で制御する
+            elapsed = clock.now - last_tick_time
+            if elapsed >= MotorController.CONTROL_MAX_PERIOD_SEC or \
+                    (is_event_mode and is_notified and elapsed >= MotorController.CONTROL_MIN_PERIOD_SEC):
+                self.motorController.tick(self.shmem)
+                last_tick_time = clock.now
+                is_notified = False
+        wall_time = time.monotonic() - wall_start_time
+        sim_time = clock.now - start_time
+        return {'sim_time_sec': round(sim_time, 2),
+                'wall_time_sec': round(wall_time, 2),
+                'speedup': round(sim_time / wall_time, 1) if wall_time > 0 else None,
+                'delivered': world.delivered,
+                'delivered_per_min': round(world.delivered / sim_time * 60, 3),
+                'captures': world.captures,
+                'capture_misses': world.capture_misses,
+                'drops': world.drops,
+                'mean_time_to_capture_sec': round(sum(capture_times) / len(capture_times), 2) if capture_times else None,
+                'mean_time_to_station_sec': round(sum(station_times) / len(station_times), 2) if station_times else None,
+                'maneuvers': self.motorController.maneuvers.format()}
+
+
+def simulate(duration_sec, seed=0, vision=Simulator.VISION_GEOMETRY):
+    simulator = Simulator(seed=seed, vision=vision)
+    try:
+        return simulator.run(duration_sec)
+    finally:
+        simulator.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run MotorController in a simulated field faster than real time')
+    parser.add_argument('--duration', type=float, default=300, help='simulated time of each run [s]')
+    parser.add_argument('--runs', type=int, default=1, help='number of runs with different seeds')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first run')
+    parser.add_argument('--vision', choices=[Simulator.VISION_GEOMETRY, Simulator.VISION_RENDER],
+                        default=Simulator.VISION_GEOMETRY)
+    parser.add_argument('--verbose', action='store_true', help='keep INFO logs of the simulated modules')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        debug.setDebugLevel(debug.DEBUG_LEVEL_WARN)
+    reports = [simulate(args.duration, seed=args.seed + i, vision=args.vision) for i in range(args.runs)]
+    delivered_per_min = [report['delivered_per_min'] for report in reports]
+    json.dump({'runs': reports,
+               'mean_delivered_per_min': round(sum(delivered_per_min) / len(delivered_per_min), 3)},
+              sys.stdout, indent=2)
+    print()
@@ -2,6 +2,11 @@ import logging
 from debug import INFO, DEBUG
 from websocket_server import WebsocketServer
 import json
+from guideChannel import GuideChannel, GUIDE_DEGREE_NONE, writeGuideFile
+
+
+# 誘導情報をモータ制御プロセスへ渡す共有メモリ
+guideChannel = None
 
 
 # Callback functions
@@ -19,8 +24,12 @@ def message_received(client, server, message):
         message_dict = json.loads(message)
         if message_dict['type'] == 'guide_info':
             try:
-                with open('./guide_info.json', mode='w') as f:
-                    f.write(message)
+                if guideChannel is not None:
+                    guideChannel.publish(message_dict.get('degree', GUIDE_DEGREE_NONE),
+                                         message_dict.get('distance', -1),
+                                         message_dict.get('wait', False))
+                # guide_info.jsonを読むツール向けに、ファイルにも書き込む
+                writeGuideFile(message)
             except AttributeError:
                 INFO('faild to get color data')
     except json.JSONDecodeError:
@@ -29,6 +38,9 @@ def message_received(client, server, message):
 
 # Main
 if __name__ == "__main__":
+    guideChannel = GuideChannel()
+    # 前回起動時の誘導情報が残っていたら消す
+    guideChannel.publish(GUIDE_DEGREE_NONE, -1, False)
     server = WebsocketServer(port=9001, host='192.168.100.122', loglevel=logging.INFO)
     server.set_fn_new_client(new_client)
     server.set_fn_client_left(client_left)
@@ -0,0 +1,348 @@
+# coding: UTF-8
+
+import argparse
+import functools
+import glob
+import json
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+from ctypes import Structure, c_bool, c_char, c_double, c_int, c_uint, sizeof
+
+
+"""
+
+span trace module
+
+画像処理、IMU、モータ制御の各処理の開始時刻と処理時間(span)を、プロセス毎の共有メモリ(/dev/shm上のファイル)の
+リングバッファに書き込み、後から全プロセス分をまとめてChrome trace形式(chrome://tracing、ui.perfetto.dev)のJSONにする。
+
+| 有効無効は共有メモリ上のフラグで切り替えるので、動作中のプロセスを止めずに変更できる。
+| 無効の場合はフラグを1回読むだけなので、試合中も入れたままにしておける。
+| 時刻はtime.monotonic()(全プロセス共通)なので、プロセスをまたいで並べられる。
+| リングバッファは書き込み側が読み出し側を待たない。書き込み中のspanを読んだ場合、そのspanだけ壊れることがある。
+| リングバッファはプロセス内の全スレッドで共有するので、書き込みはロックで1つずつ行う。
+| プロセスが最初にリングバッファを作る時に、終了したプロセスのリングバッファを消す(前回の実行分を一緒に出力しない)。
+
+.. code-block:: bash
+
+    python3 spanTrace.py enable
+    python3 spanTrace.py export trace.json
+    python3 spanTrace.py disable
+
+"""
+
+
+TRACE_CHANNEL_PREFIX = 'collect_ball_trace'
+# 1プロセスあたりのspanの数(古いものから上書きする)
+RING_CAPACITY = 8192
+# spanの名前の最大長[byte]
+SPAN_NAME_LENGTH = 32
+# 制御用の共有メモリが無かった時の有効無効
+DEFAULT_ENABLE = False
+
+
+# 全プロセス共通の制御情報
+class TraceControl(Structure):
+    _fields_ = [('enabled', c_bool)]
+
+
+# 1つのspan
+class SpanRecord(Structure):
+    _fields_ = [('name', c_char * SPAN_NAME_LENGTH),
+                # 開始時刻(time.monotonic())と処理時間[s]
+                ('start', c_double), ('duration', c_double),
+                ('tid', c_uint), ('arg', c_int)]
+
+
+# プロセス毎のリングバッファのヘッダ
+class RingHeader(Structure):
+    _fields_ = [('pid', c_uint), ('capacity', c_uint),
+                # これまでに書き込んだspanの数(次に書き込む位置はcount % capacity)
+                ('count', c_uint),
+                ('processName', c_char * SPAN_NAME_LENGTH)]
+
+
+def traceDirectory():
+    # /dev/shmがない環境では一時ディレクトリに置く
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _mapFile(path, size):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        is_new = os.fstat(fd).st_size < size
+        if is_new:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size), is_new
+    finally:
+        os.close(fd)
+
+
+class _Control:
+    # 制御用の共有メモリ(プロセス毎に1回だけ開く)
+    def __init__(self, directory):
+        self._mmap, is_new = _mapFile(os.path.join(directory, TRACE_CHANNEL_PREFIX + '_control'), sizeof(TraceControl))
+        self.record = TraceControl.from_buffer(self._mmap)
+        if is_new:
+            self.record.enabled = DEFAULT_ENABLE
+
+
+class SpanRing:
+    """
+
+    Span ring buffer of one process
+
+    write()は複数のスレッドから呼ばれるので、書き込み位置の更新とspanの書き込みをロックで守る。
+
+    Attributes:
+        header (RingHeader) : header on the shared memory
+        records (SpanRecord array) : spans on the shared memory
+
+    """
+
+    def __init__(self, path, capacity=RING_CAPACITY, process_name=''):
+        size = sizeof(RingHeader) + sizeof(SpanRecord) * capacity
+        self._mmap, is_new = _mapFile(path, size)
+        self.header = RingHeader.from_buffer(self._mmap)
+        self.records = (SpanRecord * capacity).from_buffer(self._mmap, sizeof(RingHeader))
+        # 同じpidの古いファイルが残っていた場合も作り直す
+        self.header.pid = os.getpid()
+        self.header.capacity = capacity
+        self.header.count = 0
+        self.header.processName = process_name.encode()[:SPAN_NAME_LENGTH - 1]
+        self._lock = threading.Lock()
+
+    def write(self, name, start, duration, arg):
+        tid = threading.get_ident() & 0xFFFFFFFF
+        with self._lock:
+            header = self.header
+            record = self.records[header.count % header.capacity]
+            record.name = name
+            record.start = start
+            record.duration = duration
+            record.tid = tid
+            record.arg = arg
+            header.count += 1
+
+    def close(self):
+        self.header = None
+        self.records = None
+        self._mmap.close()
+
+
+_control = None
+_ring = None
+_ring_pid = None
+_ring_lock = threading.Lock()
+_process_name = ''
+
+
+def _controlRecord():
+    global _control
+    if _control is None:
+        _control = _Control(traceDirectory())
+    return _control.record
+
+
+def isEnabled():
+    return _controlRecord().enabled
+
+
+def setEnabled(enabled):
+    """
+
+    enable or disable tracing of all processes
+
+    """
+    _controlRecord().enabled = enabled
+
+
+def setProcessName(name):
+    """
+
+    set the name shown in the timeline (call it in each process)
+
+    """
+    global _process_name
+    _process_name = name
+    if _ring is not None and _ring_pid == os.getpid():
+        _ring.header.processName = name.encode()[:SPAN_NAME_LENGTH - 1]
+
+
+def _currentRing():
+    global _ring, _ring_pid
+    pid = os.getpid()
+    # fork後のプロセスでは親のリングバッファを使わずに作り直す
+    if _ring_pid != pid:
+        with _ring_lock:
+            if _ring_pid != pid:
+                # 終了したプロセス(前回の実行など)のリングバッファは出力に混ざらないように消す
+                removeRings()
+                path = os.path.join(traceDirectory(), TRACE_CHANNEL_PREFIX + '_' + str(pid))
+                _ring = SpanRing(path, process_name=_process_name or os.path.basename(sys.argv[0]))
+                _ring_pid = pid
+    return _ring
+
+
+class _Span:
+    __slots__ = ('_name', '_arg', '_start')
+
+    def __init__(self, name, arg):
+        self._name = name
+        self._arg = arg
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.monotonic()
+        _currentRing().write(self._name, self._start, end - self._start, self._arg)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, arg=0):
+    """
+
+    measure a block
+
+    Examples:
+        >>> with span('detectColors'):
+        >>>     detections = self.detectColors(hsv_img)
+
+    Args:
+        name (str) : span name (SPAN_NAME_LENGTH - 1 bytes以内)
+        arg (int) : value shown in the timeline (フレーム番号、モータ値など)
+
+    """
+    if not _controlRecord().enabled:
+        return _NO_SPAN
+    return _Span(name.encode(), arg)
+
+
+def traced(name):
+    """
+
+    decorator measuring every call of the function
+
+    Examples:
+        >>> @traced('calcMotorPowers')
+        >>> def calcMotorPowers(self, shmem, motion_status, vision):
+
+    """
+    encoded_name = name.encode()
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _controlRecord().enabled:
+                return func(*args, **kwargs)
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _currentRing().write(encoded_name, start, time.monotonic() - start, 0)
+        return wrapper
+    return decorator
+
+
+def _ringPaths(directory):
+    control_path = os.path.join(directory, TRACE_CHANNEL_PREFIX + '_control')
+    return [path for path in glob.glob(os.path.join(directory, TRACE_CHANNEL_PREFIX + '_*')) if path != control_path]
+
+
+def _readRing(path):
+    size = os.path.getsize(path)
+    if size < sizeof(RingHeader):
+        return None, []
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    header = RingHeader.from_buffer(data)
+    capacity = min(header.capacity, (size - sizeof(RingHeader)) // sizeof(SpanRecord))
+    if capacity == 0:
+        return header, []
+    records = (SpanRecord * capacity).from_buffer(data, sizeof(RingHeader))
+    count = header.count
+    # 古い順に並べる
+    first = max(count - capacity, 0)
+    return header, [records[i % capacity] for i in range(first, count)]
+
+
+def exportChromeTrace(output_path, directory=None):
+    """
+
+    merge the ring buffers of all processes into a Chrome trace JSON
+
+    Returns:
+        int: number of spans written
+
+    """
+    directory = directory if directory is not None else traceDirectory()
+    events = []
+    for path in sorted(_ringPaths(directory)):
+        header, records = _readRing(path)
+        if header is None:
+            continue
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': header.pid,
+                       'args': {'name': header.processName.decode(errors='replace') or str(header.pid)}})
+        for record in records:
+            events.append({'name': record.name.decode(errors='replace'), 'ph': 'X', 'pid': header.pid,
+                           'tid': record.tid,
+                           'ts': record.start * 1e6, 'dur': record.duration * 1e6,
+                           'args': {'arg': record.arg}})
+    span_count = sum(1 for event in events if event['ph'] == 'X')
+    with open(output_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return span_count
+
+
+def removeRings(directory=None):
+    """
+
+    remove the ring buffers of finished processes
+
+    """
+    directory = directory if directory is not None else traceDirectory()
+    for path in _ringPaths(directory):
+        pid = int(path.rsplit('_', 1)[1])
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            os.remove(path)
+        except PermissionError:
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='control span tracing and export the timeline')
+    parser.add_argument('command', choices=['enable', 'disable', 'status', 'export', 'clean'])
+    parser.add_argument('output', nargs='?', default='trace.json', help='output path of export')
+    args = parser.parse_args()
+
+    if args.command == 'enable':
+        setEnabled(True)
+    elif args.command == 'disable':
+        setEnabled(False)
+    elif args.command == 'export':
+        count = exportChromeTrace(args.output)
+        print('wrote ' + str(count) + ' spans to ' + args.output)
+    elif args.command == 'clean':
+        removeRings()
+    print('tracing ' + ('enabled' if isEnabled() else 'disabled'))
@@ -0,0 +1,114 @@
+# coding: UTF-8
+
+import argparse
+import json
+import os
+import threading
+import time
+from multiprocessing import Process
+import spanTrace
+from spanTrace import span, traced, setProcessName
+
+
+"""
+
+benchmark for spanTrace.py
+
+無効時と有効時の1spanあたりのコストを計測し、2つのプロセスで書き込んだspanを1つのタイムラインに出力する。
+1つのプロセスの複数のスレッドから同時に書き込んだspanが、失われたり重複したりしないことも確認する。
+計測後は有効無効を元に戻す。
+
+.. code-block:: bash
+
+    python3 spanTraceBenchmark.py --count 100000 --output trace.json
+
+"""
+
+
+@traced('work')
+def work():
+    pass
+
+
+def measure(count):
+    start = time.perf_counter()
+    for i in range(count):
+        with span('block', i):
+            pass
+    block = (time.perf_counter() - start) / count
+    start = time.perf_counter()
+    for i in range(count):
+        work()
+    decorated = (time.perf_counter() - start) / count
+    return block, decorated
+
+
+def threadWriter(count, barrier):
+    # 全スレッドが書き終わるまで終了しない(スレッドIDが再利用されないように)
+    barrier.wait()
+    for i in range(count):
+        with span('thread', i):
+            pass
+    barrier.wait()
+
+
+# 各スレッドのspanが1つずつ(リングバッファに収まる数だけ書く)
+def checkThreads(output_path, thread_count, count):
+    barrier = threading.Barrier(thread_count)
+    threads = [threading.Thread(target=threadWriter, args=(count, barrier)) for i in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    idents = [thread.ident for thread in threads]
+    for thread in threads:
+        thread.join()
+    spanTrace.exportChromeTrace(output_path)
+    with open(output_path) as f:
+        spans = [(event['tid'], event['args']['arg']) for event in json.load(f)['traceEvents']
+                 if event['ph'] == 'X' and event['pid'] == os.getpid() and event['name'] == 'thread']
+    expected = {(ident & 0xFFFFFFFF, i) for ident in idents for i in range(count)}
+    return len(spans) == len(expected) and set(spans) == expected
+
+
+def producer(name, count):
+    setProcessName(name)
+    for i in range(count):
+        with span(name, i):
+            time.sleep(0.001)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measure the overhead of span tracing')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--output', default='trace.json')
+    args = parser.parse_args()
+
+    was_enabled = spanTrace.isEnabled()
+    try:
+        for enabled in [False, True]:
+            spanTrace.setEnabled(enabled)
+            block, decorated = measure(args.count)
+            print(('enabled ' if enabled else 'disabled') + ': with span = ' + '{:.2f}'.format(block * 1e6) +
+                  ' [us], @traced = ' + '{:.2f}'.format(decorated * 1e6) + ' [us]')
+
+        thread_count = 4
+        thread_span_count = spanTrace.RING_CAPACITY // (thread_count * 2)
+        if not checkThreads(args.output, thread_count, thread_span_count):
+            raise RuntimeError('spans of threads were lost or duplicated')
+        print('threads : ' + str(thread_count) + ' x ' + str(thread_span_count) + ' spans ok')
+
+        processes = [Process(target=producer, args=('producer' + str(i), 100)) for i in range(2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        count = spanTrace.exportChromeTrace(args.output)
+        with open(args.output) as f:
+            pids = {event['pid'] for event in json.load(f)['traceEvents']}
+        print('exported ' + str(count) + ' spans of ' + str(len(pids)) + ' processes to ' + args.output)
+    finally:
+        spanTrace.setEnabled(was_enabled)
+        # 終了したプロセスと、このプロセスのリングバッファを消す
+        spanTrace.removeRings()
+        own_ring_path = os.path.join(spanTrace.traceDirectory(), spanTrace.TRACE_CHANNEL_PREFIX + '_' + str(os.getpid()))
+        if os.path.exists(own_ring_path):
+            os.remove(own_ring_path)
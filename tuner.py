@@ -0,0 +1,343 @@
+# coding: UTF-8
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from multiprocessing import Pool
+import debug
+import motorContl
+from motorContl import MotorController
+from simulator import Simulator, SimWorld
+
+
+"""
+
+motor parameter tuner
+
+simulator.pyの決まったボール配置(シーン)で、ボールを1個届けるまでのエピソードをプロセスプールで並列に実行し、
+MotorController、ChaseMode、MotorControlPostProcessorのパラメータを探索する。
+
+| grid     : 各パラメータをGRID_POINTS等分した全組み合わせを試す
+| random   : 範囲内の一様乱数で試す
+| adaptive : 最初はrandomで試し、その後は良かった候補の周辺と悪かった候補の周辺の密度の比が大きい点を試す(TPE)
+
+評価値はシーン毎の(捕獲までの時間 + 捕獲から配達までの時間)の平均[s]で、小さいほど良い。
+配達できなかったエピソードはタイムアウトの2倍として扱う。
+候補はまずEARLY_STOP_EPISODES個のエピソードで評価し、最良の候補よりEARLY_STOP_RATIO倍以上悪ければ残りを実行しない。
+
+最良のパラメータはmotor_params.jsonに書き出し、main.pyの起動時にMotorController.load_params()で読み込む。
+
+.. code-block:: bash
+
+    python3 tuner.py --method adaptive --trials 60 --workers 4
+    python3 tuner.py --method grid --grid-points 3 --output motor_params.json
+
+Note:
+    シミュレータにはセンターカメラが無いので、SPEED_STATION_GUIDE、K_STATION_GUIDE_ANGLEは調整できない
+
+"""
+
+
+# 探索するパラメータ : 'ClassName.CONSTANT_NAME' -> (最小値, 最大値, 型)
+SEARCH_SPACE = {
+    'MotorController.SPEED_CHASE': (20, 80, int),
+    'MotorController.K_CHASE_ANGLE': (0.2, 1.5, float),
+    'MotorController.SPEED_TURN': (10, 40, int),
+    'MotorController.K_TURN_ANGLE': (0.5, 3.0, float),
+    'MotorController.TIME_WALL_STUCK': (1.0, 6.0, float),
+    'ChaseMode.MAX_NORMAL_TIME_SEC': (3.0, 15.0, float),
+    'ChaseMode.MAX_SWING_TIME_SEC': (1.0, 8.0, float),
+    'MotorControlPostProcessor.PRESS_WALL_DETECT_TIME': (0.3, 2.0, float),
+    'MotorControlPostProcessor.PRESS_WALL_BACK_TIME': (0.5, 3.0, float),
+}
+
+# シーン : 最初に置くボール(ロボットはステーションの前から奥を向いてスタートする)
+_CENTER_X = (SimWorld.STATION_X_CM[0] + SimWorld.STATION_X_CM[1]) / 2
+SCENES = {
+    'front': [[_CENTER_X, 150, 'RED']],
+    'left': [[50, 120, 'BLUE']],
+    'right': [[250, 120, 'RED']],
+    'far': [[_CENTER_X + 30, 270, 'BLUE']],
+    'corner': [[20, 280, 'RED']],
+    'behind': [[_CENTER_X - 60, 40, 'BLUE']],
+}
+
+# 1エピソードの最大時間[s]
+EPISODE_TIMEOUT_SEC = 60
+# 配達できなかったエピソードの評価値の倍率(タイムアウトに対する)
+TIMEOUT_PENALTY = 2
+# 途中打ち切りの判定に使うエピソード数と倍率
+EARLY_STOP_EPISODES = 4
+EARLY_STOP_RATIO = 1.3
+# gridの分割数
+GRID_POINTS = 3
+# adaptiveでrandomに試す回数、良い候補とする割合、1回に比べる候補数
+ADAPTIVE_WARMUP = 10
+ADAPTIVE_GOOD_RATIO = 0.25
+ADAPTIVE_CANDIDATES = 24
+
+
+def _initWorker():
+    # 各エピソードのログは多すぎるので警告以上だけ出す
+    debug.setDebugLevel(debug.DEBUG_LEVEL_WARN)
+
+
+def runEpisode(args):
+    """
+
+    run one episode in a worker process
+
+    Args:
+        args (tuple) : (params, scene_name, seed, timeout_sec)
+
+    Returns:
+        dict: scene, seed, time_to_capture, time_to_station, score
+
+    """
+    params, scene_name, seed, timeout_sec = args
+    simulator = Simulator(seed=seed, balls=SCENES[scene_name], params=params)
+    try:
+        report = simulator.run(timeout_sec, stop_after_deliveries=1)
+    finally:
+        simulator.close()
+    time_to_capture = report['mean_time_to_capture_sec']
+    time_to_station = report['mean_time_to_station_sec']
+    if report['delivered'] > 0:
+        score = time_to_capture + time_to_station
+    else:
+        score = timeout_sec * TIMEOUT_PENALTY
+    return {'scene': scene_name, 'seed': seed, 'time_to_capture': time_to_capture,
+            'time_to_station': time_to_station, 'score': score}
+
+
+class Tuner:
+    """
+
+    Search MotorController parameters with closed-loop simulated episodes
+
+    Examples:
+        >>> tuner = Tuner(workers=4)
+        >>> best = tuner.search('adaptive', trials=60)
+        >>> tuner.writeParams('motor_params.json')
+
+    Attributes:
+        results (list) : (params, score, episodes) of every fully evaluated candidate
+        pruned (list) : (params, partial score) of the candidates stopped early
+        best (tuple) : (params, score, episodes) with the lowest score
+
+    """
+
+    def __init__(self, workers=None, scenes=None, seeds=2, timeout_sec=EPISODE_TIMEOUT_SEC, space=None, seed=0):
+        self._workers = workers or os.cpu_count() or 1
+        self._scenes = scenes if scenes is not None else sorted(SCENES)
+        self._seeds = seeds
+        self._timeout_sec = timeout_sec
+        self._space = space if space is not None else SEARCH_SPACE
+        self._rng = random.Random(seed)
+        self.results = []
+        self.pruned = []
+        self.best = None
+        self.episode_count = 0
+        self.early_stop_count = 0
+
+    def _episodes(self, params):
+        # 途中打ち切りの判定が偏らないように、シーンを先に回す
+        return [(params, scene_name, seed, self._timeout_sec)
+                for seed in range(self._seeds) for scene_name in self._scenes]
+
+    def evaluate(self, pool, candidates):
+        """
+
+        evaluate candidates in parallel with early stopping
+
+        Returns:
+            list of (params, score, episodes): score is None if stopped early
+
+        """
+        episodes = [self._episodes(params) for params in candidates]
+        # 1段目 : 最初のEARLY_STOP_EPISODES個
+        first = [pool.map_async(runEpisode, episode[:EARLY_STOP_EPISODES]) for episode in episodes]
+        results = []
+        second = []
+        for params, episode, async_result in zip(candidates, episodes, first):
+            done = async_result.get()
+            self.episode_count += len(done)
+            partial = _meanScore(done)
+            # 最良の候補の同じエピソード(シーンとシード)の評価値と比べる
+            if self.best is not None and partial > _meanScore(self.best[2][:len(done)]) * EARLY_STOP_RATIO:
+                self.early_stop_count += 1
+                self.pruned.append((params, partial))
+                results.append((params, None, done))
+                second.append(None)
+                continue
+            second.append(pool.map_async(runEpisode, episode[EARLY_STOP_EPISODES:]))
+            results.append((params, partial, done))
+        # 2段目 : 残り
+        for i, async_result in enumerate(second):
+            if async_result is None:
+                continue
+            params, partial, done = results[i]
+            rest = async_result.get()
+            self.episode_count += len(rest)
+            done = done + rest
+            results[i] = (params, _meanScore(done), done)
+        for result in results:
+            if result[1] is None:
+                continue
+            self.results.append(result)
+            if self.best is None or result[1] < self.best[1]:
+                self.best = result
+                print('best score = ' + '{:.2f}'.format(result[1]) + ' [s]: ' + json.dumps(result[0]), flush=True)
+        return results
+
+    def _random(self):
+        params = {}
+        for key, (low, high, value_type) in self._space.items():
+            params[key] = _cast(self._rng.uniform(low, high), value_type)
+        return params
+
+    def _grid(self, points):
+        axes = []
+        for key, (low, high, value_type) in self._space.items():
+            values = [_cast(low + (high - low) * i / (points - 1), value_type) for i in range(points)]
+            axes.append(sorted(set(values)))
+        for values in itertools.product(*axes):
+            yield dict(zip(self._space, values))
+
+    def _adaptive(self):
+        # 評価値の良い順に並べ、良い候補と悪い候補に分ける
+        ranked = sorted(self.results, key=lambda result: result[1])
+        good_count = max(int(len(ranked) * ADAPTIVE_GOOD_RATIO), 1)
+        good = [result[0] for result in ranked[:good_count]]
+        # 途中で打ち切った候補も悪い候補として使う
+        bad = [result[0] for result in ranked[good_count:]] + [params for params, partial in self.pruned] or good
+        best_params = None
+        best_ratio = -math.inf
+        for i in range(ADAPTIVE_CANDIDATES):
+            # 良い候補の周辺から選ぶ
+            center = self._rng.choice(good)
+            params = {}
+            for key, (low, high, value_type) in self._space.items():
+                sigma = (high - low) / max(len(good), 2)
+                value = min(max(self._rng.gauss(center[key], sigma), low), high)
+                params[key] = _cast(value, value_type)
+            ratio = self._density(params, good) - self._density(params, bad)
+            if ratio > best_ratio:
+                best_params = params
+                best_ratio = ratio
+        return best_params
+
+    def _density(self, params, population):
+        # 各パラメータのガウスカーネルの積の平均(対数)
+        total = 0
+        for other in population:
+            log_density = 0
+            for key, (low, high, value_type) in self._space.items():
+                sigma = (high - low) / max(len(population), 2)
+                log_density -= ((params[key] - other[key]) / sigma) ** 2 / 2
+            total += math.exp(log_density)
+        return math.log(total / len(population) + 1e-300)
+
+    def search(self, method, trials=30, grid_points=GRID_POINTS):
+        """
+
+        Args:
+            method (str) : 'grid', 'random' or 'adaptive'
+            trials (int) : number of candidates (gridの場合は最大数、格子点の方が多い場合はランダムに選ぶ)
+
+        Returns:
+            tuple: (params, score, episodes) of the best candidate
+
+        """
+        start_time = time.monotonic()
+        with Pool(self._workers, initializer=_initWorker) as pool:
+            # 現在のパラメータを基準として最初に評価する
+            self.evaluate(pool, [self._current()])
+            if method == 'grid':
+                candidates = list(self._grid(grid_points))
+                # 先頭から切り詰めると最後の数軸しか変わらないので、格子点から偏りなく選ぶ
+                if len(candidates) > trials:
+                    candidates = self._rng.sample(candidates, trials)
+                for i in range(0, len(candidates), self._workers):
+                    self.evaluate(pool, candidates[i:i + self._workers])
+            elif method == 'random':
+                for i in range(0, trials, self._workers):
+                    self.evaluate(pool, [self._random() for j in range(min(self._workers, trials - i))])
+            elif method == 'adaptive':
+                count = 0
+                while count < trials:
+                    if len(self.results) < ADAPTIVE_WARMUP:
+                        candidates = [self._random() for j in range(min(self._workers, trials - count))]
+                    else:
+                        candidates = [self._adaptive() for j in range(min(self._workers, trials - count))]
+                    self.evaluate(pool, candidates)
+                    count += len(candidates)
+            else:
+                raise ValueError('unknown search method: ' + method)
+        print('episodes = ' + str(self.episode_count) + ', early stopped candidates = ' + str(self.early_stop_count) +
+              ', elapsed = ' + '{:.1f}'.format(time.monotonic() - start_time) + ' [s]', flush=True)
+        return self.best
+
+    def _current(self):
+        params = {}
+        for key in self._space:
+            class_name, _, name = key.partition('.')
+            params[key] = getattr(getattr(motorContl, class_name), name)
+        return params
+
+    def writeParams(self, path):
+        """
+
+        write the best parameters for MotorController.load_params()
+
+        """
+        params, score, episodes = self.best
+        data = {'params': params,
+                'score': round(score, 3),
+                'time_to_capture': _mean([episode['time_to_capture'] for episode in episodes]),
+                'time_to_station': _mean([episode['time_to_station'] for episode in episodes]),
+                'scenes': self._scenes,
+                'seeds': self._seeds,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+        # 読み込み中に途中まで書いたファイルが見えないように、一時ファイルに書いてから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+
+def _cast(value, value_type):
+    return int(round(value)) if value_type is int else round(value, 3)
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def _meanScore(episodes):
+    return sum(episode['score'] for episode in episodes) / len(episodes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tune MotorController parameters with the simulator')
+    parser.add_argument('--method', choices=['grid', 'random', 'adaptive'], default='adaptive')
+    parser.add_argument('--trials', type=int, default=30, help='number of candidates')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--seeds', type=int, default=2, help='number of seeds per scene')
+    parser.add_argument('--scenes', nargs='+', choices=sorted(SCENES), default=None)
+    parser.add_argument('--timeout', type=float, default=EPISODE_TIMEOUT_SEC, help='max simulated time of an episode [s]')
+    parser.add_argument('--grid-points', type=int, default=GRID_POINTS)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random search')
+    parser.add_argument('--output', default=MotorController.PARAMS_FILE)
+    args = parser.parse_args()
+
+    tuner = Tuner(workers=args.workers, scenes=args.scenes, seeds=args.seeds, timeout_sec=args.timeout, seed=args.seed)
+    tuner.search(args.method, trials=args.trials, grid_points=args.grid_points)
+    tuner.writeParams(args.output)
+    print('wrote ' + args.output)
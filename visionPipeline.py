@@ -0,0 +1,201 @@
+# coding: UTF-8
+
+import ctypes
+import multiprocessing
+import queue
+import threading
+import time
+import numpy as np
+from frameSource import PiCameraFrameSource
+from latencyStats import LatencyStats
+from debug import ERROR, WARN, INFO, DEBUG, TRACE
+
+
+"""
+
+pipelined vision module
+
+画像の取得、画像処理、共有メモリへの書き込みを並列に行う
+
+.. code-block:: none
+
+    capture thread -> task queue -> worker processes -> result queue -> sequencer -> shmem
+
+"""
+
+
+class SoundPhaseHolder:
+    """
+
+    Receive soundPhase written by ImageProcessing.imageProcessingFrame() in a worker process
+
+    ワーカは処理順が前後するので共有メモリに直接書き込まず、sequencerが順番を揃えてから書き込む
+
+    """
+
+    def __init__(self):
+        self.soundPhase = None
+
+
+class VisionPipeline:
+    """
+
+    Pipelined vision mode
+
+    画像取得スレッドが共有メモリ上のフレームスロットに画像をコピーしてキューに積み、
+    複数のワーカプロセスが imageProcessingFrame() を実行する。
+    sequencerは処理済みの結果のうち、公開済みのものより新しいフレームの結果だけを共有メモリに書き込む。
+    キューが一杯の場合は一番古いフレームを捨てる。
+
+    Examples:
+        >>> pipeline = VisionPipeline(ImageProcessing(), workers=3)
+        >>> pipeline.run(shmem)
+
+    Attributes:
+        _frame_array (multiprocessing.RawArray) : frame slots shared with the worker processes
+        _free_slots (queue.Queue) : frame slot indices which are not used now
+        _last_published_seq (int) : frame seq of the newest result written to shmem
+
+    """
+
+    def __init__(self, imageProcessing, workers=2, queue_size=2, resolution=(480, 480), report_interval_sec=5):
+        self._imageProcessing = imageProcessing
+        self._workers = workers
+        self._resolution = resolution
+        self._report_interval_sec = report_interval_sec
+        # キュー待ち、処理中、sequencer待ちのフレームと書き込み中のフレームの分だけスロットを確保する
+        self._slot_count = 2 * workers + queue_size + 1
+        width, height = resolution
+        self._frame_array = multiprocessing.RawArray(ctypes.c_uint8, self._slot_count * height * width * 3)
+        self._task_queue = multiprocessing.Queue(maxsize=queue_size)
+        self._result_queue = multiprocessing.Queue()
+        self._free_slots = queue.Queue()
+        for slot in range(self._slot_count):
+            self._free_slots.put(slot)
+        self._last_published_seq = 0
+        self._queue_dropped_frames = 0
+        self._stale_dropped_frames = 0
+        self._published_frames = 0
+        self._copy_stats = LatencyStats('copy')
+        self._queue_stats = LatencyStats('queue')
+        self._process_stats = LatencyStats('process')
+        self._publish_stats = LatencyStats('publish')
+        self._latency_stats = LatencyStats('capture->publish')
+
+    def _frames(self):
+        width, height = self._resolution
+        return np.frombuffer(self._frame_array, dtype=np.uint8).reshape((self._slot_count, height, width, 3))
+
+    def _worker_loop(self):
+        TRACE('VisionPipeline worker start')
+        frames = self._frames()
+        holder = SoundPhaseHolder()
+        while True:
+            task = self._task_queue.get()
+            if task is None:
+                break
+            slot, frame_seq, capture_time, enqueue_time = task
+            start_time = time.monotonic()
+            holder.soundPhase = None
+            result = self._imageProcessing.imageProcessingFrame(frames[slot], holder)
+            end_time = time.monotonic()
+            self._result_queue.put((slot, frame_seq, capture_time, enqueue_time, start_time, end_time,
+                                    result, holder.soundPhase))
+        self._result_queue.put(None)
+        TRACE('VisionPipeline worker end')
+
+    def _capture_loop(self, source):
+        TRACE('VisionPipeline capture start')
+        frames = self._frames()
+        while True:
+            captured = source.read()
+            if captured is None:
+                break
+            frame, frame_seq, capture_time = captured
+            copy_start_time = time.monotonic()
+            slot = self._free_slots.get()
+            np.copyto(frames[slot], frame)
+            self._copy_stats.add(time.monotonic() - copy_start_time)
+            task = (slot, frame_seq, capture_time, time.monotonic())
+            while True:
+                try:
+                    self._task_queue.put_nowait(task)
+                    break
+                except queue.Full:
+                    # 一番古いフレームを捨てて、新しいフレームを優先する
+                    try:
+                        old_task = self._task_queue.get_nowait()
+                        self._free_slots.put(old_task[0])
+                        self._queue_dropped_frames += 1
+                    except queue.Empty:
+                        pass
+        for i in range(self._workers):
+            self._task_queue.put(None)
+        TRACE('VisionPipeline capture end')
+
+    def _sequence(self, shmem, source):
+        running_workers = self._workers
+        report_start_time = time.monotonic()
+        while running_workers > 0:
+            item = self._result_queue.get()
+            if item is None:
+                running_workers -= 1
+                continue
+            slot, frame_seq, capture_time, enqueue_time, start_time, end_time, result, sound_phase = item
+            self._free_slots.put(slot)
+            self._queue_stats.add(start_time - enqueue_time)
+            self._process_stats.add(end_time - start_time)
+            # 公開済みの結果より古いフレームの結果は捨てる
+            if frame_seq <= self._last_published_seq:
+                self._stale_dropped_frames += 1
+                continue
+            self._last_published_seq = frame_seq
+            if sound_phase is not None:
+                shmem.soundPhase = sound_phase
+            self._imageProcessing.writeResult(shmem, result, frame_seq, capture_time)
+            publish_time = time.monotonic()
+            self._publish_stats.add(publish_time - end_time)
+            self._latency_stats.add(publish_time - capture_time)
+            self._published_frames += 1
+
+            if publish_time - report_start_time > self._report_interval_sec:
+                self.report(publish_time - report_start_time, source)
+                report_start_time = publish_time
+
+    def report(self, elapsed_sec, source):
+        INFO('vision pipeline: ' + '{:.1f}'.format(self._published_frames / elapsed_sec) + ' fps',
+             ', dropped capture =', source.dropped_frames,
+             ', queue =', self._queue_dropped_frames,
+             ', stale =', self._stale_dropped_frames)
+        for stats in [self._copy_stats, self._queue_stats, self._process_stats, self._publish_stats, self._latency_stats]:
+            INFO('vision pipeline ' + stats.format())
+            stats.clear()
+        self._published_frames = 0
+
+    def run(self, shmem, source=None):
+        """
+
+        run the pipeline until the source is exhausted
+
+        Args:
+            shmem : shared memory
+            source (FrameSource) : frame source, camera if None
+
+        """
+        TRACE('VisionPipeline run() start: workers = ' + str(self._workers))
+        # スレッドを起動する前にワーカプロセスを生成する
+        worker_processes = [multiprocessing.Process(target=self._worker_loop) for i in range(self._workers)]
+        for worker_process in worker_processes:
+            worker_process.daemon = True
+            worker_process.start()
+
+        if source is None:
+            source = PiCameraFrameSource(resolution=self._resolution)
+        with source:
+            capture_thread = threading.Thread(target=self._capture_loop, args=(source,))
+            capture_thread.daemon = True
+            capture_thread.start()
+            self._sequence(shmem, source)
+            capture_thread.join()
+        for worker_process in worker_processes:
+            worker_process.join()
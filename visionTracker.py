@@ -0,0 +1,198 @@
+# coding: UTF-8
+
+from math import sqrt
+from debug import ERROR, WARN, INFO, DEBUG, TRACE
+
+
+"""
+
+vision tracker module
+
+追跡中の領域の次フレームでの位置を予測し、予測位置の周辺だけを探索させる
+
+"""
+
+
+class ConstantVelocityTracker:
+    """
+
+    Constant-velocity (alpha-beta) filter for one target
+
+    Examples:
+        >>> tracker = ConstantVelocityTracker()
+        >>> tracker.update(240, 120, 3000)
+        >>> window = tracker.search_window(480, 480)
+
+    Attributes:
+        _x, _y (float) : filtered centroid [px]
+        _vx, _vy (float) : filtered velocity [px/frame]
+        _area (float) : area of the last detection [px^2]
+        _lost_count (int) : number of successive frames without detection
+
+    """
+
+    # 位置の補正係数
+    ALPHA = 0.85
+    # 速度の補正係数
+    BETA = 0.3
+    # 探索窓の半径を面積の平方根の何倍にするか
+    WINDOW_SIZE_RATIO = 1.0
+    # 探索窓の半径の最小値[px]
+    WINDOW_MIN_HALF_SIZE = 24
+    # 何フレーム連続で見失ったら追跡をやめるか
+    MAX_LOST_FRAMES = 2
+    # 前回の面積に対してこの割合未満に縮んだら、信頼度が低いとして追跡をやめる
+    MIN_AREA_RATIO = 0.5
+
+    def __init__(self):
+        self._is_locked = False
+        self._x = 0
+        self._y = 0
+        self._vx = 0
+        self._vy = 0
+        self._area = 0
+        self._lost_count = 0
+
+    def is_locked(self):
+        return self._is_locked
+
+    def reset(self):
+        self._is_locked = False
+        self._vx = 0
+        self._vy = 0
+        self._lost_count = 0
+
+    def predict(self):
+        return self._x + self._vx, self._y + self._vy
+
+    def update(self, cx, cy, area):
+        """
+
+        correct the state by a detection
+
+        Returns:
+            bool: False if the detection is not reliable and the target was released
+
+        """
+        if not self._is_locked:
+            self._x = cx
+            self._y = cy
+            self._vx = 0
+            self._vy = 0
+            self._area = area
+            self._lost_count = 0
+            self._is_locked = True
+            return True
+        if area < self._area * self.MIN_AREA_RATIO:
+            DEBUG('tracker: area dropped ' + str(self._area) + ' -> ' + str(area))
+            self.reset()
+            return False
+        predicted_x, predicted_y = self.predict()
+        residual_x = cx - predicted_x
+        residual_y = cy - predicted_y
+        self._x = predicted_x + self.ALPHA * residual_x
+        self._y = predicted_y + self.ALPHA * residual_y
+        self._vx += self.BETA * residual_x
+        self._vy += self.BETA * residual_y
+        self._area = area
+        self._lost_count = 0
+        return True
+
+    def miss(self):
+        if not self._is_locked:
+            return
+        self._lost_count += 1
+        self._x, self._y = self.predict()
+        if self._lost_count > self.MAX_LOST_FRAMES:
+            DEBUG('tracker: lost')
+            self.reset()
+
+    def search_window(self, width, height):
+        """
+
+        get the search window around the predicted centroid
+
+        Returns:
+            tuple: (x0, y0, x1, y1), None if not locked
+
+        """
+        if not self._is_locked:
+            return None
+        predicted_x, predicted_y = self.predict()
+        half_size = max(sqrt(self._area) * self.WINDOW_SIZE_RATIO, self.WINDOW_MIN_HALF_SIZE) + \
+            abs(self._vx) + abs(self._vy)
+        x0 = max(int(predicted_x - half_size), 0)
+        y0 = max(int(predicted_y - half_size), 0)
+        x1 = min(int(predicted_x + half_size) + 1, width)
+        y1 = min(int(predicted_y + half_size) + 1, height)
+        if x0 >= x1 or y0 >= y1:
+            self.reset()
+            return None
+        return x0, y0, x1, y1
+
+
+class VisionTracker:
+    """
+
+    Trackers for the colors used by ImageProcessing
+
+    ボールと黄色ステーションを追跡する。
+    一定フレーム毎に画面全体を探索して、追跡していない大きな領域が現れていないかも確認する。
+
+    Examples:
+        >>> tracker = VisionTracker(['RED', 'BLUE', 'YELLOW'])
+        >>> window = tracker.search_window('RED', 480, 480)
+        >>> # windowの中だけ探索した結果を渡す
+        >>> tracker.update('RED', cx, cy, area_size, min_area_size)
+
+    """
+
+    # この間隔[フレーム]で画面全体を探索し直す
+    FULL_SEARCH_INTERVAL = 10
+
+    def __init__(self, colors):
+        self._trackers = {color_name: ConstantVelocityTracker() for color_name in colors}
+        self._frame_count = 0
+
+    def next_frame(self):
+        self._frame_count += 1
+
+    def is_full_search_frame(self):
+        return self._frame_count % self.FULL_SEARCH_INTERVAL == 0
+
+    def search_window(self, color_name, width, height):
+        """
+
+        Returns:
+            tuple: (x0, y0, x1, y1), None if the whole frame should be searched
+
+        """
+        if color_name not in self._trackers or self.is_full_search_frame():
+            return None
+        return self._trackers[color_name].search_window(width, height)
+
+    def update(self, color_name, cx, cy, area_size, min_area_size):
+        """
+
+        update the tracker by a detection result
+
+        Args:
+            cx, cy (int) : centroid, -1 if not detected
+            area_size (float) : area
+            min_area_size (float) : results smaller than this are not tracked
+
+        Returns:
+            bool: False if the detection is not reliable and the target was released (画面全体を探索し直す)
+
+        """
+        if color_name not in self._trackers:
+            return True
+        tracker = self._trackers[color_name]
+        if cx == -1 or area_size <= min_area_size:
+            tracker.miss()
+            return True
+        return tracker.update(cx, cy, area_size)
+
+    def reset(self, color_name):
+        if color_name in self._trackers:
+            self._trackers[color_name].reset()